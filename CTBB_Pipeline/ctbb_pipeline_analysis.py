@@ -0,0 +1,256 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_analysis.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Quantitative analysis stage: HU histograms, per-slice statistics and
+# density mask (RA-950 style) scores computed over reconstructed series.
+#
+# Series are streamed through in z-slabs (pipeline_img_series.iter_slabs) so
+# that whole volumes are never held in memory, and many series are analyzed
+# in parallel on a process pool.
+
+import os
+import csv
+import logging
+
+import numpy as np
+
+from CTBB_Pipeline.pypeline import pipeline_img_series,map_series
+
+# Histogram covers [hist_min,hist_max) HU in 1 HU bins. Anything outside is
+# clamped into the first/last bin.
+hist_min=-1024
+hist_max=3072
+
+# Density mask thresholds (HU) reported as "RA<threshold>" (percent of voxels below)
+default_thresholds=[-950,-910,-856]
+
+# Percentiles of the HU distribution reported in the summary (e.g. Perc15)
+default_percentiles=[15]
+
+default_slab_size=32
+
+def series_paths(img_filepath):
+    # Returns the paths used by the analysis for a given series:
+    #     prm  - parameter file next to the image data
+    #     mask - optional segmentation mask in the study's seg/ directory
+    #     eval - output directory (the study's eval/ directory)
+    img_dirpath=os.path.dirname(os.path.abspath(img_filepath))
+    study_dirpath=os.path.dirname(img_dirpath)
+    basename=os.path.splitext(os.path.basename(img_filepath))[0]
+
+    paths={}
+    paths['basename']=basename
+    paths['prm']=os.path.join(img_dirpath,basename+'.prm')
+    paths['mask']=os.path.join(study_dirpath,'seg',basename+'.mask')
+    paths['eval']=os.path.join(study_dirpath,'eval')
+    paths['summary']=os.path.join(paths['eval'],basename+'_analysis.yml')
+    paths['histogram']=os.path.join(paths['eval'],basename+'_histogram.csv')
+    paths['slices']=os.path.join(paths['eval'],basename+'_slices.csv')
+    return paths
+
+def is_up_to_date(img_filepath):
+    # Analysis is current if the summary is newer than the image data
+    summary_filepath=series_paths(img_filepath)['summary']
+    if not os.path.exists(summary_filepath):
+        return False
+    return os.path.getmtime(summary_filepath)>=os.path.getmtime(img_filepath)
+
+def threshold_tag(t):
+    return 'RA%d' % abs(int(t))
+
+def percentile_from_histogram(hist,p):
+    # Percentile (in HU) read off of the cumulative 1 HU histogram
+    total=hist.sum()
+    if total==0:
+        return float('nan')
+    idx=np.searchsorted(np.cumsum(hist),total*p/100.0)
+    return float(hist_min+idx)
+
+def analyze_series(img_filepath,thresholds=default_thresholds,percentiles=default_percentiles,slab_size=default_slab_size,use_mask=True):
+    ### Stream one series slab-by-slab and compute its histogram, per-slice
+    ### statistics and threshold metrics. Results are written to the study's
+    ### eval/ directory and returned as a flat summary dictionary.
+    paths=series_paths(img_filepath)
+    series=pipeline_img_series(img_filepath,paths['prm'])
+
+    n_slices=series.header.NoOfSlices
+    thresholds=sorted(thresholds)
+
+    mask=None
+    if use_mask and os.path.exists(paths['mask']):
+        logging.info('Using segmentation mask %s' % paths['mask'])
+        mask=np.memmap(paths['mask'],dtype='uint8',mode='r',
+                       shape=(n_slices,series.header.Width,series.header.Height))
+
+    n_bins=hist_max-hist_min
+    hist=np.zeros(n_bins,dtype=np.int64)
+
+    slice_count=np.zeros(n_slices,dtype=np.int64)
+    slice_sum=np.zeros(n_slices,dtype=np.float64)
+    slice_sum_sq=np.zeros(n_slices,dtype=np.float64)
+    slice_min=np.full(n_slices,np.nan)
+    slice_max=np.full(n_slices,np.nan)
+    slice_below=np.zeros((len(thresholds),n_slices),dtype=np.int64)
+
+    for start,slab in series.iter_slabs(slab_size):
+        stop=start+slab.shape[0]
+
+        if mask is not None:
+            m=np.transpose(mask[start:stop],(0,2,1))!=0
+        else:
+            m=np.ones(slab.shape,dtype=bool)
+
+        # Per-slice moments over the masked voxels
+        counts=m.sum(axis=(1,2))
+        masked=np.where(m,slab,0.0)
+        slice_count[start:stop]=counts
+        slice_sum[start:stop]=masked.sum(axis=(1,2),dtype=np.float64)
+        slice_sum_sq[start:stop]=np.square(masked,dtype=np.float64).sum(axis=(1,2))
+
+        has_voxels=counts>0
+        if has_voxels.any():
+            slice_min[start:stop][has_voxels]=np.where(m,slab,np.inf).min(axis=(1,2))[has_voxels]
+            slice_max[start:stop][has_voxels]=np.where(m,slab,-np.inf).max(axis=(1,2))[has_voxels]
+
+        for i,t in enumerate(thresholds):
+            slice_below[i,start:stop]=np.logical_and(slab<t,m).sum(axis=(1,2))
+
+        # Histogram via bincount on clamped integer bin indices
+        values=slab[m]
+        bins=np.clip(np.floor(values).astype(np.int64)-hist_min,0,n_bins-1)
+        hist+=np.bincount(bins,minlength=n_bins)
+
+    ## Summary statistics
+    n_voxels=int(slice_count.sum())
+    summary={}
+    summary['img_series_filepath']=img_filepath
+    summary['masked']=mask is not None
+    summary['n_slices']=n_slices
+    summary['n_voxels']=n_voxels
+    if n_voxels>0:
+        mean=slice_sum.sum()/n_voxels
+        summary['mean']=float(mean)
+        summary['std']=float(np.sqrt(max(slice_sum_sq.sum()/n_voxels-mean**2,0.0)))
+        summary['min']=float(np.nanmin(slice_min))
+        summary['max']=float(np.nanmax(slice_max))
+    else:
+        summary['mean']=summary['std']=summary['min']=summary['max']=float('nan')
+
+    for i,t in enumerate(thresholds):
+        below=int(slice_below[i].sum())
+        summary[threshold_tag(t)]=100.0*below/n_voxels if n_voxels>0 else float('nan')
+
+    for p in percentiles:
+        summary['Perc%d' % p]=percentile_from_histogram(hist,p)
+
+    ## Write results to the study's eval directory
+    if not os.path.isdir(paths['eval']):
+        os.makedirs(paths['eval'])
+
+    with open(paths['histogram'],'w',newline='') as f:
+        wr=csv.writer(f,lineterminator=os.linesep)
+        wr.writerow(['hu','count'])
+        nonzero=np.flatnonzero(hist)
+        for idx in nonzero:
+            wr.writerow([hist_min+int(idx),int(hist[idx])])
+
+    with open(paths['slices'],'w',newline='') as f:
+        wr=csv.writer(f,lineterminator=os.linesep)
+        wr.writerow(['slice','n_voxels','mean','std','min','max']+[threshold_tag(t) for t in thresholds])
+        with np.errstate(invalid='ignore',divide='ignore'):
+            slice_mean=slice_sum/slice_count
+            slice_std=np.sqrt(np.maximum(slice_sum_sq/slice_count-slice_mean**2,0.0))
+            slice_pct=100.0*slice_below/slice_count
+        for z in range(n_slices):
+            wr.writerow([z,int(slice_count[z]),slice_mean[z],slice_std[z],slice_min[z],slice_max[z]]+
+                        [slice_pct[i,z] for i in range(len(thresholds))])
+
+    # Summary is written last since its mtime marks the analysis as complete
+    with open(paths['summary'],'w') as f:
+        def printout(tag,value):
+            f.write("%s: %s\n" % (str(tag),str(value)))
+        for k,v in summary.items():
+            printout(k,v)
+
+    return summary
+
+def read_summary(img_filepath):
+    # Read back a previously written summary file
+    import yaml
+    with open(series_paths(img_filepath)['summary'],'r') as f:
+        return yaml.safe_load(f)
+
+def analyze_library(library,n_processes=None,force=False,**kwargs):
+    ### Analyze every IMG series in a pipeline library on a process pool and
+    ### write the library-wide table to library/eval/analysis.csv
+    library.refresh_recon_list()
+    recon_list=library.get_recon_list()
+
+    recon_list=[r for r in recon_list if r['img_series_filepath'].endswith(('.img','.imgz'))]
+
+    todo=[r['img_series_filepath'] for r in recon_list
+          if force or not is_up_to_date(r['img_series_filepath'])]
+
+    logging.info('Analyzing %d of %d series' % (len(todo),len(recon_list)))
+
+    results={}
+    if todo:
+        for img_filepath,summary in map_series(analyze_series,todo,n_processes,**kwargs):
+            results[img_filepath]=summary
+
+    ## Assemble the library-wide table from all available summaries
+    rows=[]
+    for r in recon_list:
+        p=r['img_series_filepath']
+        if p in results:
+            summary=results[p]
+        elif is_up_to_date(p):
+            summary=read_summary(p)
+        else:
+            summary=None
+
+        if not summary:
+            continue
+
+        row={k:r[k] for k in ['pipeline_id','dose','kernel','slice_thickness']}
+        row.update(summary)
+        rows.append(row)
+
+    eval_dir=os.path.join(library.path,'eval')
+    if not os.path.isdir(eval_dir):
+        os.makedirs(eval_dir)
+
+    table_filepath=os.path.join(eval_dir,'analysis.csv')
+    if rows:
+        fieldnames=list(rows[0].keys())
+        for row in rows:
+            for k in row.keys():
+                if k not in fieldnames:
+                    fieldnames.append(k)
+        with open(table_filepath,'w',newline='') as f:
+            w=csv.DictWriter(f,fieldnames,lineterminator=os.linesep)
+            w.writeheader()
+            for row in rows:
+                w.writerow(row)
+
+    n_failed=len([p for p in results if results[p] is None])
+    if n_failed:
+        logging.warning('%d series failed analysis' % n_failed)
+
+    return rows
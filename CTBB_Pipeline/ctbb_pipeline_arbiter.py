@@ -0,0 +1,293 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_arbiter.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Host-wide GPU arbiter shared by every pipeline library on a machine.
+#
+# Library device mutexes (.proc/mutex/devN) only protect a device against
+# jobs from the same library.  The arbiter is a lock directory shared by all
+# daemons on the host (default /tmp/ctbb_pipeline_arbiter, override with the
+# CTBB_PIPELINE_ARBITER_DIR environment variable):
+#
+#     slots/devN          - one file per claimed device: library, pid, host, acquired
+#     libraries/<id>      - one file per running daemon: library, weight, demand, pid
+#     weights.yml         - optional "library path: weight" overrides
+#
+# Slots are claimed by hard-linking a fully written record into place, which
+# fails atomically if the slot is taken.  A claim is granted if the library
+# holds fewer devices than its weighted fair share of the host, or if enough
+# devices are free that no other waiting library's share is affected.  Slots
+# whose owning process has died are dropped automatically.
+
+import os
+import time
+import math
+import logging
+from hashlib import md5
+
+from CTBB_Pipeline.ctbb_pipeline_lease import hostname,pid_alive,write_record,read_record
+
+default_arbiter_dir='/tmp/ctbb_pipeline_arbiter'
+
+def get_arbiter_dir():
+    return os.environ.get('CTBB_PIPELINE_ARBITER_DIR',default_arbiter_dir)
+
+def library_id(library_path):
+    return md5(os.path.abspath(library_path).encode('utf-8')).hexdigest()
+
+def read_weights(arbiter_dir):
+    # Optional host-wide weight overrides keyed by library path
+    weights={}
+    weights_filepath=os.path.join(arbiter_dir,'weights.yml')
+    if os.path.exists(weights_filepath):
+        import yaml
+        with open(weights_filepath,'r') as f:
+            w=yaml.safe_load(f)
+        if w:
+            for k,v in w.items():
+                weights[os.path.abspath(k)]=float(v)
+    return weights
+
+def read_records(dirpath):
+    records={}
+    if not os.path.isdir(dirpath):
+        return records
+    for f in os.listdir(dirpath):
+        if f.endswith('.tmp'):
+            continue
+        try:
+            records[f]=read_record(os.path.join(dirpath,f))
+        except (IOError,ValueError):
+            continue
+    return records
+
+def is_stale(record):
+    # Records are only considered stale if their owner is provably gone
+    return record.get('host')==hostname() and not pid_alive(record.get('pid',-1))
+
+class gpu_arbiter:
+    arbiter_dir=None
+    slot_dir=None
+    library_dir=None
+    library_path=None
+    library_id=None
+    weight=None
+
+    def __init__(self,library_path,weight=1,arbiter_dir=None):
+        if arbiter_dir is None:
+            arbiter_dir=get_arbiter_dir()
+
+        self.arbiter_dir=arbiter_dir
+        self.slot_dir=os.path.join(arbiter_dir,'slots')
+        self.library_dir=os.path.join(arbiter_dir,'libraries')
+        self.library_path=os.path.abspath(library_path)
+        self.library_id=library_id(library_path)
+
+        weights=read_weights(arbiter_dir)
+        self.weight=weights.get(self.library_path,float(weight))
+
+        for d in [self.arbiter_dir,self.slot_dir,self.library_dir]:
+            if not os.path.isdir(d):
+                os.makedirs(d,exist_ok=True)
+                try:
+                    os.chmod(d,0o777) # Shared by every user's daemons
+                except OSError:
+                    pass
+
+    def register(self,demand):
+        ### Advertise this library's daemon and how many jobs it has waiting
+        record={
+            'library':self.library_path,
+            'weight':self.weight,
+            'demand':demand,
+            'pid':os.getpid(),
+            'host':hostname(),
+            'updated':time.time(),
+        }
+        write_record(os.path.join(self.library_dir,self.library_id),record)
+
+    def unregister(self):
+        path=os.path.join(self.library_dir,self.library_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def slots(self):
+        ### Current device claims. Claims held by dead processes are removed.
+        slots=read_records(self.slot_dir)
+        for device in list(slots.keys()):
+            if is_stale(slots[device]):
+                logging.warning('Arbiter: dropping stale claim on %s by %s' % (device,slots[device].get('library')))
+                self.__remove_slot__(device)
+                del slots[device]
+        return slots
+
+    def libraries(self):
+        libraries=read_records(self.library_dir)
+        for k in list(libraries.keys()):
+            if is_stale(libraries[k]):
+                try:
+                    os.remove(os.path.join(self.library_dir,k))
+                except OSError:
+                    pass
+                del libraries[k]
+        return libraries
+
+    def shares(self,n_devices,slots=None,libraries=None):
+        ### Weighted fair share of the host's devices for every library with demand.
+        ### Returns {library path: (held, entitled)}
+        if slots is None:
+            slots=self.slots()
+        if libraries is None:
+            libraries=self.libraries()
+
+        held={}
+        for record in slots.values():
+            held[record.get('library')]=held.get(record.get('library'),0)+1
+
+        active={}
+        for record in libraries.values():
+            lib=record.get('library')
+            if int(record.get('demand',0))>0 or held.get(lib,0)>0:
+                active[lib]=float(record.get('weight',1))
+
+        if self.library_path not in active:
+            active[self.library_path]=self.weight
+
+        total_weight=sum(active.values())
+        shares={}
+        for lib,w in active.items():
+            shares[lib]=(held.get(lib,0),n_devices*w/total_weight)
+        return shares
+
+    def may_claim(self,n_devices):
+        slots=self.slots()
+        libraries=self.libraries()
+        shares=self.shares(n_devices,slots,libraries)
+
+        demand={r.get('library'):int(r.get('demand',0)) for r in libraries.values()}
+
+        held,entitled=shares[self.library_path]
+        if held<math.floor(entitled) or (held==0 and entitled>0):
+            return True
+
+        # Over our share: only take a device no other waiting library needs
+        n_free=n_devices-len(slots)
+        deficit=0
+        for lib,(lib_held,lib_entitled) in shares.items():
+            if lib==self.library_path or demand.get(lib,0)==0:
+                continue
+            deficit+=max(0,min(math.ceil(lib_entitled)-lib_held,demand.get(lib,0)))
+
+        return n_free>deficit
+
+    def claim(self,device,n_devices):
+        ### Try to claim a device for this library. Returns True on success.
+        if not self.may_claim(n_devices):
+            logging.debug('Arbiter: %s is at its fair share, not claiming %s' % (self.library_path,device))
+            return False
+
+        slot_file=os.path.join(self.slot_dir,device)
+        tmp_file='%s.%s.%d.tmp' % (slot_file,hostname(),os.getpid())
+        write_record(tmp_file,{
+            'library':self.library_path,
+            'pid':os.getpid(),
+            'host':hostname(),
+            'acquired':time.time(),
+        })
+
+        try:
+            os.link(tmp_file,slot_file)
+            claimed=True
+        except FileExistsError:
+            claimed=False
+        finally:
+            os.remove(tmp_file)
+
+        if claimed:
+            logging.info('Arbiter: %s claimed %s' % (self.library_path,device))
+        return claimed
+
+    def owns(self,device):
+        slot_file=os.path.join(self.slot_dir,device)
+        try:
+            record=read_record(slot_file)
+        except (IOError,ValueError):
+            return False
+        return record.get('library')==self.library_path
+
+    def adopt(self,device):
+        ### Transfer ownership of our claim to the calling process (the queue item)
+        if not self.owns(device):
+            return False
+        slot_file=os.path.join(self.slot_dir,device)
+        record=read_record(slot_file)
+        record['pid']=os.getpid()
+        record['host']=hostname()
+        write_record(slot_file,record)
+        return True
+
+    def release(self,device):
+        if self.owns(device):
+            self.__remove_slot__(device)
+            logging.info('Arbiter: %s released %s' % (self.library_path,device))
+
+    def __remove_slot__(self,device):
+        try:
+            os.remove(os.path.join(self.slot_dir,device))
+        except OSError:
+            pass
+
+def status(arbiter_dir=None):
+    ### Human readable view of which library holds which device
+    if arbiter_dir is None:
+        arbiter_dir=get_arbiter_dir()
+
+    lines=[]
+    if not os.path.isdir(arbiter_dir):
+        lines.append('No arbiter directory found at %s' % arbiter_dir)
+        return lines
+
+    arb=gpu_arbiter.__new__(gpu_arbiter)
+    arb.arbiter_dir=arbiter_dir
+    arb.slot_dir=os.path.join(arbiter_dir,'slots')
+    arb.library_dir=os.path.join(arbiter_dir,'libraries')
+
+    slots=arb.slots()
+    libraries=arb.libraries()
+
+    lines.append('Arbiter directory: %s' % arbiter_dir)
+    lines.append('')
+    lines.append('%-8s %-8s %-16s %-10s %s' % ('DEVICE','PID','HOST','HELD (s)','LIBRARY'))
+    now=time.time()
+    for device in sorted(slots.keys()):
+        r=slots[device]
+        lines.append('%-8s %-8s %-16s %-10d %s' % (device,r.get('pid'),r.get('host'),now-r.get('acquired',now),r.get('library')))
+    if not slots:
+        lines.append('(no devices claimed)')
+
+    lines.append('')
+    lines.append('%-8s %-8s %-8s %-8s %s' % ('WEIGHT','DEMAND','HELD','PID','LIBRARY'))
+    held={}
+    for r in slots.values():
+        held[r.get('library')]=held.get(r.get('library'),0)+1
+    for r in libraries.values():
+        lines.append('%-8s %-8s %-8s %-8s %s' % (r.get('weight'),r.get('demand'),held.get(r.get('library'),0),r.get('pid'),r.get('library')))
+    if not libraries:
+        lines.append('(no daemons registered)')
+
+    return lines
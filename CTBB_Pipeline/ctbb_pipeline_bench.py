@@ -0,0 +1,494 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_bench.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# End-to-end scheduler benchmark.
+#
+# Builds a synthetic case list and library in a scratch directory, puts stub
+# ctbb_info/ctbb_simdose/ctbb_recon executables first on the PATH, replaces
+# CUDA device discovery with CTBB_PIPELINE_FAKE_DEVICES, and then runs the
+# real ctbb_pipeline_launch -> ctbb_pipeline_daemon -> ctbb_queue_item chain.
+# Once the daemon exits, the library's logs are mined for throughput, device
+# idle gaps, mutex wait time and scheduling latency.
+#
+# With hosts=N, N daemons share the library, each posing as a separate host
+# (CTBB_PIPELINE_HOSTNAME=benchhost<i>, with its own fake devices and arbiter
+# directory), which exercises the multi-host locking on one machine.
+#
+# The stubs are configured through environment variables:
+#     CTBB_STUB_RECON_TIME    - seconds per reconstruction
+#     CTBB_STUB_RECON_TIME_PER_SLICE - plus seconds per reconstructed slice
+#     CTBB_STUB_SIMDOSE_TIME  - seconds per dose reduction
+#     CTBB_STUB_JITTER        - +/- fraction of random variation of the times above
+#     CTBB_STUB_SLICES        - slices written per reconstruction (Nx=Ny=512)
+#     CTBB_STUB_FAILURE_RATE  - probability that a reconstruction fails (CUDA OOM)
+#
+# measure_startup() separately times how long each entry point takes to start
+# (interpreter start plus module imports), and which heavy modules it pulls in.
+
+import os
+import sys
+import time
+import glob
+import json
+import shutil
+import tempfile
+import subprocess
+from datetime import datetime
+
+default_options={
+    'cases'             : 4,
+    'doses'             : [100,50],
+    'slice_thicknesses' : [1.0,5.0],
+    'kernels'           : [1],
+    'devices'           : 2,
+    'hosts'             : 1,
+    'policy'            : 'fifo',
+    'recon_time'        : 2.0,
+    'recon_time_per_slice' : 0.0,
+    'simdose_time'      : 1.0,
+    'jitter'            : 0.2,
+    'slices'            : 8,
+    'failure_rate'      : 0.0,
+    'raw_size'          : 1<<20,
+    'timeout'           : 3600,
+    'workdir'           : None,
+    'staging_dir'       : None,
+    'staging_capacity'  : 100e9,
+    'staging_bandwidth' : 0,
+}
+
+stub_common='''#!PYTHON
+import os,sys,time,random
+def jittered(t):
+    j=float(os.environ.get('CTBB_STUB_JITTER',0.0))
+    return max(0.0,t*random.uniform(1.0-j,1.0+j))
+def runtime(var,default):
+    return jittered(float(os.environ.get(var,default)))
+'''
+
+stub_info=stub_common+'''
+# ctbb_info -b /path/to/raw -> writes /path/to/raw.prmb
+# Scan lengths of 100-400 mm, fixed per file
+from hashlib import md5
+raw=sys.argv[-1]
+length=100*(1+int(md5(os.path.basename(raw).encode('utf-8')).hexdigest(),16)%4)
+with open(raw+'.prmb','w') as f:
+    f.write("Nx:\\t512\\nNy:\\t512\\nStartPos:\\t0\\nEndPos:\\t%d\\nAcqFOV:\\t500\\nReconFOV:\\t350\\n" % length)
+    f.write("ImageOrientationPatient:\\t[[1,0,0],[0,1,0]]\\nXorigin:\\t0\\nYorigin:\\t0\\n")
+    f.write("PitchValue:\\t19.2\\nCollSlicewidth:\\t0.6\\nNrows:\\t32\\n")
+'''
+
+stub_simdose=stub_common+'''
+# ctbb_simdose /full/dose/raw dose /reduced/dose/raw
+src,dose,dst=sys.argv[1:4]
+time.sleep(runtime('CTBB_STUB_SIMDOSE_TIME',1.0))
+with open(src,'rb') as f_in:
+    with open(dst,'wb') as f_out:
+        f_out.write(f_in.read())
+'''
+
+stub_recon=stub_common+'''
+# ctbb_recon -v --timing --device=N /path/to/file.prm
+prm={}
+with open(sys.argv[-1],'r') as f:
+    for line in f.read().splitlines():
+        if ':' in line:
+            k,v=line.split(':',1)
+            prm[k.strip()]=v.strip()
+
+raw=os.path.join(prm['RawDataDir'],prm['RawDataFile'])
+if not os.path.exists(raw):
+    sys.stderr.write('Could not open raw data file: No such file or directory\\n')
+    sys.exit(1)
+with open(raw,'rb') as f:
+    while f.read(1<<20):
+        pass
+
+n_recon_slices=abs(float(prm['EndPos'])-float(prm['StartPos']))/float(prm['SliceThickness'])
+time.sleep(jittered(float(os.environ.get('CTBB_STUB_RECON_TIME',2.0))+
+                    float(os.environ.get('CTBB_STUB_RECON_TIME_PER_SLICE',0.0))*n_recon_slices))
+
+if random.random()<float(os.environ.get('CTBB_STUB_FAILURE_RATE',0.0)):
+    sys.stderr.write('CUDA error: out of memory\\n')
+    sys.exit(1)
+
+n_slices=int(os.environ.get('CTBB_STUB_SLICES',8))
+with open(os.path.join(prm['OutputDir'],prm['OutputFile']),'wb') as f:
+    f.truncate(int(prm.get('Nx',512))*int(prm.get('Ny',512))*n_slices*4)
+'''
+
+pipeline_scripts=['ctbb_pipeline_launch','ctbb_pipeline_daemon','ctbb_queue_item']
+
+def write_stubs(stub_dir):
+    os.makedirs(stub_dir,exist_ok=True)
+    scripts=[('ctbb_info',stub_info),('ctbb_simdose',stub_simdose),('ctbb_recon',stub_recon)]
+
+    # When run from a source checkout, benchmark the checkout's scripts
+    # rather than whatever happens to be installed
+    bin_dir=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'bin')
+    for name in pipeline_scripts:
+        if os.path.exists(os.path.join(bin_dir,name)):
+            scripts.append((name,'#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable,os.path.join(bin_dir,name))))
+
+    for name,text in scripts:
+        path=os.path.join(stub_dir,name)
+        with open(path,'w') as f:
+            f.write(text.replace('#!PYTHON','#!'+sys.executable,1))
+        os.chmod(path,0o755)
+
+def make_workload(workdir,options):
+    ### Synthetic raw files, case list and pipeline configuration file. The
+    ### raw files and library of an earlier run in workdir are cleared.
+    raw_dir=os.path.join(workdir,'raw_src')
+    library_path=os.path.join(workdir,'library')
+    for path in [raw_dir,library_path]:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    os.makedirs(raw_dir)
+
+    case_list_filepath=os.path.join(workdir,'case_list.txt')
+    with open(case_list_filepath,'w') as f:
+        for i in range(options['cases']):
+            raw_filepath=os.path.join(raw_dir,'case%04d.ptr' % i)
+            with open(raw_filepath,'wb') as f_raw:
+                f_raw.write(os.urandom(options['raw_size']))
+            f.write('%s\n' % raw_filepath)
+
+    config_filepath=os.path.join(workdir,'config.yml')
+    with open(config_filepath,'w') as f:
+        f.write('case_list: %s\n' % case_list_filepath)
+        f.write('library: %s\n' % os.path.join(workdir,'library'))
+        f.write('doses: %s\n' % str(options['doses']))
+        f.write('slice_thicknesses: %s\n' % str(options['slice_thicknesses']))
+        f.write('kernels: %s\n' % str(options['kernels']))
+
+    # Library settings must be in place before the daemon starts
+    os.makedirs(library_path)
+    with open(os.path.join(library_path,'settings.yml'),'w') as f:
+        f.write('dispatch_policy: %s\n' % options['policy'])
+        if options['staging_dir']:
+            f.write('staging_dir: %s\n' % options['staging_dir'])
+            f.write('staging_capacity: %d\n' % int(options['staging_capacity']))
+            f.write('staging_bandwidth: %d\n' % int(options['staging_bandwidth']))
+
+    return config_filepath
+
+def bench_hostname(i):
+    return 'benchhost%d' % i
+
+def bench_environment(workdir,options,host=0):
+    env=dict(os.environ)
+    package_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    env['PATH']=os.pathsep.join([os.path.join(workdir,'stubs'),env.get('PATH','')])
+    env['PYTHONPATH']=os.pathsep.join([package_dir]+([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    env['CTBB_PIPELINE_FAKE_DEVICES']=str(options['devices'])
+    env['CTBB_PIPELINE_HOSTNAME']=bench_hostname(host)
+    env['CTBB_PIPELINE_ARBITER_DIR']=os.path.join(workdir,'arbiter',bench_hostname(host))
+    env['CTBB_STUB_RECON_TIME']=str(options['recon_time'])
+    env['CTBB_STUB_RECON_TIME_PER_SLICE']=str(options['recon_time_per_slice'])
+    env['CTBB_STUB_SIMDOSE_TIME']=str(options['simdose_time'])
+    env['CTBB_STUB_JITTER']=str(options['jitter'])
+    env['CTBB_STUB_SLICES']=str(options['slices'])
+    env['CTBB_STUB_FAILURE_RATE']=str(options['failure_rate'])
+    return env
+
+def wait_for_daemon(library_path,timeout,n_hosts=1):
+    # Wait for every host's daemon to appear and then for all of them to exit
+    daemon_mutexes=os.path.join(library_path,'.proc','mutex','daemon@*')
+    t_start=time.time()
+    seen=set()
+    while len(seen)<n_hosts:
+        seen.update(glob.glob(daemon_mutexes))
+        if time.time()-t_start>60:
+            raise RuntimeError('Pipeline daemon never started (%d of %d hosts)' % (len(seen),n_hosts))
+        time.sleep(0.1)
+    while glob.glob(daemon_mutexes):
+        if time.time()-t_start>timeout:
+            raise RuntimeError('Benchmark timed out after %d s' % timeout)
+        time.sleep(0.5)
+
+def parse_log_time(line):
+    return datetime.strptime(line[0:23],'%Y-%m-%d %H:%M:%S,%f')
+
+def percentiles(values,ps=(50,90,99)):
+    values=sorted(values)
+    result={}
+    for p in ps:
+        if values:
+            idx=min(len(values)-1,int(round(p/100.0*(len(values)-1))))
+            result['p%d' % p]=values[idx]
+        else:
+            result['p%d' % p]=float('nan')
+    result['max']=values[-1] if values else float('nan')
+    result['mean']=sum(values)/len(values) if values else float('nan')
+    return result
+
+def mine_logs(library_path):
+    ### Extract per-job timings from the daemon and queue item logs
+    jobs=[]
+    dispatch={}
+    lock_waits=[]
+    staged={'prefetched':0,'on_demand':0}
+
+    for filepath in glob.glob(os.path.join(library_path,'log','*_daemon.log')):
+        with open(filepath,'r') as f:
+            for line in f.read().splitlines():
+                if 'Current queue item is:' in line:
+                    qi,device=line.split('Current queue item is: ',1)[1].rsplit(' for device ',1)
+                    dispatch.setdefault((qi,device),[]).append(parse_log_time(line))
+                elif 'acquired after waiting' in line:
+                    lock_waits.append(('daemon',float(line.split('waiting ')[1].split(' ')[0])))
+                elif ' Staged ' in line:
+                    staged['prefetched']+=1
+
+    for filepath in glob.glob(os.path.join(library_path,'log','*_qi.log')):
+        job={'log':filepath}
+        with open(filepath,'r') as f:
+            for line in f.read().splitlines():
+                if 'START: QUEUE ITEM' in line:
+                    job['start']=parse_log_time(line)
+                elif 'END: QUEUE ITEM' in line:
+                    job['end']=parse_log_time(line)
+                elif 'Lease on ' in line and ' acquired for ' in line:
+                    s=line.split('Lease on ',1)[1]
+                    job['device']=s.split(' acquired for ')[0]
+                    job['qi']=s.split(' acquired for ')[1].rsplit(' (attempt',1)[0]
+                elif 'acquired after waiting' in line:
+                    name=line.split('Mutex ')[1].split(' ')[0]
+                    t=float(line.split('waiting ')[1].split(' ')[0])
+                    lock_waits.append((name,t))
+                    if name=='case_list' or name.startswith('simdose_'):
+                        job['data_wait']=job.get('data_wait',0.0)+t
+                elif 'Adding raw data file to library' in line or 'Reduced dose data not found' in line:
+                    job['produced_data']=True
+                elif ' Staged ' in line:
+                    staged['on_demand']+=1
+                elif 'FINAL STATUS' in line or 'Cleaning up queue item' in line:
+                    job['finished']=True
+        if 'start' in job and 'end' in job and 'device' in job:
+            key=(job['qi'],job['device'])
+            if key in dispatch:
+                # Latest dispatch of this job to this device before it started
+                candidates=[t for t in dispatch[key] if t<=job['start']]
+                if candidates:
+                    job['dispatch']=max(candidates)
+            jobs.append(job)
+
+    return jobs,lock_waits,staged
+
+data_wait_threshold=0.1 # seconds on the case_list/simdose mutexes that count as waiting for data
+
+def summarize(jobs,lock_waits,n_devices,wall_time=None):
+    # n_devices counts the devices of every host
+    ### Throughput, idle gaps, lock waits and scheduling latency
+    report={}
+    report['jobs']=len(jobs)
+    if not jobs:
+        return report
+
+    t0=min([j['start'] for j in jobs])
+    t1=max([j['end'] for j in jobs])
+    makespan=(t1-t0).total_seconds()
+    report['makespan']=makespan
+    if wall_time is not None:
+        report['wall_time']=wall_time
+    report['jobs_per_hour']=3600.0*len(jobs)/makespan if makespan>0 else float('nan')
+
+    # Per-device busy time and idle gaps between consecutive jobs
+    gaps=[]
+    busy=0.0
+    by_device={}
+    for j in jobs:
+        by_device.setdefault(j['device'],[]).append(j)
+    for device,device_jobs in by_device.items():
+        device_jobs.sort(key=lambda j: j['start'])
+        for i,j in enumerate(device_jobs):
+            busy+=(j['end']-j['start']).total_seconds()
+            if i>0:
+                gaps.append(max(0.0,(j['start']-device_jobs[i-1]['end']).total_seconds()))
+    report['device_utilization']=busy/(n_devices*makespan) if makespan>0 else float('nan')
+    report['idle_gap']=percentiles(gaps)
+    report['idle_gap']['total']=sum(gaps)
+
+    by_host={}
+    for device,device_jobs in by_device.items():
+        host=device.split('@',1)[1] if '@' in device else 'localhost'
+        by_host[host]=by_host.get(host,0)+len(device_jobs)
+    report['jobs_per_host']=by_host
+
+    # A job hits when its raw data was ready when it started: it neither
+    # produced the data itself (copy into the library or dose reduction) nor
+    # waited for another job to produce it
+    n_produced=len([j for j in jobs if j.get('produced_data')])
+    n_waited=len([j for j in jobs if not j.get('produced_data') and j.get('data_wait',0.0)>data_wait_threshold])
+    report['cache']={'hit_rate':float(len(jobs)-n_produced-n_waited)/len(jobs),
+                     'produced':n_produced,
+                     'waited':n_waited,
+                     'wait_total':sum([j.get('data_wait',0.0) for j in jobs if not j.get('produced_data')])}
+
+    # Time from the daemon dispatching a job to the job starting on its device
+    latency=[(j['start']-j['dispatch']).total_seconds() for j in jobs if 'dispatch' in j]
+    report['scheduling_latency']=percentiles(latency)
+
+    waits={}
+    for name,t in lock_waits:
+        name=name if not name.startswith('dev') else 'device'
+        name=name if not name.startswith('simdose_') else 'simdose'
+        waits.setdefault(name,[]).append(t)
+    report['lock_wait']={}
+    for name,values in waits.items():
+        report['lock_wait'][name]={'count':len(values),'total':sum(values),'max':max(values)}
+
+    return report
+
+def prediction_error(library_path):
+    ### How well the runtime model (fitted on this run) predicts its recons
+    from CTBB_Pipeline.ctbb_pipeline_library import ctbb_pipeline_library
+    from CTBB_Pipeline.ctbb_pipeline_runtime import runtime_model
+    model=runtime_model(ctbb_pipeline_library(library_path))
+    model.update()
+    errors=[]
+    for r in model.history:
+        if r['recon']>0:
+            errors.append(abs(model.predict_recon(r)-r['recon'])/r['recon'])
+    return {'samples':len(errors),
+            'recon_mean_abs_pct_error':100.0*sum(errors)/len(errors) if errors else float('nan'),
+            'fitted':model.recon_coefficients is not None}
+
+def write_report(report,filepath):
+    def dump(f,d,indent=0):
+        for k,v in d.items():
+            if isinstance(v,dict):
+                f.write('%s%s:\n' % (' '*indent,k))
+                dump(f,v,indent+4)
+            else:
+                f.write('%s%s: %s\n' % (' '*indent,k,str(v)))
+    with open(filepath,'w') as f:
+        dump(f,report)
+
+def run_benchmark(options):
+    ### Run one end-to-end benchmark. Returns (report, working directory).
+    o=dict(default_options)
+    o.update(options)
+
+    workdir=o['workdir']
+    if workdir is None:
+        workdir=tempfile.mkdtemp(prefix='ctbb_pipeline_bench_')
+    else:
+        os.makedirs(workdir,exist_ok=True)
+
+    write_stubs(os.path.join(workdir,'stubs'))
+    config_filepath=make_workload(workdir,o)
+    env=bench_environment(workdir,o)
+    library_path=os.path.join(workdir,'library')
+
+    t_start=time.time()
+    subprocess.check_call(['ctbb_pipeline_launch',config_filepath],env=env,cwd=workdir,
+                          stdout=subprocess.DEVNULL)
+    # The launch starts the first host's daemon; the other hosts join in
+    daemons=[]
+    for i in range(1,o['hosts']):
+        daemons.append(subprocess.Popen(['ctbb_pipeline_daemon',library_path],cwd=workdir,
+                                        env=bench_environment(workdir,o,host=i),
+                                        stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL))
+    wait_for_daemon(library_path,o['timeout'],o['hosts'])
+    for p in daemons:
+        p.wait()
+    wall_time=time.time()-t_start
+
+    jobs,lock_waits,staged=mine_logs(library_path)
+    report=summarize(jobs,lock_waits,o['devices']*o['hosts'],wall_time)
+    report['hosts']=o['hosts']
+    report['policy']=o['policy']
+    if o['staging_dir']:
+        report['staging']=staged
+
+    report['prediction']=prediction_error(library_path)
+
+    with open(os.path.join(library_path,'.proc','done'),'r') as f:
+        report['done']=len(f.read().splitlines())
+    with open(os.path.join(library_path,'.proc','error'),'r') as f:
+        report['errors']=len(f.read().splitlines())
+
+    write_report(report,os.path.join(workdir,'bench_report.yml'))
+    return report,workdir
+
+startup_entry_points=['ctbb_queue_item','ctbb_pipeline_daemon','ctbb_pipeline_launch','ctbb_q',
+                      'ctbb_pipeline_arbiter','ctbb_pipeline_analyze','ctbb_pipeline_metrics']
+heavy_modules=['numpy','yaml','pycuda','jinja2','sqlite3']
+
+startup_probe='''
+import sys,time,json,importlib.util,importlib.machinery
+t=time.time()
+loader=importlib.machinery.SourceFileLoader('ctbb_entry_point',sys.argv[1])
+module=importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name,loader))
+loader.exec_module(module)
+t=time.time()-t
+print(json.dumps([t,[m for m in sys.argv[2:] if m in sys.modules]]))
+'''
+
+def find_entry_point(name):
+    bin_path=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'bin',name)
+    if os.path.exists(bin_path):
+        return bin_path
+    return shutil.which(name)
+
+def measure_startup(repeats=10,entry_points=None):
+    ### Median wall-clock start latency of each entry point in a fresh
+    ### interpreter (the script's module is loaded but its main block does not
+    ### run), next to the bare interpreter start time for reference.
+    if entry_points is None:
+        entry_points=startup_entry_points
+
+    env=dict(os.environ)
+    package_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH']=os.pathsep.join([package_dir]+([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    def run(args):
+        t=time.time()
+        out=subprocess.check_output([sys.executable]+args,env=env,stderr=subprocess.DEVNULL)
+        return time.time()-t,out
+
+    report={}
+    report['interpreter']={'median_ms':1000*percentiles([run(['-c','pass'])[0] for i in range(repeats)],ps=(50,))['p50']}
+
+    for name in entry_points:
+        path=find_entry_point(name)
+        if path is None:
+            continue
+        totals=[]
+        imports=[]
+        loaded=[]
+        for i in range(repeats):
+            try:
+                total,out=run(['-c',startup_probe,path]+heavy_modules)
+            except subprocess.CalledProcessError:
+                break
+            t,loaded=json.loads(out.decode('utf-8').strip().splitlines()[-1])
+            totals.append(total)
+            imports.append(t)
+        if not totals:
+            report[name]={'error':'failed to import'}
+            continue
+        report[name]={'median_ms':1000*percentiles(totals,ps=(50,))['p50'],
+                      'import_ms':1000*percentiles(imports,ps=(50,))['p50'],
+                      'heavy_modules':','.join(loaded) if loaded else 'none'}
+    return report
@@ -0,0 +1,442 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_campaign.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Campaigns: the jobs of one launch (cases x doses x slice thicknesses x
+# kernels), expanded into the queue as it drains rather than all at once.
+#
+# Writing one queue line per job up front makes a 5,000-case, 6x6x3 campaign
+# a 540k-line queue that is rewritten on every pop. Instead, a launch records
+# the campaign in .proc/campaigns/<name>/:
+#
+#     spec.yml   doses, slice_thicknesses, kernels, priority, created
+#     cases      raw filepath of each case, one per line
+#     cursor     grid index of the next job to expand
+#     done       bitmap over the grid: job finished successfully
+#     cancelled  bitmap over the grid: job cancelled before it was expanded
+#
+# Jobs are numbered case-major, then dose, slice thickness and kernel (the
+# order launches have always queued them in). Each daemon pass tops the
+# queue up to 'campaign_window' items (settings.yml) from the campaigns in
+# order of priority, then launch, so the dispatch policies still see a
+# window of jobs to choose from. Expanded queue items carry
+# campaign=<name>,index=<i>, and a job's success sets its bit in 'done'.
+# Progress and diffs read the bitmaps, which are 68 kB for 540k jobs.
+#
+# Launching a campaign again with the same grid re-expands it from the
+# start, skipping finished jobs and those already queued or running.
+#
+# The daemon reads the campaigns every pass, so list_campaigns keeps them
+# (per library) and only reads a campaign's spec and cases again when its
+# spec.yml changes, and progress is only recounted when the cursor or a
+# bitmap changes. Fully expanded campaigns are passed over without reading
+# their bitmaps.
+
+import os
+import time
+import shutil
+import logging
+
+from CTBB_Pipeline import pypeline as pype
+from CTBB_Pipeline.pypeline import mutex
+
+default_window=1000
+
+def campaigns_dir(library):
+    return os.path.join(library.path,'.proc','campaigns')
+
+def campaign_name(name):
+    # Names are queue item option values and directory names
+    return str(name).replace(',','_').replace('=','_').replace(os.sep,'_')
+
+def popcount(data):
+    # Pure Python: jobs, the daemon and launches import this module and
+    # should not pay for numpy at start
+    return bin(int.from_bytes(bytes(data),'little')).count('1')
+
+class campaign:
+    ### One campaign's grid and bitmaps
+    library=None
+    name=None
+    path=None
+    cases=None
+    doses=None
+    slice_thicknesses=None
+    kernels=None
+    priority=None
+    created=None
+    case_index=None # raw filepath -> case number
+    spec_mtime=None
+    progress_key=None # state files' (mtime, size) the cached progress is of
+    progress_cache=None
+
+    def __init__(self,library,name):
+        import yaml
+        self.library=library
+        self.name=name
+        self.path=os.path.join(campaigns_dir(library),name)
+        self.spec_mtime=os.path.getmtime(os.path.join(self.path,'spec.yml'))
+        with open(os.path.join(self.path,'spec.yml'),'r') as f:
+            spec=yaml.safe_load(f)
+        with open(os.path.join(self.path,'cases'),'r') as f:
+            self.cases=[c for c in f.read().splitlines() if c]
+        self.doses=[str(d) for d in spec['doses']]
+        self.slice_thicknesses=[str(s) for s in spec['slice_thicknesses']]
+        self.kernels=[str(k) for k in spec['kernels']]
+        self.priority=int(spec.get('priority',0))
+        self.created=float(spec.get('created',0))
+        self.case_index={c:i for i,c in enumerate(self.cases)}
+
+    def spec(self):
+        return {'doses':self.doses,'slice_thicknesses':self.slice_thicknesses,'kernels':self.kernels,
+                'priority':self.priority,'created':self.created}
+
+    def size(self):
+        return len(self.cases)*len(self.doses)*len(self.slice_thicknesses)*len(self.kernels)
+
+    def job(self,i):
+        ### (filepath, dose, kernel, slice thickness) of grid index i
+        i,k=divmod(i,len(self.kernels))
+        i,s=divmod(i,len(self.slice_thicknesses))
+        c,d=divmod(i,len(self.doses))
+        return (self.cases[c],self.doses[d],self.kernels[k],self.slice_thicknesses[s])
+
+    def index(self,filepath,dose,kernel,slice_thickness):
+        ### Grid index of a job, or None if it is not in the campaign
+        def find(values,v):
+            # Values as written in the launch configuration (1 and 1.0 match)
+            for i,x in enumerate(values):
+                try:
+                    if float(x)==float(v):
+                        return i
+                except ValueError:
+                    if x==str(v):
+                        return i
+            return None
+        c=self.case_index.get(filepath)
+        d=find(self.doses,dose)
+        s=find(self.slice_thicknesses,slice_thickness)
+        k=find(self.kernels,kernel)
+        if None in [c,d,s,k]:
+            return None
+        return ((c*len(self.doses)+d)*len(self.slice_thicknesses)+s)*len(self.kernels)+k
+
+    def queue_item(self,i):
+        filepath,dose,kernel,st=self.job(i)
+        qi='%s,%s,%s,%s,campaign=%s,index=%d' % (filepath,dose,kernel,st,self.name,i)
+        if self.priority!=0:
+            qi+=',priority=%d' % self.priority
+        return qi
+
+    # State files
+
+    def mutex(self):
+        return mutex('campaign_%s' % self.name,self.library.mutex_dir)
+
+    def get_cursor(self):
+        with open(os.path.join(self.path,'cursor'),'r') as f:
+            return int(f.read().strip() or 0)
+
+    def set_cursor(self,cursor):
+        tmp=os.path.join(self.path,'cursor.%d.tmp' % os.getpid())
+        with open(tmp,'w') as f:
+            f.write('%d\n' % cursor)
+        os.rename(tmp,os.path.join(self.path,'cursor'))
+
+    def read_bitmap(self,which):
+        with open(os.path.join(self.path,which),'rb') as f:
+            return bytearray(f.read())
+
+    def set_bits(self,which,indices):
+        ### Set bits of a bitmap (under the campaign's mutex: several hosts'
+        ### jobs finish at once)
+        indices=list(indices)
+        if not indices:
+            return
+        with self.mutex():
+            with open(os.path.join(self.path,which),'r+b') as f:
+                if len(indices)==1:
+                    i=indices[0]
+                    f.seek(i//8)
+                    b=f.read(1)[0]
+                    f.seek(i//8)
+                    f.write(bytes([b|(1<<(i%8))]))
+                else:
+                    bitmap=bytearray(f.read())
+                    for i in indices:
+                        bitmap[i//8]|=1<<(i%8)
+                    f.seek(0)
+                    f.write(bitmap)
+
+    def clear_bitmap(self,which):
+        with self.mutex():
+            with open(os.path.join(self.path,which),'r+b') as f:
+                f.write(bytes((self.size()+7)//8))
+
+    def progress(self):
+        key=[]
+        for which in ['cursor','done','cancelled']:
+            st=os.stat(os.path.join(self.path,which))
+            key.append((st.st_mtime,st.st_size))
+        if key!=self.progress_key:
+            done=self.read_bitmap('done')
+            cancelled=self.read_bitmap('cancelled')
+            cursor=self.get_cursor()
+            self.progress_cache={'total':self.size(),
+                                 'done':popcount(done),
+                                 'cancelled':popcount(cancelled),
+                                 'expanded':cursor,
+                                 'unexpanded':self.unexpanded(cursor,done,cancelled)}
+            # A file changed within the timestamps' resolution may change
+            # again unnoticed: count again next time
+            recent=max([k[0] for k in key])>time.time()-2
+            self.progress_key=None if recent else key
+        return dict(self.progress_cache,priority=self.priority)
+
+    def unexpanded(self,cursor=None,done=None,cancelled=None):
+        ### Jobs still to be expanded into the queue
+        if cursor is None:
+            cursor=self.get_cursor()
+        n=self.size()
+        if cursor>=n:
+            return 0
+        if done is None:
+            done=self.read_bitmap('done')
+        if cancelled is None:
+            cancelled=self.read_bitmap('cancelled')
+        # Bits from cursor on that are neither done nor cancelled
+        skip=int.from_bytes(bytes(done),'little')|int.from_bytes(bytes(cancelled),'little')
+        skip=(skip>>cursor)&((1<<(n-cursor))-1)
+        return n-cursor-bin(skip).count('1')
+
+def is_bit_set(bitmap,i):
+    return (bitmap[i//8]>>(i%8))&1==1
+
+loaded={} # library path -> {name: campaign} as last read by list_campaigns
+
+def list_campaigns(library):
+    ### Campaigns of a library, in expansion order (priority, then launch).
+    ### Campaigns whose spec.yml has not changed since the last call are not
+    ### read again.
+    if not os.path.isdir(campaigns_dir(library)):
+        return []
+    previous=loaded.get(library.path,{})
+    current={}
+    for name in os.listdir(campaigns_dir(library)):
+        try:
+            mtime=os.path.getmtime(os.path.join(campaigns_dir(library),name,'spec.yml'))
+        except OSError:
+            continue
+        c=previous.get(name)
+        if c is None or c.spec_mtime!=mtime:
+            try:
+                c=campaign(library,name)
+            except (OSError,ValueError,KeyError) as e:
+                logging.warning('Could not read campaign %s: %s' % (name,e))
+                continue
+        current[name]=c
+    loaded[library.path]=current
+    return sorted(current.values(),key=lambda c: (-c.priority,c.created,c.name))
+
+def get_campaign(library,name):
+    ### A library's campaign, or None
+    if not os.path.exists(os.path.join(campaigns_dir(library),name,'spec.yml')):
+        return None
+    return campaign(library,name)
+
+def create(library,name,cases,doses,slice_thicknesses,kernels,priority=0):
+    ### Record a new campaign (launch). A campaign of the same name and grid
+    ### is restarted instead: its unfinished jobs are expanded again. Returns
+    ### the campaign.
+    import yaml
+    name=campaign_name(name)
+    cases=[c for c in cases if c]
+    spec={'doses':[str(d) for d in doses],
+          'slice_thicknesses':[str(s) for s in slice_thicknesses],
+          'kernels':[str(k) for k in kernels],
+          'priority':int(priority),
+          'created':time.time()}
+
+    os.makedirs(campaigns_dir(library),exist_ok=True)
+    existing=get_campaign(library,name)
+    if existing is not None:
+        same=existing.cases==cases and all([existing.spec()[k]==spec[k] for k in ['doses','slice_thicknesses','kernels']])
+        if same:
+            logging.info('Restarting campaign %s' % name)
+            with existing.mutex():
+                existing.set_cursor(0)
+            existing.clear_bitmap('cancelled')
+            if existing.priority!=spec['priority']:
+                set_campaign_priority(library,name,spec['priority'])
+                existing.priority=spec['priority']
+            return existing
+        # A different grid under the same name gets a name of its own
+        n=2
+        while os.path.exists(os.path.join(campaigns_dir(library),'%s_%d' % (name,n))):
+            n+=1
+        name='%s_%d' % (name,n)
+
+    n_jobs=len(cases)*len(doses)*len(slice_thicknesses)*len(kernels)
+    tmp_path=os.path.join(campaigns_dir(library),'.%s.%d.tmp' % (name,os.getpid()))
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path,'spec.yml'),'w') as f:
+        yaml.safe_dump(spec,f,default_flow_style=False)
+    with open(os.path.join(tmp_path,'cases'),'w') as f:
+        for c in cases:
+            f.write('%s\n' % c)
+    with open(os.path.join(tmp_path,'cursor'),'w') as f:
+        f.write('0\n')
+    for which in ['done','cancelled']:
+        with open(os.path.join(tmp_path,which),'wb') as f:
+            f.write(bytes((n_jobs+7)//8))
+    os.rename(tmp_path,os.path.join(campaigns_dir(library),name))
+    logging.info('Campaign %s: %d cases, %d jobs' % (name,len(cases),n_jobs))
+    return campaign(library,name)
+
+def set_campaign_priority(library,name,priority):
+    ### Priority of the jobs a campaign has yet to expand
+    import yaml
+    c=campaign(library,name)
+    spec=c.spec()
+    spec['priority']=int(priority)
+    tmp=os.path.join(c.path,'spec.yml.%d.tmp' % os.getpid())
+    with open(tmp,'w') as f:
+        yaml.safe_dump(spec,f,default_flow_style=False)
+    os.rename(tmp,os.path.join(c.path,'spec.yml'))
+
+def remove(library,name):
+    shutil.rmtree(os.path.join(campaigns_dir(library),name))
+
+def job_index(library,qi):
+    ### (campaign, grid index) of a queue item, or (None, None)
+    item=pype.parse_queue_item(qi)
+    name=item['options'].get('campaign')
+    if name is None:
+        return None,None
+    c=get_campaign(library,name)
+    if c is None:
+        return None,None
+    i=item['options'].get('index')
+    if i is None:
+        # Queued before campaigns were expanded lazily
+        i=c.index(item['filepath'],item['dose'],item['kernel'],item['slice_thickness'])
+        if i is None:
+            return None,None
+    return c,int(i)
+
+def mark_done(library,qi):
+    ### Record the success of a campaign's job
+    c,i=job_index(library,qi)
+    if c is not None and i<c.size():
+        c.set_bits('done',[i])
+
+def expand(library,queue,active,window,campaigns=None):
+    ### Queue items to append to queue (whose jobs are not already in queue
+    ### or active) so that it holds up to window items of each campaign's
+    ### priority or more: a high priority campaign is expanded however many
+    ### lower priority jobs are queued. The queue mutex must be held.
+    ###
+    ### campaigns: list_campaigns(library), if already at hand.
+    ###
+    ### Returns (new items, cursors). The campaigns' cursors are not moved:
+    ### pass cursors to advance once the queue with the new items has been
+    ### written, so that a crash in between loses no job (those already
+    ### queued are skipped when they are expanded again).
+    from CTBB_Pipeline.ctbb_pipeline_control import job_priority
+
+    present=set()
+    levels=[]
+    for qi in list(queue)+list(active):
+        options=pype.parse_queue_item(qi)['options']
+        if 'campaign' in options and 'index' in options:
+            present.add((options['campaign'],int(options['index'])))
+    for qi in queue:
+        levels.append(job_priority(qi))
+
+    new_items=[]
+    cursors=[]
+    for c in (list_campaigns(library) if campaigns is None else campaigns):
+        cursor=c.get_cursor()
+        n=c.size()
+        if cursor>=n:
+            continue
+        n_wanted=window-len([p for p in levels if p>=c.priority])
+        if n_wanted<=0:
+            continue
+        done=c.read_bitmap('done')
+        cancelled=c.read_bitmap('cancelled')
+        n_new=0
+        start=cursor
+        while cursor<n and n_new<n_wanted:
+            if not (is_bit_set(done,cursor) or is_bit_set(cancelled,cursor) or (c.name,cursor) in present):
+                new_items.append(c.queue_item(cursor))
+                levels.append(c.priority)
+                n_new+=1
+            cursor+=1
+        if cursor!=start:
+            cursors.append((c,cursor))
+    return new_items,cursors
+
+def advance(cursors):
+    ### Move the cursors returned by expand
+    for c,cursor in cursors:
+        c.set_cursor(cursor)
+        if cursor>=c.size():
+            logging.info('Campaign %s fully expanded' % c.name)
+
+def progress(library,campaigns=None):
+    ### {campaign: progress} (see campaign.progress)
+    return {c.name:c.progress() for c in (list_campaigns(library) if campaigns is None else campaigns)}
+
+def unexpanded_jobs(library,campaigns=None):
+    ### (queue item of the next job, jobs left to expand) of each campaign
+    ### with jobs left, for predictions (e.g. the queue ETA)
+    result=[]
+    for c in (list_campaigns(library) if campaigns is None else campaigns):
+        cursor=c.get_cursor()
+        n_left=c.unexpanded(cursor)
+        if n_left>0:
+            result.append((c.queue_item(min(cursor,c.size()-1)),n_left))
+    return result
+
+def cancel(library,keys,name=None):
+    ### Cancel the jobs of campaigns (one, or all) that are yet to be
+    ### expanded and match keys (see ctbb_pipeline_control.matches; none:
+    ### every job of the campaign). The queue mutex must be held. Returns the
+    ### number cancelled.
+    from CTBB_Pipeline.ctbb_pipeline_control import matches
+    n=0
+    for c in list_campaigns(library):
+        if name is not None and c.name!=name:
+            continue
+        if name is None and not keys:
+            continue
+        every=not keys or 'all' in keys
+        cursor=c.get_cursor()
+        done=c.read_bitmap('done')
+        cancelled=c.read_bitmap('cancelled')
+        indices=[]
+        for i in range(cursor,c.size()):
+            if is_bit_set(done,i) or is_bit_set(cancelled,i):
+                continue
+            if every or matches(c.queue_item(i),keys,name):
+                indices.append(i)
+        c.set_bits('cancelled',indices)
+        n+=len(indices)
+        logging.info('Cancelled %d unexpanded jobs of campaign %s' % (len(indices),c.name))
+    return n
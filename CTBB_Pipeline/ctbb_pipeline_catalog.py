@@ -0,0 +1,193 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_catalog.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Library-wide catalog of series metadata (library/catalog.npy).
+#
+# One row per reconstructed series holding the numeric header fields of its
+# PRM file, stored as a NumPy structured array so that queries such as
+#
+#     catalog.select(dose=25,ConvolutionKernel=3,SliceThickness=0.6,Width=512)
+#
+# are a handful of vectorized comparisons instead of parsing thousands of
+# PRMs. refresh() only re-parses PRMs whose mtime (or image size) changed.
+
+import os
+import logging
+
+import numpy as np
+
+from CTBB_Pipeline.pypeline import read_prm,series_header
+from CTBB_Pipeline.ctbb_pipeline_compress import series_filepath
+from CTBB_Pipeline.ctbb_pipeline_layout import recon_glob
+
+numeric_fields=[('Width','i4'),
+                ('Height','i4'),
+                ('NoOfSlices','i4'),
+                ('StartPos','f8'),
+                ('EndPos','f8'),
+                ('DataCollectionDiameter','f8'),
+                ('ReconstructionDiameter','f8'),
+                ('ConvolutionKernel','i4'),
+                ('SliceThickness','f8'),
+                ('SpiralPitchFactor','f8'),
+                ('TableFeedPerRotation','f8'),
+                ('SingleCollimationWidth','f8'),
+                ('TotalCollimationWidth','f8')]
+
+# Identification and change tracking
+key_fields=[('dose','i4'),
+            ('prm_mtime','f8'),
+            ('img_size','i8')]
+
+string_fields=['pipeline_id','prm_filepath','img_filepath']
+
+def catalog_path(library_path):
+    return os.path.join(library_path,'catalog.npy')
+
+def catalog_dtype(string_width=1):
+    return np.dtype([(f,'S%d' % string_width) for f in string_fields]+key_fields+numeric_fields)
+
+def make_row(prm_filepath,prm_mtime):
+    ### Catalog entry (a dictionary) for one series
+    img_filepath=series_filepath(os.path.splitext(prm_filepath)[0]+'.img') # .img or .imgz
+    img_size=os.path.getsize(img_filepath) if os.path.exists(img_filepath) else -1
+    header=series_header.from_prm(read_prm(prm_filepath),img_filepath)
+
+    # Filenames are <pipeline_id>_d<dose>_k<kernel>_st<slice thickness>.prm
+    parts=os.path.basename(os.path.splitext(prm_filepath)[0]).split('_')
+    row={'pipeline_id':parts[0],
+         'prm_filepath':prm_filepath,
+         'img_filepath':img_filepath,
+         'dose':int(parts[1].strip('d')),
+         'prm_mtime':prm_mtime,
+         'img_size':img_size}
+    for f,t in numeric_fields:
+        v=getattr(header,f)
+        row[f]=-1 if v is None else v
+    return row
+
+class series_catalog:
+    library_path=None
+    path=None
+    table=None
+
+    def __init__(self,library_path):
+        self.library_path=library_path
+        self.path=catalog_path(library_path)
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            self.table=np.load(self.path,allow_pickle=False)
+        else:
+            self.table=np.zeros(0,dtype=catalog_dtype())
+
+    def save(self):
+        tmp='%s.%d.tmp.npy' % (self.path,os.getpid())
+        np.save(tmp,self.table,allow_pickle=False)
+        os.rename(tmp,self.path)
+
+    def __len__(self):
+        return len(self.table)
+
+    def refresh(self):
+        ### Bring the catalog up to date with the PRM files in the library.
+        ### Returns (n_parsed, n_removed).
+        prm_filepaths=recon_glob(self.library_path,'img','*.prm')
+
+        existing={}
+        for i,p in enumerate(self.table['prm_filepath']):
+            existing[p.decode('utf-8')]=i
+
+        rows=[]
+        n_parsed=0
+        for p in prm_filepaths:
+            try:
+                mtime=os.path.getmtime(p)
+            except OSError:
+                continue
+            i=existing.get(p)
+            if i is not None:
+                old=self.table[i]
+                img_filepath=old['img_filepath'].decode('utf-8')
+                img_size=os.path.getsize(img_filepath) if os.path.exists(img_filepath) else -1
+                if old['prm_mtime']==mtime and old['img_size']==img_size:
+                    rows.append(old)
+                    continue
+            try:
+                rows.append(make_row(p,mtime))
+                n_parsed+=1
+            except (OSError,KeyError,ValueError,IndexError,ZeroDivisionError) as e:
+                logging.warning('Could not catalog %s: %s' % (p,e))
+
+        n_removed=len(set(existing)-set(prm_filepaths))
+        if n_parsed==0 and n_removed==0:
+            return 0,0
+
+        self.table=self.__build__(rows)
+        self.save()
+        return n_parsed,n_removed
+
+    def __build__(self,rows):
+        width=1
+        for r in rows:
+            for f in string_fields:
+                v=r[f]
+                n=len(v) if isinstance(v,bytes) else len(v.encode('utf-8'))
+                width=max(width,n)
+        table=np.zeros(len(rows),dtype=catalog_dtype(width))
+        for i,r in enumerate(rows):
+            if isinstance(r,np.void):
+                table[i]=tuple(r[f] for f in table.dtype.names)
+            else:
+                table[i]=tuple(r[f].encode('utf-8') if f in string_fields else r[f] for f in table.dtype.names)
+        return table
+
+    def mask(self,**criteria):
+        ### Boolean mask of the rows matching every criterion. A criterion is a
+        ### single value, a list of accepted values, or a (low, high) tuple giving
+        ### an inclusive range.
+        m=np.ones(len(self.table),dtype=bool)
+        for field,value in criteria.items():
+            if field not in self.table.dtype.names:
+                raise KeyError('Unknown catalog field %s' % field)
+            column=self.table[field]
+            if field in string_fields:
+                if isinstance(value,(list,tuple)):
+                    value=[v.encode('utf-8') for v in value]
+                else:
+                    value=value.encode('utf-8')
+            if isinstance(value,tuple):
+                m&=(column>=value[0])&(column<=value[1])
+            elif isinstance(value,list):
+                if column.dtype.kind=='f':
+                    m&=np.isclose(column[:,None],np.array(value,dtype='f8')[None,:]).any(axis=1)
+                else:
+                    m&=np.isin(column,value)
+            elif column.dtype.kind=='f':
+                m&=np.isclose(column,value)
+            else:
+                m&=(column==value)
+        return m
+
+    def select(self,**criteria):
+        return self.table[self.mask(**criteria)]
+
+    def img_filepaths(self,**criteria):
+        return [p.decode('utf-8') for p in self.select(**criteria)['img_filepath']]
@@ -0,0 +1,336 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_compare.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Cross-series comparison of one case across the dose x kernel x slice
+# thickness grid.
+#
+# For each case, series that differ only in the varied parameter (dose by
+# default) are compared with the reference value of that parameter (full
+# dose by default). Slices are matched by z position (nearest slice, so
+# comparisons across slice thickness are slice-to-nearest-slice) and the pair
+# is streamed through in z-slabs, computing
+#
+#     bias, rmse, mae  - of the difference image (test - reference, HU)
+#     noise_ref/test   - standard deviation in each ROI, averaged over slices
+#     noise_diff       - standard deviation of the difference in each ROI / sqrt(2)
+#     ssim             - mean structural similarity (7x7 box window) over [-1000, 1000] HU
+#
+# Pairs from many cases are processed in parallel on a process pool and the
+# results written to library/eval/comparisons.csv as a long ("tidy") table:
+# one row per pair, metric and ROI.
+
+import os
+import csv
+import logging
+
+import numpy as np
+
+from CTBB_Pipeline.pypeline import pipeline_img_series,mutex,map_series
+from CTBB_Pipeline.ctbb_pipeline_catalog import series_catalog
+
+default_slab_size=16
+default_rois=[(0.5,0.5,0.05)] # (x, y, radius) as fractions of the image width/height
+ssim_window=7
+ssim_range=(-1000.0,1000.0)
+
+# Catalog field of each parameter that can be varied
+parameter_fields={'dose':'dose','kernel':'ConvolutionKernel','slice_thickness':'SliceThickness'}
+default_references={'dose':100,'kernel':None,'slice_thickness':None}
+
+table_columns=['pipeline_id','dose','kernel','slice_thickness',
+               'ref_dose','ref_kernel','ref_slice_thickness',
+               'metric','roi','value','n_slices',
+               'img_series_filepath','ref_img_series_filepath']
+
+def slice_positions(header):
+    n=header.NoOfSlices
+    if n<2:
+        return np.array([float(header.StartPos)]*n)
+    return np.linspace(float(header.StartPos),float(header.EndPos),n)
+
+def match_slices(test_header,ref_header):
+    ### (test indices, reference indices) of slices at the same z position,
+    ### to within half a test slice spacing
+    z_test=slice_positions(test_header)
+    z_ref=slice_positions(ref_header)
+    if len(z_test)==0 or len(z_ref)==0:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+    order=np.argsort(z_ref)
+    pos=np.clip(np.searchsorted(z_ref[order],z_test),1,max(1,len(z_ref)-1))
+    left=order[pos-1]
+    right=order[np.minimum(pos,len(z_ref)-1)]
+    nearest=np.where(np.abs(z_ref[left]-z_test)<=np.abs(z_ref[right]-z_test),left,right)
+    spacing=abs(z_test[1]-z_test[0]) if len(z_test)>1 else float(test_header.SliceThickness)
+    keep=np.abs(z_ref[nearest]-z_test)<=0.5*spacing+1e-6
+    return np.flatnonzero(keep),nearest[keep]
+
+def roi_masks(rois,width,height):
+    ### Boolean (n_rois, height, width) masks of circular ROIs
+    y,x=np.mgrid[0:height,0:width]
+    masks=np.zeros((len(rois),height,width),dtype=bool)
+    for i,(cx,cy,r) in enumerate(rois):
+        masks[i]=(x-cx*width)**2+(y-cy*height)**2<=(r*width)**2
+    return masks
+
+def box_sums(a,w):
+    ### Sums over every w x w window of each slice of a (valid region only)
+    c=np.zeros((a.shape[0],a.shape[1]+1,a.shape[2]+1),dtype=np.float64)
+    c[:,1:,1:]=a.cumsum(axis=1,dtype=np.float64).cumsum(axis=2)
+    return c[:,w:,w:]-c[:,:-w,w:]-c[:,w:,:-w]+c[:,:-w,:-w]
+
+def ssim_slices(x,y,window=ssim_window,value_range=ssim_range):
+    ### Mean SSIM of each slice of x against the same slice of y
+    L=value_range[1]-value_range[0]
+    C1=(0.01*L)**2
+    C2=(0.03*L)**2
+    x=np.clip(x,*value_range).astype(np.float64)
+    y=np.clip(y,*value_range).astype(np.float64)
+    n=float(window*window)
+    mu_x=box_sums(x,window)/n
+    mu_y=box_sums(y,window)/n
+    var_x=box_sums(x*x,window)/n-mu_x**2
+    var_y=box_sums(y*y,window)/n-mu_y**2
+    cov=box_sums(x*y,window)/n-mu_x*mu_y
+    s=((2*mu_x*mu_y+C1)*(2*cov+C2))/((mu_x**2+mu_y**2+C1)*(var_x+var_y+C2))
+    return s.mean(axis=(1,2))
+
+def __read_rows__(series,indices):
+    # HU slices at (sorted or unsorted) indices, reading one contiguous slab
+    lo=int(indices.min())
+    hi=int(indices.max())+1
+    return series.read_slab(lo,hi)[indices-lo]
+
+def compare_pair(test_filepath,ref_filepath,rois=default_rois,slab_size=default_slab_size,diff_filepath=None):
+    ### Stream a test series and its reference through matched z-slabs.
+    ### Returns {metric: value} with per-ROI metrics as lists, or None if no
+    ### slices match. With diff_filepath, the difference stack (test -
+    ### reference, float32 HU, matched slices only) is written there.
+    test=pipeline_img_series(test_filepath,os.path.splitext(test_filepath)[0]+'.prm')
+    ref=pipeline_img_series(ref_filepath,os.path.splitext(ref_filepath)[0]+'.prm')
+    if (test.header.Width,test.header.Height)!=(ref.header.Width,ref.header.Height):
+        raise ValueError('Image sizes differ: %s, %s' % (test_filepath,ref_filepath))
+
+    test_idx,ref_idx=match_slices(test.header,ref.header)
+    n=len(test_idx)
+    if n==0:
+        return None
+
+    masks=roi_masks(rois,test.header.Width,test.header.Height)
+    n_rois=len(rois)
+
+    diff_sum=0.0
+    diff_sum_sq=0.0
+    diff_abs=0.0
+    n_voxels=0
+    noise_ref=np.zeros(n_rois)
+    noise_test=np.zeros(n_rois)
+    noise_diff=np.zeros(n_rois)
+    ssim_sum=0.0
+
+    f_diff=open(diff_filepath,'wb') if diff_filepath else None
+    try:
+        for start in range(0,n,slab_size):
+            t_idx=test_idx[start:start+slab_size]
+            r_idx=ref_idx[start:start+slab_size]
+            t=__read_rows__(test,t_idx)
+            r=__read_rows__(ref,r_idx)
+            d=t-r
+
+            diff_sum+=float(d.sum(dtype=np.float64))
+            diff_sum_sq+=float(np.square(d,dtype=np.float64).sum())
+            diff_abs+=float(np.abs(d).sum(dtype=np.float64))
+            n_voxels+=d.size
+
+            # ROI noise: per-slice std within each ROI, summed over slices
+            for i in range(n_rois):
+                noise_ref[i]+=r[:,masks[i]].std(axis=1).sum()
+                noise_test[i]+=t[:,masks[i]].std(axis=1).sum()
+                noise_diff[i]+=d[:,masks[i]].std(axis=1).sum()/np.sqrt(2.0)
+
+            ssim_sum+=float(ssim_slices(t,r).sum())
+
+            if f_diff is not None:
+                # On-disk orientation, like the IMG files themselves
+                np.ascontiguousarray(np.transpose(d,(0,2,1)),dtype=np.float32).tofile(f_diff)
+    finally:
+        if f_diff is not None:
+            f_diff.close()
+
+    bias=diff_sum/n_voxels
+    return {'n_slices':n,
+            'bias':bias,
+            'rmse':float(np.sqrt(diff_sum_sq/n_voxels)),
+            'mae':diff_abs/n_voxels,
+            'ssim':ssim_sum/n,
+            'noise_ref':list(noise_ref/n),
+            'noise_test':list(noise_test/n),
+            'noise_diff':list(noise_diff/n)}
+
+def case_pairs(catalog,case_id,vary='dose',reference=None):
+    ### (test, reference) catalog rows for one case: series differing from a
+    ### reference series in the varied parameter only
+    if vary not in parameter_fields:
+        raise ValueError('Cannot vary %s (choose from %s)' % (vary,', '.join(parameter_fields)))
+    if reference is None:
+        reference=default_references[vary]
+
+    rows=catalog.select(pipeline_id=case_id)
+    field=parameter_fields[vary]
+    others=[parameter_fields[p] for p in parameter_fields if p!=vary]
+
+    groups={}
+    for r in rows:
+        groups.setdefault(tuple(float(r[f]) for f in others),[]).append(r)
+
+    pairs=[]
+    for key,group in groups.items():
+        values=sorted(set(float(r[field]) for r in group))
+        # Kernels and slice thicknesses have no natural reference; without
+        # one given, the largest value in the group is used
+        ref_value=float(reference) if reference is not None else values[-1]
+        refs=[r for r in group if np.isclose(float(r[field]),ref_value)]
+        if not refs:
+            continue
+        for r in group:
+            if not np.isclose(float(r[field]),ref_value):
+                pairs.append((r,refs[0]))
+    return pairs
+
+def __row_params__(r):
+    return {'dose':int(r['dose']),'kernel':int(r['ConvolutionKernel']),'slice_thickness':float(r['SliceThickness'])}
+
+def compare_paths(paths,write_diff=False,**kwargs):
+    ### compare_pair of a (test filepath, reference filepath) pair, with the
+    ### difference stack (if write_diff) at its diff_path
+    test_filepath,ref_filepath=paths
+    diff_filepath=diff_path(test_filepath,ref_filepath) if write_diff else None
+    return compare_pair(test_filepath,ref_filepath,diff_filepath=diff_filepath,**kwargs)
+
+def diff_path(test_filepath,ref_filepath):
+    # Difference stacks go to the test study's eval/ directory
+    study_dirpath=os.path.dirname(os.path.dirname(os.path.abspath(test_filepath)))
+    name='%s_minus_%s.img' % (os.path.splitext(os.path.basename(test_filepath))[0],
+                              os.path.splitext(os.path.basename(ref_filepath))[0])
+    return os.path.join(study_dirpath,'eval',name)
+
+def table_path(library_path):
+    return os.path.join(library_path,'eval','comparisons.csv')
+
+def compare_cases(library_path,case_ids=None,vary='dose',reference=None,rois=default_rois,
+                  slab_size=default_slab_size,write_diff=False,n_processes=None):
+    ### Compare the series of each case (all cases by default) on a process
+    ### pool and update library/eval/comparisons.csv. Returns the new rows.
+    catalog=series_catalog(library_path)
+    catalog.refresh()
+    if case_ids is None:
+        case_ids=sorted(set(p.decode('utf-8') for p in catalog.table['pipeline_id']))
+
+    pairs=[]
+    for case_id in case_ids:
+        pairs+=case_pairs(catalog,case_id,vary,reference)
+    logging.info('Comparing %d series pairs from %d cases' % (len(pairs),len(case_ids)))
+
+    params={}
+    for test,ref in pairs:
+        t=test['img_filepath'].decode('utf-8')
+        r=ref['img_filepath'].decode('utf-8')
+        params[(t,r)]=(test['pipeline_id'].decode('utf-8'),__row_params__(test),__row_params__(ref))
+        if write_diff and not os.path.isdir(os.path.dirname(diff_path(t,r))):
+            os.makedirs(os.path.dirname(diff_path(t,r)))
+
+    rows=[]
+    if params:
+        for (t,r),result in map_series(compare_paths,list(params),n_processes,
+                                       rois=rois,slab_size=slab_size,write_diff=write_diff):
+            if result is None:
+                continue
+            case_id,p_test,p_ref=params[(t,r)]
+            rows+=result_rows(case_id,p_test,p_ref,t,r,result)
+
+    write_table(library_path,rows)
+    return rows
+
+def result_rows(case_id,p_test,p_ref,test_filepath,ref_filepath,result):
+    ### Table rows of one compare_pair result
+    base={'pipeline_id':case_id,
+          'dose':p_test['dose'],'kernel':p_test['kernel'],'slice_thickness':p_test['slice_thickness'],
+          'ref_dose':p_ref['dose'],'ref_kernel':p_ref['kernel'],'ref_slice_thickness':p_ref['slice_thickness'],
+          'n_slices':result['n_slices'],'img_series_filepath':test_filepath,'ref_img_series_filepath':ref_filepath}
+    rows=[]
+    for metric in ['bias','rmse','mae','ssim']:
+        rows.append(dict(base,metric=metric,roi='',value=result[metric]))
+    for metric in ['noise_ref','noise_test','noise_diff']:
+        for i,v in enumerate(result[metric]):
+            rows.append(dict(base,metric=metric,roi=i,value=v))
+    return rows
+
+def name_params(img_filepath):
+    ### (case id, parameters) from a series' name, <id>_d<dose>_k<kernel>_st<st>
+    fields=os.path.splitext(os.path.basename(img_filepath))[0].split('_')
+    return fields[0],{'dose':int(fields[1].strip('d')),'kernel':int(fields[2].strip('k')),'slice_thickness':float(fields[3].strip('st'))}
+
+def compare_series(library_path,test_filepath,ref_filepath,rois=default_rois,slab_size=default_slab_size,write_diff=False):
+    ### Compare one series with its reference (e.g. as a stage of the job
+    ### that reconstructed it, see ctbb_pipeline_dag) and merge the result
+    ### into library/eval/comparisons.csv. Returns the new rows.
+    diff_filepath=None
+    if write_diff:
+        diff_filepath=diff_path(test_filepath,ref_filepath)
+        os.makedirs(os.path.dirname(diff_filepath),exist_ok=True)
+    result=compare_pair(test_filepath,ref_filepath,rois,slab_size,diff_filepath)
+    if result is None:
+        logging.warning('No slices of %s match %s' % (test_filepath,ref_filepath))
+        return []
+    case_id,p_test=name_params(test_filepath)
+    p_ref=name_params(ref_filepath)[1]
+    rows=result_rows(case_id,p_test,p_ref,test_filepath,ref_filepath,result)
+    write_table(library_path,rows)
+    return rows
+
+def write_table(library_path,rows):
+    ### Merge rows into the library's comparison table, replacing earlier rows
+    ### for the same series pairs. Writers of the same library (e.g.
+    ### comparison stages running in parallel) take turns.
+    mutex_dir=os.path.join(library_path,'.proc','mutex')
+    if os.path.isdir(mutex_dir):
+        with mutex('comparisons',mutex_dir):
+            __write_table__(library_path,rows)
+    else:
+        __write_table__(library_path,rows)
+
+def __write_table__(library_path,rows):
+    filepath=table_path(library_path)
+    replaced=set((r['img_series_filepath'],r['ref_img_series_filepath']) for r in rows)
+
+    existing=[]
+    if os.path.exists(filepath):
+        with open(filepath,'r',newline='') as f:
+            for r in csv.DictReader(f):
+                if (r['img_series_filepath'],r['ref_img_series_filepath']) not in replaced:
+                    existing.append(r)
+
+    if not os.path.isdir(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+    tmp='%s.%d.tmp' % (filepath,os.getpid())
+    with open(tmp,'w',newline='') as f:
+        w=csv.DictWriter(f,table_columns,lineterminator=os.linesep)
+        w.writeheader()
+        for r in existing+sorted(rows,key=lambda r: (r['pipeline_id'],r['img_series_filepath'],r['metric'],str(r['roi']))):
+            w.writerow(r)
+    os.rename(tmp,filepath)
@@ -0,0 +1,299 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_compress.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Compressed storage of reconstructed series (.imgz).
+#
+# ctbb_recon writes a series as raw float32 attenuation (.img). A converted
+# series is quantized to int16 HU and stored as independently compressed
+# chunks of chunk_slices slices, followed by the byte offset of every chunk,
+# so that a range of slices is read by decompressing only the chunks that
+# cover it:
+#
+#     header  magic "CTBBIMGZ", version, filter, Width, Height, NoOfSlices,
+#             chunk_slices, HU per stored unit (scale), offset of the index
+#     chunks  zlib(int16 slices in the on-disk orientation of the .img)
+#     index   n_chunks+1 little-endian uint64 offsets (the last: end of data)
+#
+# With the 'shuffle' filter each chunk stores the low bytes of its values
+# followed by the high bytes, which are nearly constant and compress well.
+#
+# pipeline_img_series reads either format and accepts either path for a
+# series (see series_filepath), so readers need not know which one a series
+# is stored in; the .img is preferred while both exist. Quantization to 1 HU
+# is lossy: the original .img is removed after conversion unless it is kept.
+# Series can be converted after each reconstruction ('compress_recons' in the
+# library's settings.yml) or for a whole library with ctbb_pipeline_compress.
+
+import os
+import time
+import zlib
+import random
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+extension='.imgz'
+magic=b'CTBBIMGZ'
+version=1
+header_format='<8sHHIIIIdQ'
+header_size=struct.calcsize(header_format)
+filters={'none':0,'shuffle':1}
+
+default_chunk_slices=2 # a 512x512 chunk decompresses in a few ms; the ratio hardly depends on it
+default_scale=1.0   # HU per stored unit
+default_level=6     # zlib compression level
+default_cache_chunks=4
+
+def is_compressed(filepath):
+    return filepath.endswith(extension)
+
+def series_filepath(filepath):
+    ### Existing image file of a series given its .img or .imgz path: filepath
+    ### itself if it exists, otherwise the series in the other format.
+    ### Returns filepath unchanged if neither exists.
+    if os.path.exists(filepath):
+        return filepath
+    base=os.path.splitext(filepath)[0]
+    for candidate in [base+'.img',base+extension]:
+        if os.path.exists(candidate):
+            return candidate
+    return filepath
+
+def read_header(filepath):
+    with open(filepath,'rb') as f:
+        data=f.read(header_size)
+    if len(data)<header_size:
+        raise ValueError('%s is not a compressed series (too short)' % filepath)
+    fields=struct.unpack(header_format,data)
+    if fields[0]!=magic:
+        raise ValueError('%s is not a compressed series' % filepath)
+    if fields[1]!=version:
+        raise ValueError('%s has unsupported version %d' % (filepath,fields[1]))
+    names=['magic','version','filter','Width','Height','NoOfSlices','chunk_slices','scale','index_offset']
+    return dict(zip(names,fields))
+
+def encode_chunk(values,filter,level):
+    data=values.astype('<i2').tobytes()
+    if filter==filters['shuffle']:
+        data=np.frombuffer(data,'u1').reshape(-1,2).T.tobytes()
+    return zlib.compress(data,level)
+
+def decode_chunk(data,filter,shape):
+    data=zlib.decompress(data)
+    if filter==filters['shuffle']:
+        data=np.frombuffer(data,'u1').reshape(2,-1).T.tobytes()
+    return np.frombuffer(data,'<i2').reshape(shape)
+
+class compressed_series:
+    ### Random access to the slices of an .imgz file. Decoded chunks are kept
+    ### in a small LRU cache so that reading neighbouring slices one at a
+    ### time does not decompress the same chunk repeatedly. Safe to share
+    ### between threads.
+    filepath=None
+    filter=None
+    Width=None
+    Height=None
+    NoOfSlices=None
+    chunk_slices=None
+    scale=None
+    offsets=None
+    cache=None
+    cache_chunks=None
+    lock=None
+
+    def __init__(self,filepath,cache_chunks=default_cache_chunks):
+        self.filepath=filepath
+        header=read_header(filepath)
+        for f in ['filter','Width','Height','NoOfSlices','chunk_slices','scale']:
+            setattr(self,f,header[f])
+        n_chunks=-(-self.NoOfSlices//self.chunk_slices)
+        with open(filepath,'rb') as f:
+            f.seek(header['index_offset'])
+            self.offsets=np.frombuffer(f.read(8*(n_chunks+1)),'<u8').astype('int64')
+        if len(self.offsets)!=n_chunks+1:
+            raise ValueError('%s has a truncated chunk index' % filepath)
+        self.cache=OrderedDict()
+        self.cache_chunks=cache_chunks
+        self.lock=threading.Lock()
+
+    def chunk_shape(self,k):
+        n=min(self.chunk_slices,self.NoOfSlices-k*self.chunk_slices)
+        return (n,self.Width,self.Height)
+
+    def read_chunks(self,first,last):
+        ### Decoded chunks first..last-1. Chunks not in the cache are read from
+        ### the file with one read covering all of them.
+        with self.lock:
+            chunks={k:self.cache[k] for k in range(first,last) if k in self.cache}
+            for k in chunks:
+                self.cache.move_to_end(k)
+        missing=[k for k in range(first,last) if k not in chunks]
+        if missing:
+            lo,hi=missing[0],missing[-1]+1
+            fd=os.open(self.filepath,os.O_RDONLY)
+            try:
+                data=os.pread(fd,int(self.offsets[hi]-self.offsets[lo]),int(self.offsets[lo]))
+            finally:
+                os.close(fd)
+            for k in missing:
+                a=int(self.offsets[k]-self.offsets[lo])
+                b=int(self.offsets[k+1]-self.offsets[lo])
+                chunks[k]=decode_chunk(data[a:b],self.filter,self.chunk_shape(k))
+            with self.lock:
+                for k in missing:
+                    self.cache[k]=chunks[k]
+                while len(self.cache)>self.cache_chunks:
+                    self.cache.popitem(last=False)
+        return [chunks[k] for k in range(first,last)]
+
+    def read_hu(self,start,stop):
+        ### Slices [start,stop) as float32 HU in the on-disk orientation
+        start=max(0,start)
+        stop=min(self.NoOfSlices,stop)
+        if stop<=start:
+            return np.zeros((0,self.Width,self.Height),dtype='float32')
+        first=start//self.chunk_slices
+        last=(stop-1)//self.chunk_slices+1
+        stored=np.concatenate(self.read_chunks(first,last))
+        offset=first*self.chunk_slices
+        hu=stored[start-offset:stop-offset].astype('float32')
+        if self.scale!=1.0:
+            hu*=self.scale
+        return hu
+
+def convert_series(img_filepath,chunk_slices=default_chunk_slices,scale=default_scale,
+                   level=default_level,filter='shuffle',keep=False):
+    ### Write the .imgz of an .img series next to it and, unless keep, remove
+    ### the .img. The .imgz is written under a temporary name and renamed into
+    ### place, and gets the .img's modification time (it holds the same
+    ### series), so a failed conversion never leaves a partial file behind.
+    ### Returns (bytes before, bytes after).
+    from CTBB_Pipeline.pypeline import pipeline_img_series,mu_water
+
+    series=pipeline_img_series(img_filepath,os.path.splitext(img_filepath)[0]+'.prm')
+    h=series.header
+    stack=series.to_memmap()
+    code=filters[filter]
+
+    out_filepath=os.path.splitext(img_filepath)[0]+extension
+    tmp_filepath='%s.tmp.%d' % (out_filepath,os.getpid())
+    try:
+        with open(tmp_filepath,'wb') as f:
+            f.write(b'\0'*header_size)
+            offsets=[header_size]
+            for start in range(0,h.NoOfSlices,chunk_slices):
+                hu=np.array(stack[start:start+chunk_slices],dtype='float32')
+                hu-=mu_water
+                hu*=1000.0/(mu_water*scale)
+                values=np.clip(np.rint(hu),-32768,32767)
+                f.write(encode_chunk(values,code,level))
+                offsets.append(f.tell())
+            index_offset=f.tell()
+            f.write(np.array(offsets,dtype='<u8').tobytes())
+            f.seek(0)
+            f.write(struct.pack(header_format,magic,version,code,h.Width,h.Height,h.NoOfSlices,
+                                chunk_slices,scale,index_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        st=os.stat(img_filepath)
+        os.utime(tmp_filepath,(st.st_atime,st.st_mtime))
+        os.rename(tmp_filepath,out_filepath)
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+    n_before=os.path.getsize(img_filepath)
+    n_after=os.path.getsize(out_filepath)
+    if not keep:
+        os.remove(img_filepath)
+    logging.info('Compressed %s: %d -> %d bytes (%.2fx)' % (img_filepath,n_before,n_after,n_before/max(1,n_after)))
+    return (n_before,n_after)
+
+def compress_library(library,n_processes=None,**kwargs):
+    ### Convert every .img series of a pipeline library on a process pool
+    ### and refresh the recon list. Series are only picked up once they are
+    ### in their study's img/ directory, i.e. after their job has finished.
+    ### Returns {img_filepath: (bytes before, bytes after) or None if it
+    ### failed}.
+    library.refresh_recon_list()
+    todo=[r['img_series_filepath'] for r in library.get_recon_list()
+          if r['img_series_filepath'].endswith('.img') and os.path.exists(r['img_series_filepath'])
+          and os.path.basename(os.path.dirname(r['img_series_filepath']))=='img']
+
+    logging.info('Compressing %d series' % len(todo))
+
+    results={}
+    if todo:
+        from CTBB_Pipeline.pypeline import map_series
+        for img_filepath,sizes in map_series(convert_series,todo,n_processes,**kwargs):
+            results[img_filepath]=sizes
+        # The series moved from .img to .imgz: the recon list and catalog
+        # hold their paths
+        library.refresh_recon_list()
+        from CTBB_Pipeline.ctbb_pipeline_catalog import series_catalog,catalog_path
+        if os.path.exists(catalog_path(library.path)):
+            series_catalog(library.path).refresh()
+    return results
+
+def benchmark(filepaths,n_reads=200,slab_size=1,seed=0):
+    ### Compression ratio and random read latency of compressed series.
+    ### filepaths are .imgz files; where the .img was kept it is read the
+    ### same way for comparison. Each read opens the series afresh, so the
+    ### chunk cache does not hide decompression. Returns a list of one dict
+    ### per series (latencies in seconds, see ctbb_pipeline_bench.percentiles).
+    from CTBB_Pipeline.pypeline import pipeline_img_series
+    from CTBB_Pipeline.ctbb_pipeline_bench import percentiles
+
+    rng=random.Random(seed)
+    results=[]
+    for filepath in filepaths:
+        prm_filepath=os.path.splitext(filepath)[0]+'.prm'
+        compressed=pipeline_img_series(filepath,prm_filepath)
+        h=compressed.header
+        n_raw=4*h.Width*h.Height*h.NoOfSlices
+        starts=[rng.randrange(0,max(1,h.NoOfSlices-slab_size+1)) for i in range(n_reads)]
+
+        result={'filepath':filepath,'slices':h.NoOfSlices,'raw_bytes':n_raw,
+                'compressed_bytes':os.path.getsize(filepath),
+                'ratio':n_raw/max(1,os.path.getsize(filepath))}
+
+        latencies=[]
+        for start in starts:
+            t=time.time()
+            pipeline_img_series(filepath,prm_filepath).read_slab(start,start+slab_size)
+            latencies.append(time.time()-t)
+        result['compressed_read']=percentiles(latencies)
+
+        img_filepath=os.path.splitext(filepath)[0]+'.img'
+        if os.path.exists(img_filepath):
+            latencies=[]
+            errors=[]
+            for start in starts:
+                t=time.time()
+                slab=pipeline_img_series(img_filepath,prm_filepath).read_slab(start,start+slab_size)
+                latencies.append(time.time()-t)
+                errors.append(float(np.abs(slab-compressed.read_slab(start,start+slab_size)).max()))
+            result['img_read']=percentiles(latencies)
+            result['max_error_hu']=max(errors)
+        results.append(result)
+    return results
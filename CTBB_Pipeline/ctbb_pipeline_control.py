@@ -0,0 +1,358 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_control.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Job control for one library: priorities, pause/drain, cancellation and
+# preemption (see ctbb_pipeline_control in bin/).
+#
+# Priorities: a queue item may carry priority=<n> (see priorities; untagged
+# items are normal, 0). Daemons dispatch the highest priority in the queue
+# first, the dispatch policy choosing among jobs of that priority. A queued
+# job of at least 'preempt_priority' (settings.yml) that finds no free device
+# preempts the running job of lowest priority below its own, the most
+# recently started first since it loses the least work.
+#
+# Process groups: the daemon starts every job in a session of its own, so a
+# job and the ctbb_simdose/ctbb_recon processes under it form one process
+# group, whose id is the PID in the job's lease. A job is stopped by
+# signalling its group:
+#
+#     SIGTERM  cancel:  the job is recorded in .proc/error as CANCELLED and
+#                       is not retried
+#     SIGUSR1  preempt: the job is put back at the front of the queue with
+#                       its attempt count unchanged
+#
+# The job cleans up after itself (device, lease, partial images). If it is
+# still running stop_grace seconds later, its daemon kills the group and
+# does so instead. Stop requests are also left in .proc/stop/<device> so that
+# jobs running on other hosts sharing the library act on them: each job
+# checks for a request every lease_renew_interval seconds.
+#
+# Pause and drain are files in .proc seen by every daemon of the library:
+#
+#     .proc/paused  no new jobs are started; running ones continue
+#     .proc/drain   no new jobs are started, and daemons exit once their
+#                   running jobs have finished (the queue is kept)
+#
+# and are both cleared by resume().
+
+import os
+import time
+import signal
+import logging
+import threading
+
+from CTBB_Pipeline import pypeline as pype
+from CTBB_Pipeline.pypeline import mutex,qi_status
+from CTBB_Pipeline import ctbb_pipeline_lease as lease_util
+
+priorities={'low':-1,'normal':0,'high':1}
+
+stop_signals={'cancel':signal.SIGTERM,'preempt':signal.SIGUSR1}
+stop_reasons={signal.SIGTERM:'cancel',signal.SIGUSR1:'preempt'}
+
+def parse_priority(value):
+    ### Priority given as a name (low, normal, high) or an integer
+    if str(value) in priorities:
+        return priorities[str(value)]
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('Unknown priority %s (an integer or one of %s)' % (value,', '.join(sorted(priorities))))
+
+bad_priorities=set() # queue items already warned about
+
+def job_priority(qi):
+    ### Priority of a queue item; one that cannot be parsed (e.g. edited in
+    ### by hand) is normal, so that it cannot stop the daemon
+    if 'priority=' not in qi:
+        return 0
+    try:
+        return parse_priority(pype.get_queue_item_option(qi,'priority',0))
+    except ValueError as e:
+        if qi not in bad_priorities:
+            bad_priorities.add(qi)
+            logging.warning('%s: %s; treating it as normal (0)' % (qi,e))
+        return 0
+
+def select(policy,queue,device):
+    ### policy.select restricted to the jobs of the highest priority in the
+    ### queue (the whole queue when nothing carries a priority)
+    if not any(['priority=' in qi for qi in queue]):
+        return policy.select(queue,device)
+    levels=[job_priority(qi) for qi in queue]
+    top=max(levels)
+    indices=[i for i,p in enumerate(levels) if p==top]
+    i=policy.select([queue[i] for i in indices],device)
+    return None if i is None else indices[i]
+
+def plan_preemption(queue,running,threshold,n_pending=0):
+    ### Devices whose jobs should be preempted for the queue's urgent jobs.
+    ### running: (device, qi, start time) of jobs that could be preempted;
+    ### n_pending: preemptions already under way (each frees one device).
+    if threshold is None:
+        return []
+    waiting=sorted([p for p in [job_priority(qi) for qi in queue if 'priority=' in qi] if p>=threshold],reverse=True)
+    waiting=waiting[n_pending:]
+    candidates=sorted(running,key=lambda r: (job_priority(r[1]),-r[2]))
+    victims=[]
+    for p in waiting:
+        if not candidates or job_priority(candidates[0][1])>=p:
+            break
+        victims.append(candidates.pop(0)[0])
+    return victims
+
+def matches(qi,keys,campaign=None):
+    ### Whether a queue item matches any of keys, each a prefix of a job key
+    ### (filepath[,dose[,kernel[,slice_thickness]]], or 'all'), and belongs
+    ### to campaign if one is given
+    if campaign is not None and pype.get_queue_item_option(qi,'campaign')!=campaign:
+        return False
+    if not keys:
+        return campaign is not None
+    fields=pype.queue_item_key(qi).split(',')
+    for key in keys:
+        if key=='all':
+            return True
+        k=key.split(',')
+        if fields[0:len(k)]==k:
+            return True
+    return False
+
+# Pause/drain flags
+
+def flag_path(library,name):
+    return os.path.join(library.path,'.proc',name)
+
+def is_paused(library):
+    return os.path.exists(flag_path(library,'paused'))
+
+def is_draining(library):
+    return os.path.exists(flag_path(library,'drain'))
+
+def __set_flag__(library,name):
+    with open(flag_path(library,name),'w') as f:
+        f.write('%s %d %f\n' % (lease_util.hostname(),os.getpid(),time.time()))
+
+def pause(library):
+    __set_flag__(library,'paused')
+    logging.info('Library paused')
+
+def drain(library):
+    __set_flag__(library,'drain')
+    logging.info('Library draining')
+
+def resume(library):
+    for name in ['paused','drain']:
+        if os.path.exists(flag_path(library,name)):
+            os.remove(flag_path(library,name))
+    logging.info('Library resumed')
+
+# Stop requests
+
+def stop_dir(library):
+    return os.path.join(library.path,'.proc','stop')
+
+def signal_job(pid,sig):
+    ### Signal a job's process group (just the process if it does not lead
+    ### a group of its own). Returns False if it no longer exists.
+    try:
+        if os.getpgid(pid)==pid:
+            os.killpg(pid,sig)
+        else:
+            os.kill(pid,sig)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        logging.warning('Not permitted to signal job process %d' % pid)
+        return False
+    return True
+
+def request_stop(library,device,record,reason):
+    ### Ask the job holding device (lease record) to stop for reason
+    ### ('cancel' or 'preempt')
+    os.makedirs(stop_dir(library),exist_ok=True)
+    lease_util.write_record(os.path.join(stop_dir(library),device),
+                            {'reason':reason,'qi':record['qi'],'requested':time.time(),'host':lease_util.hostname()})
+    logging.info('Requested %s of %s on %s' % (reason,record['qi'],device))
+    if record.get('host')==lease_util.hostname():
+        signal_job(record['pid'],stop_signals[reason])
+
+def read_stop_request(library,device,qi):
+    ### Stop request for the job qi on device, or None
+    try:
+        request=lease_util.read_record(os.path.join(stop_dir(library),device))
+    except (IOError,ValueError):
+        return None
+    if request.get('qi')!=qi:
+        return None
+    request['requested']=float(request.get('requested',0))
+    return request
+
+def clear_stop_request(library,device,qi):
+    if read_stop_request(library,device,qi) is not None:
+        try:
+            os.remove(os.path.join(stop_dir(library),device))
+        except OSError:
+            pass
+
+def requeue_front(library,qi):
+    ### Put a job back at the front of the queue
+    with mutex('queue',library.mutex_dir):
+        queue_filepath=os.path.join(library.path,'.proc','queue')
+        with open(queue_filepath,'r') as f:
+            queue=f.read()
+        with open(queue_filepath,'w') as f:
+            f.write('%s\n' % qi)
+            f.write(queue)
+
+def finish_stopped(library,qi,reason,requeue=None):
+    ### Record the outcome of a stopped job: preempted jobs are requeued
+    ### (with requeue(qi) if given, e.g. by a daemon holding the queue
+    ### mutex), cancelled ones recorded as CANCELLED
+    from CTBB_Pipeline.ctbb_pipeline_retry import append_error
+    if reason=='preempt':
+        logging.info('Requeuing preempted job %s' % qi)
+        (requeue or (lambda qi: requeue_front(library,qi)))(qi)
+    else:
+        logging.info('Job %s cancelled' % qi)
+        append_error(library,qi,qi_status.CANCELLED,'permanent')
+
+def enforce_stop_grace(library,leases,grace,now=None):
+    ### Kill jobs of this host that have not stopped within grace seconds of
+    ### being asked to; the daemon then reclaims their device
+    if now is None:
+        now=time.time()
+    for device,record in leases.items():
+        if record.get('host')!=lease_util.hostname() or not record.get('qi'):
+            continue
+        request=read_stop_request(library,device,record['qi'])
+        if request is not None and now-request['requested']>grace:
+            logging.warning('Job %s on %s did not stop within %d s; killing it' % (record['qi'],device,grace))
+            signal_job(record['pid'],signal.SIGKILL)
+
+class stop_watcher:
+    ### Run by a job: acts on stop requests for it (e.g. from another host)
+    ### by signalling its own process group
+    library=None
+    device=None
+    qi=None
+    interval=None
+    thread=None
+    stop_event=None
+
+    def __init__(self,library,device,qi,interval):
+        self.library=library
+        self.device=device
+        self.qi=qi
+        self.interval=interval
+        self.stop_event=threading.Event()
+
+    def start(self):
+        def watch():
+            while not self.stop_event.wait(self.interval):
+                request=read_stop_request(self.library,self.device,self.qi)
+                if request is not None:
+                    logging.info('Found %s request from %s' % (request['reason'],request.get('host')))
+                    signal_job(os.getpid(),stop_signals[request['reason']])
+                    return
+        self.thread=threading.Thread(target=watch,daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+# Library-wide operations (ctbb_pipeline_control)
+
+def running_jobs(library):
+    return {device:record for device,record in lease_util.read_leases(library.lease_dir).items() if record.get('qi')}
+
+def __edit_queue__(library,edit):
+    ### Apply edit(queue) -> (new queue, result) to the queue under its mutex
+    with mutex('queue',library.mutex_dir):
+        queue_filepath=os.path.join(library.path,'.proc','queue')
+        with open(queue_filepath,'r') as f:
+            queue=f.read().splitlines()
+        queue,result=edit(queue)
+        with open(queue_filepath,'w') as f:
+            for qi in queue:
+                f.write('%s\n' % qi)
+    return result
+
+def cancel_jobs(library,keys,campaign=None):
+    ### Cancel matching jobs: queued ones (and retries waiting for their
+    ### backoff) are removed, those campaigns have yet to expand into the
+    ### queue are marked cancelled, running ones stopped. Returns (n_queued,
+    ### n_running).
+    from CTBB_Pipeline.ctbb_pipeline_retry import retry_manager,append_error
+    from CTBB_Pipeline import ctbb_pipeline_campaign as campaigns
+
+    def edit(queue):
+        cancelled=[qi for qi in queue if matches(qi,keys,campaign)]
+        # Under the queue mutex, so no daemon expands them meanwhile
+        n_unexpanded=campaigns.cancel(library,keys,campaign)
+        return [qi for qi in queue if not matches(qi,keys,campaign)],(cancelled,n_unexpanded)
+
+    cancelled,n_unexpanded=__edit_queue__(library,edit)
+
+    with mutex('queue',library.mutex_dir):
+        retry=retry_manager(library)
+        n_scheduled=len(retry.scheduled)
+        cancelled+=[qi for due,qi in retry.scheduled if matches(qi,keys,campaign)]
+        retry.scheduled=[(due,qi) for due,qi in retry.scheduled if not matches(qi,keys,campaign)]
+        if len(retry.scheduled)!=n_scheduled:
+            retry.save()
+
+    for qi in cancelled:
+        append_error(library,qi,qi_status.CANCELLED,'permanent')
+
+    n_running=0
+    for device,record in running_jobs(library).items():
+        if matches(record['qi'],keys,campaign):
+            request_stop(library,device,record,'cancel')
+            n_running+=1
+    return len(cancelled)+n_unexpanded,n_running
+
+def preempt_jobs(library,keys,campaign=None):
+    ### Stop matching running jobs and requeue them. Returns the number stopped.
+    n=0
+    for device,record in running_jobs(library).items():
+        if matches(record['qi'],keys,campaign):
+            request_stop(library,device,record,'preempt')
+            n+=1
+    return n
+
+def set_priority(library,keys,priority,campaign=None):
+    ### Set the priority of matching queued jobs (and, given a campaign and
+    ### no keys, of the jobs it has yet to expand). Returns the number of
+    ### queued jobs changed.
+    from CTBB_Pipeline import ctbb_pipeline_campaign as campaigns
+    priority=parse_priority(priority)
+    if campaign is not None and not keys and campaigns.get_campaign(library,campaign) is not None:
+        campaigns.set_campaign_priority(library,campaign,priority)
+
+    def edit(queue):
+        n=0
+        for i,qi in enumerate(queue):
+            if matches(qi,keys,campaign):
+                queue[i]=pype.set_queue_item_option(qi,'priority',priority)
+                n+=1
+        return queue,n
+    return __edit_queue__(library,edit)
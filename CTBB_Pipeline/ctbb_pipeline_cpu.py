@@ -0,0 +1,298 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_cpu.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# CPU placement and budgets for the host side of jobs.
+#
+# Core affinity: the cores of each NUMA node are split between the GPUs
+# attached to it, and the daemon starts each job pinned to its device's share
+# (so ctbb_simdose and ctbb_recon's host threads run next to the GPU's memory
+# and do not spread over every core). The topology is read from /sys, or from
+# CTBB_PIPELINE_SYSFS if set, so it can be tested without a GPU:
+#
+#     devices/system/cpu/online            cores of the host
+#     devices/system/node/node<N>/cpulist  cores of each NUMA node
+#     bus/pci/devices/<bus id>/numa_node   NUMA node of each GPU
+#
+# Stage budgets: the CPU-heavy stages of a job (fetch_raw: copying and
+# hashing raw data; dose_reduction: ctbb_simdose; recon: ctbb_recon) each
+# have a number of slots per host. A job takes a slot (a mutex named
+# "cpu_<stage><k>@<host>") for the duration of the stage, waiting if all are
+# taken, and the stage's child processes run with the stage's nice value and
+# I/O scheduling class so background I/O does not starve recon host threads.
+# The defaults below can be overridden per stage with 'cpu_stages' in the
+# library's settings.yml, e.g.
+#
+#     cpu_stages:
+#         dose_reduction: {slots: 2, nice: 10}
+
+import os
+import glob
+import time
+import logging
+
+from CTBB_Pipeline.pypeline import mutex
+from CTBB_Pipeline.ctbb_pipeline_lease import hostname,pid_alive
+
+# slots: concurrent stages per host (None: unlimited)
+# nice:  niceness added to the stage's child processes
+# ionice: I/O scheduling class of the stage ('best-effort', 'idle' or None)
+default_stage_settings={
+    'fetch_raw'      : {'slots':2,    'nice':10, 'ionice':'idle'},
+    'dose_reduction' : {'slots':None, 'nice':5,  'ionice':'best-effort'},
+    'recon'          : {'slots':None, 'nice':0,  'ionice':None},
+}
+
+ioprio_classes={'realtime':1,'best-effort':2,'idle':3}
+ioprio_class_shift=13
+ioprio_who_process=1
+
+def sysfs_root():
+    return os.environ.get('CTBB_PIPELINE_SYSFS','/sys')
+
+def parse_cpulist(s):
+    ### "0-3,8,10-11" -> [0,1,2,3,8,10,11]
+    cpus=[]
+    for token in s.strip().split(','):
+        token=token.strip()
+        if not token:
+            continue
+        if '-' in token:
+            a,b=token.split('-',1)
+            cpus+=list(range(int(a),int(b)+1))
+        else:
+            cpus.append(int(token))
+    return sorted(set(cpus))
+
+def __read__(path):
+    try:
+        with open(path,'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def online_cpus(root=None):
+    root=root or sysfs_root()
+    s=__read__(os.path.join(root,'devices','system','cpu','online'))
+    return parse_cpulist(s) if s else list(range(os.cpu_count() or 1))
+
+def numa_nodes(root=None):
+    ### {node: [cpus]} (one node holding every core if /sys has no NUMA info)
+    root=root or sysfs_root()
+    nodes={}
+    for path in glob.glob(os.path.join(root,'devices','system','node','node*','cpulist')):
+        node=os.path.basename(os.path.dirname(path))[4:]
+        s=__read__(path)
+        if node.isdigit() and s:
+            nodes[int(node)]=parse_cpulist(s)
+    if not nodes:
+        nodes[0]=online_cpus(root)
+    return nodes
+
+def normalize_bus_id(bus_id):
+    # nvidia-smi reports "00000000:3B:00.0", /proc and /sys use "0000:3b:00.0"
+    bus_id=bus_id.lower()
+    domain,rest=bus_id.split(':',1) if bus_id.count(':')==2 else ('0000',bus_id)
+    return '%04x:%s' % (int(domain,16),rest)
+
+def device_numa_node(bus_id,root=None):
+    ### NUMA node of a PCI device, or None if unknown
+    if not bus_id:
+        return None
+    root=root or sysfs_root()
+    s=__read__(os.path.join(root,'bus','pci','devices',normalize_bus_id(bus_id),'numa_node'))
+    try:
+        node=int(s)
+    except (TypeError,ValueError):
+        return None
+    return node if node>=0 else None # -1: no NUMA affinity
+
+def split(cpus,n):
+    ### Split cpus into n contiguous, near-equal shares (shared if too few)
+    if n<=0:
+        return []
+    if len(cpus)<n:
+        return [[cpus[i%len(cpus)]] if cpus else [] for i in range(n)]
+    shares=[]
+    for i in range(n):
+        shares.append(cpus[i*len(cpus)//n:(i+1)*len(cpus)//n])
+    return shares
+
+def plan_affinity(devices,allowed=None,root=None):
+    ### {device index: [cpus]} for devices as returned by discover_devices.
+    ### allowed restricts the cores used (default: this process's affinity).
+    if allowed is None:
+        allowed=os.sched_getaffinity(0)
+    allowed=set(allowed)
+    nodes={n:[c for c in cpus if c in allowed] for n,cpus in numa_nodes(root).items()}
+    nodes={n:cpus for n,cpus in nodes.items() if cpus}
+    everything=sorted(allowed)
+
+    by_node={}
+    for d in devices:
+        node=device_numa_node(d.get('bus_id'),root)
+        if node not in nodes:
+            node=None
+        by_node.setdefault(node,[]).append(d['index'])
+
+    plan={}
+    for node,indices in by_node.items():
+        cpus=nodes[node] if node is not None else everything
+        for i,share in zip(sorted(indices),split(cpus,len(indices))):
+            plan[i]=share
+    return plan
+
+def stage_settings(library,stage):
+    settings=dict(default_stage_settings[stage])
+    settings.update((library.settings.get('cpu_stages') or {}).get(stage,{}))
+    return settings
+
+# ioprio_set/ioprio_get system call numbers (Python has no wrapper)
+ioprio_syscalls={'x86_64':(251,252),'i686':(289,290),'aarch64':(30,31),'ppc64le':(273,274)}
+
+def __ioprio__(get,*args):
+    import ctypes
+    import platform
+    numbers=ioprio_syscalls.get(platform.machine())
+    if numbers is None:
+        return -1
+    try:
+        return ctypes.CDLL(None,use_errno=True).syscall(numbers[1 if get else 0],ioprio_who_process,*args)
+    except (OSError,AttributeError):
+        return -1
+
+def set_io_priority(ionice,tid=0):
+    ### Set the I/O scheduling class of a thread (0: the calling thread).
+    ### Returns False where this is not supported.
+    if ionice is None:
+        return True
+    value=(ioprio_classes[ionice]<<ioprio_class_shift)|(4 if ionice!='idle' else 0)
+    return __ioprio__(False,tid,value)==0
+
+def get_io_priority(tid=0):
+    ### Raw I/O priority of a thread, or None where unsupported
+    value=__ioprio__(True,tid)
+    return value if value>=0 else None
+
+def restore_io_priority(value,tid=0):
+    if value is not None:
+        __ioprio__(False,tid,value)
+
+def lower_thread_priority(library,stage):
+    ### Give the calling thread a stage's nice value and I/O class, for
+    ### background threads doing that stage's work (e.g. raw data prefetch).
+    ### Linux schedules threads individually, so the rest of the process is
+    ### unaffected.
+    settings=stage_settings(library,stage)
+    import threading
+    tid=threading.get_native_id()
+    if settings['nice']:
+        try:
+            os.setpriority(os.PRIO_PROCESS,tid,os.getpriority(os.PRIO_PROCESS,tid)+int(settings['nice']))
+        except OSError:
+            pass
+    set_io_priority(settings['ionice'])
+
+def dead_local_owner(owner):
+    ### For mutex.claim_if_dead: held by a process of this host that is gone
+    return owner[0]==hostname() and not pid_alive(owner[1])
+
+class cpu_stage:
+    ### Context manager for one CPU-heavy stage of a job:
+    ###
+    ###     with cpu_stage(library,'dose_reduction') as stage:
+    ###         subprocess.call(stage.command([...]))
+    ###
+    ### takes one of the stage's slots on this host (waiting for one if they
+    ### are all taken), and gives the calling thread the stage's I/O class
+    ### until the stage ends. stage.command prefixes a child's command line
+    ### with nice/ionice for the stage's nice value and I/O class. (Nothing
+    ### runs in the child between fork and exec: the processes starting
+    ### children have other threads running.)
+    library=None
+    stage=None
+    settings=None
+    slot=None
+    saved_io_priority=None
+
+    def __init__(self,library,stage):
+        self.library=library
+        self.stage=stage
+        self.settings=stage_settings(library,stage)
+
+    def slot_names(self):
+        return ['cpu_%s%d@%s' % (self.stage,k,hostname()) for k in range(int(self.settings['slots']))]
+
+    def reclaim(self,m):
+        # A slot held by a process of this host that no longer exists (e.g. a
+        # job that was killed) is freed
+        owner=m.claim_if_dead(dead_local_owner)
+        if owner is not None:
+            logging.info('Freed CPU slot %s held by dead process %d' % (m.name,owner[1]))
+
+    def acquire(self):
+        if not self.settings['slots']:
+            return
+        slots=[mutex(name,self.library.mutex_dir) for name in self.slot_names()]
+        t_start=time.time()
+        delay=0.05
+        while True:
+            for m in slots:
+                if m.try_lock():
+                    self.slot=m
+                    t_wait=time.time()-t_start
+                    if t_wait>0.001:
+                        logging.info('CPU slot %s acquired after waiting %.3f s' % (m.name,t_wait))
+                    return
+            for m in slots:
+                self.reclaim(m)
+            time.sleep(delay)
+            delay=min(2*delay,2)
+
+    def release(self):
+        if self.slot is not None:
+            self.slot.unlock()
+            self.slot=None
+
+    def __enter__(self):
+        self.acquire()
+        if self.settings['ionice'] is not None:
+            self.saved_io_priority=get_io_priority()
+            set_io_priority(self.settings['ionice'])
+        return self
+
+    def __exit__(self,type,value,traceback):
+        if self.settings['ionice'] is not None:
+            restore_io_priority(self.saved_io_priority)
+        self.release()
+
+    def prefix(self):
+        ### nice/ionice arguments for the stage (those not installed are left out)
+        import shutil
+        prefix=[]
+        if self.settings['nice'] and shutil.which('nice'):
+            prefix+=['nice','-n',str(int(self.settings['nice']))]
+        if self.settings['ionice'] is not None and shutil.which('ionice'):
+            prefix+=['ionice','-c',str(ioprio_classes[self.settings['ionice']])]
+            if self.settings['ionice']!='idle':
+                prefix+=['-n','4']
+        return prefix
+
+    def command(self,args):
+        ### Command line args (a list) run at the stage's priorities
+        return self.prefix()+list(args)
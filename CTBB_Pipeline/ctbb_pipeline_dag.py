@@ -0,0 +1,597 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_dag.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Job DAGs: the stages that follow each job's reconstruction.
+#
+# A job (queue item) reconstructs one series on a GPU, and is the root of a
+# DAG of downstream stages declared in the library's settings.yml:
+#
+#     stages:
+#         preview:  {run: preview}
+#         segment:  {run: 'lung_seg {series} {seg_dir}/{name}.mask'}
+#         analysis: {run: analysis, after: [segment]}
+#         compare:  {run: compare, inputs: {reference: {dose: 100}}}
+#         compress: {run: compress, resource: io, after: [preview, analysis, compare]}
+#     stage_pools: {cpu: 4, io: 1}
+#
+# Each stage has
+#
+#     run       a builtin (see builtins: preview, analysis, compare, compress)
+#               or a command, formatted with the fields of task_fields, e.g.
+#               {series} (the job's .img/.imgz), {seg_dir}, {eval_dir}, and
+#               the series of each of the stage's inputs by name
+#     resource  'cpu' (default) or 'io': the pool the stage runs on
+#     after     stages of the same job that must have succeeded first
+#     inputs    other recons of the same case the stage reads, by name, as
+#               overrides of the job's dose/kernel/slice_thickness (e.g. a
+#               full-dose reference). The stage waits until they exist, and
+#               does not apply to a job that is its own input.
+#     select    {dose/kernel/slice_thickness: [values]}: only these jobs
+#     options   keyword arguments of a builtin
+#
+# The GPU stage of the DAG is the job itself, dispatched to the devices as
+# before. The daemon runs the rest on a process pool per resource class on
+# its host (stage_pools workers each, niced; I/O stages in the idle I/O
+# class), starting each task (stage, job) as soon as its job has finished,
+# its 'after' stages have succeeded and its inputs exist -- so the analysis
+# of finished series overlaps the reconstruction of the rest of the queue.
+#
+# Finished jobs are read from .proc/done. Outcomes are appended to
+# .proc/stages, shared by every host using the library:
+#
+#     <status>\t<stage>\t<job key>\t<time>\t<host>
+#
+# status being done, error, skipped (an 'after' stage did not succeed) or
+# retry (ctbb_pipeline_stages --retry: run the task again). A task is claimed
+# with a mutex of its own, so each runs once across hosts; one left behind by
+# a dead process of this host is reclaimed.
+#
+# Compression replaces a series' .img by its .imgz, so a compress task waits
+# until no unfinished task reads the series, and no task starts reading a
+# series while it is being compressed. With 'compress_recons' set and no
+# compress stage declared, a stage 'compress' on the io pool after all the
+# others is implied (see library_stages), so finished series are compressed
+# here rather than by the job while it still holds its device.
+
+import os
+import time
+import shlex
+import logging
+import subprocess
+import multiprocessing
+import threading
+from hashlib import md5
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from CTBB_Pipeline import pypeline as pype
+from CTBB_Pipeline.pypeline import mutex
+from CTBB_Pipeline.ctbb_pipeline_lease import hostname
+from CTBB_Pipeline.ctbb_pipeline_status import tail_reader
+from CTBB_Pipeline.ctbb_pipeline_cpu import dead_local_owner,set_io_priority
+from CTBB_Pipeline import ctbb_pipeline_layout as layout
+
+resources=['cpu','io']
+default_pools={'cpu':2,'io':1}
+
+# Priority of each pool's worker processes
+resource_classes={
+    'cpu' : {'nice':10, 'ionice':'best-effort'},
+    'io'  : {'nice':10, 'ionice':'idle'},
+}
+
+parameters=['dose','kernel','slice_thickness']
+statuses=['done','error','skipped','retry']
+
+def ledger_path(library):
+    return os.path.join(library.path,'.proc','stages')
+
+# Declarations
+
+def parse_stages(declared):
+    ### Validated stage declarations ({name: stage}), in an order in which
+    ### every stage comes after those it depends on
+    stages={}
+    for name,d in (declared or {}).items():
+        d=dict(d or {})
+        unknown=set(d)-set(['run','resource','after','inputs','select','options'])
+        if unknown:
+            raise ValueError('Stage %s: unknown fields %s' % (name,', '.join(sorted(unknown))))
+        if name=='recon':
+            raise ValueError('Stage recon is the job itself and cannot be declared')
+        if not d.get('run'):
+            raise ValueError('Stage %s has nothing to run' % name)
+        resource=d.get('resource','cpu')
+        if resource=='gpu':
+            raise ValueError('Stage %s: GPU work runs as queue items (launch it as a job); stages are cpu or io' % name)
+        if resource not in resources:
+            raise ValueError('Stage %s: unknown resource %s (choose from %s)' % (name,resource,', '.join(resources)))
+        inputs=d.get('inputs') or {}
+        for input_name,overrides in inputs.items():
+            if input_name in task_fields or set(overrides or {})-set(parameters):
+                raise ValueError('Stage %s: bad input %s' % (name,input_name))
+        if d['run']=='compare' and len(inputs)!=1 and 'reference' not in inputs:
+            raise ValueError('Stage %s: compare needs a reference input' % name)
+        stages[name]={'name':name,
+                      'run':d['run'],
+                      'resource':resource,
+                      'after':list(d.get('after') or []),
+                      'inputs':{k:dict(v or {}) for k,v in inputs.items()},
+                      'select':{k:[str(x) for x in (v if isinstance(v,list) else [v])] for k,v in (d.get('select') or {}).items()},
+                      'options':dict(d.get('options') or {})}
+
+    # Topological order (and no cycles)
+    order=[]
+    state={}
+    def visit(name,path):
+        if state.get(name)=='done':
+            return
+        if state.get(name)=='visiting':
+            raise ValueError('Stages depend on each other: %s' % ' -> '.join(path+[name]))
+        state[name]='visiting'
+        for a in stages[name]['after']:
+            if a not in stages:
+                raise ValueError('Stage %s runs after unknown stage %s' % (name,a))
+            visit(a,path+[name])
+        state[name]='done'
+        order.append(name)
+    for name in sorted(stages):
+        visit(name,[])
+    return [stages[name] for name in order]
+
+def library_stages(library):
+    ### The library's stages (as parse_stages), with the compress stage that
+    ### 'compress_recons' implies
+    declared=dict(library.settings.get('stages') or {})
+    if library.settings.get('compress_recons') and not any([(d or {}).get('run')=='compress' for d in declared.values()]):
+        if 'compress' in declared:
+            raise ValueError('Stage compress is taken by compress_recons; rename the declared stage')
+        declared['compress']={'run':'compress',
+                              'resource':'io',
+                              'after':list(declared),
+                              'options':{'keep':bool(library.settings.get('compress_keep_img'))}}
+    return parse_stages(declared)
+
+def stage_pools(library):
+    pools=dict(default_pools)
+    pools.update(library.settings.get('stage_pools') or {})
+    return pools
+
+# Jobs and their series
+
+def job_id(key):
+    ### Normalized (filepath, dose, kernel, slice thickness) of a job key, so
+    ### that e.g. slice thickness 1 and 1.0 are the same job
+    item=pype.parse_queue_item(key)
+    return (item['filepath'],int(float(item['dose'])),int(float(item['kernel'])),float(item['slice_thickness']))
+
+def job_key(jid):
+    return '%s,%d,%d,%s' % (jid[0],jid[1],jid[2],jid[3])
+
+def task_mutex(library,name,jid):
+    ### Mutex held by the task (stage name, job id) while it runs
+    digest=md5(('%s\t%s' % (name,job_key(jid))).encode('utf-8')).hexdigest()
+    return mutex('stage_%s' % digest,library.mutex_dir)
+
+def series_path(library,case_id,dose,kernel,slice_thickness):
+    ### The .img of a series (its .imgz if compressed, see ctbb_pipeline_compress)
+    return layout.img_filepath(library,case_id,dose,kernel,slice_thickness)
+
+def series_exists(filepath):
+    from CTBB_Pipeline.ctbb_pipeline_compress import series_filepath
+    return os.path.exists(series_filepath(filepath))
+
+def input_id(jid,overrides):
+    ### Job of an input: the job's parameters with the input's overrides
+    dose=int(float(overrides.get('dose',jid[1])))
+    kernel=int(float(overrides.get('kernel',jid[2])))
+    st=float(overrides.get('slice_thickness',jid[3]))
+    return (jid[0],dose,kernel,st)
+
+def applies(stage,jid):
+    values={'dose':jid[1],'kernel':jid[2],'slice_thickness':jid[3]}
+    for p,allowed in stage['select'].items():
+        if not any([float(values[p])==float(v) for v in allowed]):
+            return False
+    for overrides in stage['inputs'].values():
+        if input_id(jid,overrides)==jid:
+            return False
+    return True
+
+task_fields=['series','name','prm','study_dir','img_dir','seg_dir','eval_dir','ref_dir','qi_raw_dir','qa_dir',
+             'log_dir','case_id','dose','kernel','slice_thickness','library']
+
+def __format_st__(st,original):
+    # Slice thickness as it is written in the job's paths
+    return original if float(original)==st else str(st)
+
+def __run_command__(library_path,stage,fields):
+    # Fields are quoted before they go in, so a path with spaces or quotes
+    # stays one argument when the command line is split
+    command=stage['run'].format(**{k:shlex.quote(str(v)) for k,v in fields.items()})
+    log_filepath=os.path.join(fields['log_dir'],'%s_%s.log' % (fields['name'],stage['name']))
+    logging.info('Stage %s: %s' % (stage['name'],command))
+    with open(log_filepath,'a') as log:
+        exit_status=subprocess.call(shlex.split(command),stdout=log,stderr=subprocess.STDOUT)
+    if exit_status!=0:
+        raise RuntimeError('%s exited with status %d (see %s)' % (command,exit_status,log_filepath))
+
+def __run_preview__(library_path,stage,fields):
+    from CTBB_Pipeline.ctbb_pipeline_preview import preview_series
+    preview_series(fields['series'],**stage['options'])
+
+def __run_analysis__(library_path,stage,fields):
+    from CTBB_Pipeline.ctbb_pipeline_analysis import analyze_series
+    analyze_series(fields['series'],**stage['options'])
+
+def __run_compare__(library_path,stage,fields):
+    from CTBB_Pipeline.ctbb_pipeline_compare import compare_series
+    reference=fields['reference'] if 'reference' in stage['inputs'] else fields[list(stage['inputs'])[0]]
+    options=dict(stage['options'])
+    if 'rois' in options:
+        options['rois']=[tuple(r) for r in options['rois']]
+    compare_series(library_path,fields['series'],reference,**options)
+
+def __run_compress__(library_path,stage,fields):
+    from CTBB_Pipeline.ctbb_pipeline_compress import convert_series,series_filepath,is_compressed
+    if is_compressed(series_filepath(fields['series'])):
+        return
+    convert_series(fields['series'],**stage['options'])
+
+builtins={
+    'preview'  : __run_preview__,
+    'analysis' : __run_analysis__,
+    'compare'  : __run_compare__,
+    'compress' : __run_compress__,
+}
+
+def run_task(library_path,stage,fields):
+    ### Run one stage for one job (in a pool worker). Failures raise.
+    run=builtins.get(stage['run'],__run_command__)
+    t_start=time.time()
+    run(library_path,stage,fields)
+    logging.info('Stage %s of %s finished in %.1f s' % (stage['name'],fields['name'],time.time()-t_start))
+
+def __init_worker__(nice,ionice):
+    if nice:
+        os.nice(int(nice))
+    set_io_priority(ionice)
+
+class stage_scheduler:
+    ### Runs the library's stages on this host (one per daemon):
+    ###
+    ###     scheduler.update()  # each pass: record finished tasks, start ready ones
+    ###     scheduler.busy()    # tasks running or ready to run
+    ###     scheduler.wait(t)   # sleep until a task finishes (at most t s)
+    ###     scheduler.shutdown()
+    library=None
+    stages=None     # in dependency order
+    by_name=None
+    pools=None
+    executors=None  # resource -> ProcessPoolExecutor (started on first use)
+    done_reader=None
+    ledger_reader=None
+    case_list=None
+    case_list_mtime=None
+    jobs=None       # finished jobs: job id -> job key as queued
+    sequence=None   # job id -> order in which the jobs finished
+    ledger=None     # (stage, job id) -> status
+    pending=None    # tasks not in the ledger
+    running=None    # task -> (future, task mutex)
+    n_ready=0
+    finished=None   # set when a task finishes (see wait)
+
+    def __init__(self,library):
+        self.library=library
+        self.stages=library_stages(library)
+        self.by_name={s['name']:s for s in self.stages}
+        self.pools=stage_pools(library)
+        self.executors={}
+        self.jobs={}
+        self.sequence={}
+        self.ledger={}
+        self.pending=set()
+        self.running={}
+        self.finished=threading.Event()
+        self.done_reader=tail_reader(os.path.join(library.path,'.proc','done'),None)
+        self.ledger_reader=tail_reader(ledger_path(library),None)
+
+    def enabled(self):
+        return len(self.stages)>0
+
+    def busy(self):
+        ### Whether tasks are running or ready to run, including those of jobs
+        ### that finished since the last update
+        if self.running:
+            return True
+        self.refresh()
+        self.n_ready=len([t for t in self.pending if self.state(t)=='ready'])
+        return self.n_ready>0
+
+    def wait(self,timeout):
+        ### Sleep for up to timeout seconds, waking early when a task finishes
+        ### so that the stages after it start without delay
+        self.finished.wait(timeout)
+        self.finished.clear()
+
+    # Bookkeeping
+
+    def read_ledger(self):
+        for line in self.ledger_reader.read():
+            fields=line.split('\t')
+            if len(fields)<3 or fields[0] not in statuses or fields[1] not in self.by_name:
+                continue
+            try:
+                task=(fields[1],job_id(fields[2]))
+            except (IndexError,ValueError):
+                continue
+            if fields[0]=='retry':
+                self.ledger.pop(task,None)
+                if task[1] in self.jobs:
+                    self.pending.add(task)
+            else:
+                self.ledger[task]=fields[0]
+                self.pending.discard(task)
+
+    def read_done(self):
+        for line in self.done_reader.read():
+            try:
+                jid=job_id(pype.queue_item_key(line))
+            except (IndexError,ValueError):
+                continue
+            if jid in self.jobs:
+                continue
+            self.jobs[jid]=pype.queue_item_key(line)
+            self.sequence[jid]=len(self.sequence)
+            for stage in self.stages:
+                task=(stage['name'],jid)
+                if applies(stage,jid) and task not in self.ledger:
+                    self.pending.add(task)
+
+    def refresh(self):
+        if not self.enabled():
+            return
+        self.read_done()
+        self.read_ledger()
+
+    def record(self,task,status):
+        with mutex('stages',self.library.mutex_dir):
+            with open(ledger_path(self.library),'a') as f:
+                f.write('%s\t%s\t%s\t%f\t%s\n' % (status,task[0],job_key(task[1]),time.time(),hostname()))
+        self.ledger[task]=status
+        self.pending.discard(task)
+
+    def get_case_id(self,filepath):
+        case_list_filepath=os.path.join(self.library.path,'case_list.txt')
+        mtime=os.path.getmtime(case_list_filepath)
+        if mtime!=self.case_list_mtime:
+            self.case_list=self.library.__get_case_list__()
+            self.case_list_mtime=mtime
+        return self.case_list.get(filepath)
+
+    def job_series(self,jid):
+        case_id=self.get_case_id(jid[0])
+        if case_id is None:
+            return None
+        key=self.jobs.get(jid)
+        st=__format_st__(jid[3],key.split(',')[3]) if key else str(jid[3])
+        return series_path(self.library,case_id,jid[1],jid[2],st)
+
+    def fields(self,task):
+        ### Command fields of a task (see task_fields), and the series of its
+        ### inputs by name
+        stage=self.by_name[task[0]]
+        jid=task[1]
+        series=self.job_series(jid)
+        study_dir=os.path.dirname(os.path.dirname(series))
+        fields={'series':series,
+                'name':os.path.splitext(os.path.basename(series))[0],
+                'prm':os.path.splitext(series)[0]+'.prm',
+                'study_dir':study_dir,
+                'case_id':self.get_case_id(jid[0]),
+                'dose':jid[1],
+                'kernel':jid[2],
+                'slice_thickness':self.jobs[jid].split(',')[3],
+                'library':self.library.path}
+        for d in ['img','seg','eval','ref','qi_raw','qa','log']:
+            fields['%s_dir' % d]=os.path.join(study_dir,d)
+        for name,overrides in stage['inputs'].items():
+            fields[name]=self.job_series(input_id(jid,overrides))
+        return fields
+
+    def input_ids(self,task):
+        stage=self.by_name[task[0]]
+        return [input_id(task[1],o) for o in stage['inputs'].values()]
+
+    # Scheduling
+
+    def task_mutex(self,task):
+        return task_mutex(self.library,task[0],task[1])
+
+    def reclaim(self,m):
+        # A task claimed by a process of this host that no longer exists
+        owner=m.claim_if_dead(dead_local_owner)
+        if owner is None:
+            return False
+        logging.info('Reclaimed stage task %s held by dead process %d' % (m.name,owner[1]))
+        return True
+
+    def state(self,task):
+        ### 'ready', 'waiting' or 'skipped' for a pending task
+        stage=self.by_name[task[0]]
+        jid=task[1]
+        for a in stage['after']:
+            if not applies(self.by_name[a],jid):
+                continue
+            status=self.ledger.get((a,jid))
+            if status in ['error','skipped']:
+                return 'skipped'
+            if status!='done':
+                return 'waiting'
+        for iid in self.input_ids(task):
+            if iid in self.jobs:
+                continue
+            filepath=self.job_series(iid)
+            if filepath is None or not series_exists(filepath):
+                return 'waiting'
+        return 'ready'
+
+    def compressing(self,ready):
+        ### Jobs whose series are being compressed, here or (ready tasks
+        ### already claimed) on another host
+        jobs=set([t[1] for t in self.running if self.by_name[t[0]]['run']=='compress'])
+        for task in ready:
+            if self.by_name[task[0]]['run']=='compress' and self.task_mutex(task).check_state():
+                jobs.add(task[1])
+        return jobs
+
+    def readers(self):
+        ### Jobs whose series unfinished tasks (other than compression) read
+        jobs=set()
+        for task in self.pending:
+            if self.by_name[task[0]]['run']=='compress':
+                continue
+            jobs.add(task[1])
+            jobs.update(self.input_ids(task))
+        return jobs
+
+    def executor(self,resource):
+        if resource not in self.executors:
+            c=resource_classes[resource]
+            # Workers are spawned rather than forked from the daemon, whose
+            # threads (lease renewal, prefetch copies) may hold locks a
+            # forked child would inherit held
+            self.executors[resource]=ProcessPoolExecutor(max_workers=int(self.pools[resource]),
+                                                         mp_context=multiprocessing.get_context('spawn'),
+                                                         initializer=__init_worker__,
+                                                         initargs=(c['nice'],c['ionice']))
+        return self.executors[resource]
+
+    def collect(self):
+        ### Record tasks that have finished
+        for task,(future,m) in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[task]
+            e=future.exception()
+            if e is None:
+                self.record(task,'done')
+            else:
+                logging.error('Stage %s of %s failed: %s' % (task[0],job_key(task[1]),e))
+                self.record(task,'error')
+                if isinstance(e,BrokenProcessPool):
+                    resource=self.by_name[task[0]]['resource']
+                    self.executors.pop(resource).shutdown(wait=False)
+            m.unlock()
+
+    def update(self,start=True):
+        ### One scheduling pass. With start=False (e.g. paused), running
+        ### tasks are collected but nothing new is started.
+        if not self.enabled():
+            return
+        self.collect()
+        self.refresh()
+
+        ready=[]
+        # Earliest finished jobs first, stages in dependency order
+        rank={s['name']:i for i,s in enumerate(self.stages)}
+        for task in sorted(self.pending-set(self.running),key=lambda t: (self.sequence[t[1]],rank[t[0]])):
+            s=self.state(task)
+            if s=='skipped':
+                self.record(task,'skipped')
+            elif s=='ready':
+                ready.append(task)
+        self.n_ready=len(ready)
+        if not start or not ready:
+            return
+
+        compressing=self.compressing(ready)
+        readers=self.readers() if any([self.by_name[t[0]]['run']=='compress' for t in ready]) else set()
+        n_running={r:len([t for t in self.running if self.by_name[t[0]]['resource']==r]) for r in resources}
+        for task in ready:
+            stage=self.by_name[task[0]]
+            if n_running[stage['resource']]>=int(self.pools[stage['resource']]):
+                continue
+            if stage['run']=='compress':
+                if task[1] in readers:
+                    continue
+            elif compressing.intersection([task[1]]+self.input_ids(task)):
+                continue
+            if not self.claim(task):
+                continue
+            fields=self.fields(task)
+            logging.info('Starting stage %s of %s' % (task[0],fields['name']))
+            m=self.task_mutex(task)
+            try:
+                future=self.executor(stage['resource']).submit(run_task,self.library.path,stage,fields)
+            except (BrokenProcessPool,RuntimeError) as e:
+                logging.error('Could not start stage %s: %s' % (task[0],e))
+                m.unlock()
+                self.executors.pop(stage['resource'],None)
+                continue
+            future.add_done_callback(lambda f: self.finished.set())
+            self.running[task]=(future,m)
+            n_running[stage['resource']]+=1
+            if stage['run']=='compress':
+                compressing.add(task[1])
+
+    def claim(self,task):
+        m=self.task_mutex(task)
+        if not m.try_lock():
+            if not self.reclaim(m) or not m.try_lock():
+                return False
+        # Another host may have finished it since we last read the ledger
+        self.read_ledger()
+        if task not in self.pending:
+            m.unlock()
+            return False
+        return True
+
+    def summary(self):
+        ### Counts of tasks of each stage by state
+        counts={s['name']:{'done':0,'error':0,'skipped':0,'running':0,'ready':0,'waiting':0} for s in self.stages}
+        for (name,jid),status in self.ledger.items():
+            counts[name][status]+=1
+        for task in self.pending:
+            if task in self.running:
+                counts[task[0]]['running']+=1
+            else:
+                s=self.state(task)
+                counts[task[0]][s]+=1
+        return counts
+
+    def retry(self,names=None,which=('error','skipped')):
+        ### Run the failed (or skipped) tasks of the given stages (all by
+        ### default) again. Returns the number requeued.
+        n=0
+        for task,status in list(self.ledger.items()):
+            if status in which and (names is None or task[0] in names):
+                self.record(task,'retry')
+                del self.ledger[task]
+                if task[1] in self.jobs:
+                    self.pending.add(task)
+                n+=1
+        return n
+
+    def shutdown(self,wait=True):
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+        if wait:
+            self.collect()
+        self.executors={}
@@ -0,0 +1,191 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_devices.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# GPU discovery without creating a CUDA context.
+#
+# Devices are found, in order of preference, from:
+#     1. CTBB_PIPELINE_FAKE_DEVICES=N (benchmarks and tests)
+#     2. the cached inventory file, if it was written since the last boot
+#     3. /proc/driver/nvidia/gpus (no driver calls at all)
+#     4. nvidia-smi
+#     5. the CUDA driver API through pycuda (cuInit only; no context)
+# and the result is then restricted to CUDA_VISIBLE_DEVICES. Devices are
+# numbered the way ctbb_recon --device=N sees them, which assumes
+# CUDA_DEVICE_ORDER=PCI_BUS_ID (or a single GPU model in the machine).
+#
+# Each device is a dictionary with 'index', 'name', 'uuid', 'bus_id' and
+# 'display' (True if a display is attached, i.e. kernels have a watchdog).
+#
+# Several hosts can share one library, so a device slot (mutex, lease and
+# arbiter name) is qualified by host: "dev<index>@<host>".
+
+import os
+import json
+import logging
+
+proc_gpu_dir='/proc/driver/nvidia/gpus'
+
+def slot_name(index,host=None):
+    if host is None:
+        from CTBB_Pipeline.ctbb_pipeline_lease import hostname
+        host=hostname()
+    return 'dev%d@%s' % (index,host)
+
+def slot_index(name):
+    # CUDA device index of a slot ("dev1@host" or plain "dev1")
+    return int(name.split('@',1)[0][3:])
+
+def slot_host(name):
+    return name.split('@',1)[1] if '@' in name else None
+
+def default_inventory_path():
+    if 'CTBB_PIPELINE_DEVICE_INVENTORY' in os.environ:
+        return os.environ['CTBB_PIPELINE_DEVICE_INVENTORY']
+    import tempfile
+    return os.path.join(tempfile.gettempdir(),'ctbb_pipeline_devices_%d.json' % os.getuid())
+
+def boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id','r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def read_inventory(path):
+    ### Cached device list, or None if missing or written before the last boot
+    try:
+        with open(path,'r') as f:
+            inventory=json.load(f)
+    except (OSError,ValueError):
+        return None
+    if inventory.get('boot_id')!=boot_id():
+        return None
+    return inventory.get('devices')
+
+def write_inventory(path,devices):
+    tmp='%s.%d.tmp' % (path,os.getpid())
+    try:
+        with open(tmp,'w') as f:
+            json.dump({'boot_id':boot_id(),'devices':devices},f)
+        os.rename(tmp,path)
+    except OSError as e:
+        logging.warning('Could not write device inventory %s: %s' % (path,e))
+
+def devices_from_proc():
+    if not os.path.isdir(proc_gpu_dir):
+        return None
+    devices=[]
+    # Directory names are PCI bus IDs, so sorting gives PCI bus order
+    for bus_id in sorted(os.listdir(proc_gpu_dir)):
+        info={}
+        try:
+            with open(os.path.join(proc_gpu_dir,bus_id,'information'),'r') as f:
+                for line in f.read().splitlines():
+                    if ':' in line:
+                        k,v=line.split(':',1)
+                        info[k.strip()]=v.strip()
+        except OSError:
+            continue
+        devices.append({'index':len(devices),
+                        'name':info.get('Model','unknown'),
+                        'uuid':info.get('GPU UUID'),
+                        'bus_id':bus_id,
+                        'display':None})
+    return devices
+
+def devices_from_nvidia_smi():
+    import subprocess
+    try:
+        out=subprocess.check_output(['nvidia-smi','--query-gpu=index,name,uuid,pci.bus_id,display_active',
+                                     '--format=csv,noheader'],stderr=subprocess.DEVNULL)
+    except (OSError,subprocess.CalledProcessError):
+        return None
+    devices=[]
+    for line in out.decode('utf-8').splitlines():
+        fields=[s.strip() for s in line.split(',')]
+        if len(fields)<5:
+            continue
+        devices.append({'index':int(fields[0]),'name':fields[1],'uuid':fields[2],
+                        'bus_id':fields[3],'display':fields[4]=='Enabled'})
+    return devices
+
+def devices_from_cuda():
+    try:
+        import pycuda.driver as cuda
+        cuda.init() # Unlike pycuda.autoinit this does not create a context
+    except Exception:
+        return None
+    devices=[]
+    for i in range(cuda.Device.count()):
+        d=cuda.Device(i)
+        attrs=d.get_attributes()
+        devices.append({'index':i,'name':d.name(),'uuid':None,'bus_id':d.pci_bus_id(),
+                        'display':bool(attrs[cuda.device_attribute.KERNEL_EXEC_TIMEOUT])})
+    return devices
+
+def apply_visible_devices(devices,visible):
+    ### Restrict to CUDA_VISIBLE_DEVICES (indices or UUIDs) and renumber
+    if visible is None:
+        return devices
+    selected=[]
+    for token in [t.strip() for t in visible.split(',')]:
+        if not token:
+            break
+        match=None
+        if token.isdigit():
+            match=[d for d in devices if d['index']==int(token)]
+        else:
+            match=[d for d in devices if d.get('uuid') and d['uuid'].startswith(token)]
+        if not match:
+            break # CUDA ignores everything after the first invalid entry
+        if match[0] not in selected:
+            selected.append(match[0])
+    renumbered=[]
+    for i,d in enumerate(selected):
+        d=dict(d)
+        d['physical_index']=d['index']
+        d['index']=i
+        renumbered.append(d)
+    return renumbered
+
+def discover_devices(inventory_path=None,use_cache=True):
+    n_fake=os.environ.get('CTBB_PIPELINE_FAKE_DEVICES')
+    if n_fake:
+        logging.info('Using %s fake devices (CTBB_PIPELINE_FAKE_DEVICES)' % n_fake)
+        return [{'index':i,'name':'fake','uuid':None,'bus_id':None,'display':False} for i in range(int(n_fake))]
+
+    if inventory_path is None:
+        inventory_path=default_inventory_path()
+
+    devices=read_inventory(inventory_path) if use_cache else None
+    if devices is not None:
+        source='inventory %s' % inventory_path
+    else:
+        for source,f in [('/proc',devices_from_proc),('nvidia-smi',devices_from_nvidia_smi),('CUDA driver',devices_from_cuda)]:
+            devices=f()
+            if devices is not None:
+                break
+        if devices is None:
+            logging.error('No way to discover GPUs on this host')
+            return []
+        write_inventory(inventory_path,devices)
+
+    devices=apply_visible_devices(devices,os.environ.get('CUDA_VISIBLE_DEVICES'))
+    logging.info('%d CUDA devices found (%s)' % (len(devices),source))
+    return devices
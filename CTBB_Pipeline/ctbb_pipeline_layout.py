@@ -0,0 +1,424 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_layout.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Directory layout of a library's raw data and recons.
+#
+#     flat     raw/<dose>/<case id>
+#              raw/<raw file name>.prmb
+#              recon/<dose>/<case id>_k<kernel>_st<st>/
+#
+#     sharded  raw/<dose>/ab/cd/<case id>
+#              raw/prmb/ab/cd/<raw file name>.prmb
+#              recon/<dose>/ab/cd/<case id>_k<kernel>_st<st>/
+#
+# where abcd... is the case id (an md5 digest; for PRMBs the md5 of the file
+# name), so that no directory holds more than a few hundred entries however
+# many cases the library has. Set 'layout' in the library's settings.yml;
+# ctbb_pipeline_layout converts an existing library (see migrate).
+#
+# Paths are only ever made here. Existing files are found in either layout,
+# the library's own first, so a library can be used while it is migrated,
+# and by daemons started before its layout changed. New files go where the
+# library's layout puts them.
+
+import os
+import time
+import random
+import filecmp
+import logging
+from glob import glob
+from hashlib import md5
+
+layouts=['flat','sharded']
+
+def get_layout(library):
+    layout=library.settings.get('layout','flat')
+    if layout not in layouts:
+        raise ValueError('Unknown library layout %s (one of %s)' % (layout,', '.join(layouts)))
+    return layout
+
+def shard(name):
+    ### ab/cd of a case id, or of the md5 of any other name
+    if len(name)<4 or any(c not in '0123456789abcdef' for c in name[:4]):
+        name=md5(name.encode('utf-8')).hexdigest()
+    return os.path.join(name[0:2],name[2:4])
+
+def __candidates__(library,parent,name,key=None):
+    flat=os.path.join(parent,name)
+    sharded=os.path.join(parent,shard(key or name),name)
+    return [sharded,flat] if get_layout(library)=='sharded' else [flat,sharded]
+
+def __resolve__(candidates,create):
+    ### The existing path of candidates, else the first (its directory made
+    ### if create)
+    for path in candidates:
+        if os.path.lexists(path):
+            return path
+    if create:
+        os.makedirs(os.path.dirname(candidates[0]),exist_ok=True)
+    return candidates[0]
+
+# Resolver
+
+def raw_filepath(library,dose,case_id,create=False):
+    ### Raw data file of a case at a dose
+    return __resolve__(__candidates__(library,os.path.join(library.raw_dir,str(dose)),case_id),create)
+
+def prmb_filepath(library,filepath,create=False):
+    ### Base parameter file of an original raw file
+    name=os.path.basename(filepath)+'.prmb'
+    flat=os.path.join(library.raw_dir,name)
+    sharded=os.path.join(library.raw_dir,'prmb',shard(name),name)
+    return __resolve__([sharded,flat] if get_layout(library)=='sharded' else [flat,sharded],create)
+
+def study_dirpath(library,case_id,dose,kernel,slice_thickness,create=False):
+    ### Study directory of a recon (its img, log, eval, ... directories)
+    name='%s_k%s_st%s' % (case_id,kernel,slice_thickness)
+    return __resolve__(__candidates__(library,os.path.join(library.recon_dir,str(dose)),name,case_id),create)
+
+def img_filepath(library,case_id,dose,kernel,slice_thickness):
+    ### The .img of a recon's series (see ctbb_pipeline_compress.series_filepath
+    ### for its .imgz)
+    return os.path.join(study_dirpath(library,case_id,dose,kernel,slice_thickness),'img',
+                        '%s_d%s_k%s_st%s.img' % (case_id,dose,kernel,slice_thickness))
+
+# Scans (both layouts; need only the library's path)
+
+study_patterns=[os.path.join('*','*_k*_st*'),os.path.join('*','??','??','*_k*_st*')]
+
+def recon_glob(library_path,*parts):
+    ### glob of parts (e.g. 'img', '*.prm') in every study directory
+    paths=[]
+    for pattern in study_patterns:
+        paths+=glob(os.path.join(library_path,'recon',pattern,*parts))
+    return paths
+
+def study_dirpaths(library_path):
+    return [p for p in recon_glob(library_path) if os.path.isdir(p)]
+
+def raw_filepaths(library_path):
+    ### (dose, case id, path) of every raw data file
+    entries=[]
+    raw_dir=os.path.join(library_path,'raw')
+    for dose in sorted(os.listdir(raw_dir)) if os.path.isdir(raw_dir) else []:
+        if not dose.isdigit():
+            continue
+        for pattern in ['*',os.path.join('??','??','*')]:
+            for p in glob(os.path.join(raw_dir,dose,pattern)):
+                if os.path.isfile(p) and not p.endswith('.tmp'):
+                    entries.append((dose,os.path.basename(p),p))
+    return entries
+
+def prmb_filepaths(library_path):
+    raw_dir=os.path.join(library_path,'raw')
+    return glob(os.path.join(raw_dir,'*.prmb'))+glob(os.path.join(raw_dir,'prmb','??','??','*.prmb'))
+
+def in_layout(path,layout):
+    ### Whether a path found by a scan is where layout puts it
+    parent=os.path.basename(os.path.dirname(path))
+    grandparent=os.path.basename(os.path.dirname(os.path.dirname(path)))
+    sharded=os.path.join(grandparent,parent)==shard(os.path.basename(path))
+    return sharded==(layout=='sharded')
+
+# Migration
+
+def migration_path(library):
+    return os.path.join(library.path,'.proc','layout')
+
+def set_layout(library,layout):
+    ### Record layout in the library's settings.yml, keeping the rest of the
+    ### file as it is
+    settings_filepath=os.path.join(library.path,'settings.yml')
+    lines=[]
+    if os.path.exists(settings_filepath):
+        with open(settings_filepath,'r') as f:
+            lines=f.read().splitlines()
+    lines=[l for l in lines if not l.startswith('layout:')]+['layout: %s' % layout]
+    tmp='%s.%d.tmp' % (settings_filepath,os.getpid())
+    with open(tmp,'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    os.rename(tmp,settings_filepath)
+    library.settings['layout']=layout
+
+def read_migration(library):
+    import yaml
+    if not os.path.exists(migration_path(library)):
+        return None
+    with open(migration_path(library),'r') as f:
+        return yaml.safe_load(f)
+
+def write_migration(library,state):
+    import yaml
+    tmp='%s.%d.tmp' % (migration_path(library),os.getpid())
+    with open(tmp,'w') as f:
+        yaml.safe_dump(state,f,default_flow_style=False)
+    os.rename(tmp,migration_path(library))
+
+def pending(library,layout):
+    ### Entries not where layout puts them: (kind, dose, name, path) with kind
+    ### raw, prmb or study
+    entries=[('raw',dose,case_id,p) for dose,case_id,p in raw_filepaths(library.path)]
+    entries+=[('prmb',None,os.path.basename(p),p) for p in prmb_filepaths(library.path)]
+    for p in study_dirpaths(library.path):
+        dose=os.path.relpath(p,library.recon_dir).split(os.sep)[0]
+        entries.append(('study',dose,os.path.basename(p),p))
+
+    todo=[]
+    for kind,dose,name,path in entries:
+        if kind=='prmb':
+            sharded=os.path.dirname(os.path.dirname(os.path.dirname(path)))==os.path.join(library.raw_dir,'prmb')
+            if sharded!=(layout=='sharded'):
+                todo.append((kind,dose,name,path))
+        elif not in_layout(path,layout):
+            todo.append((kind,dose,name,path))
+    return todo
+
+def destination(library,kind,dose,name,layout):
+    if kind=='prmb':
+        if layout=='sharded':
+            return os.path.join(library.raw_dir,'prmb',shard(name),name)
+        return os.path.join(library.raw_dir,name)
+    parent=os.path.join(library.raw_dir if kind=='raw' else library.recon_dir,dose)
+    case_id=name.split('_')[0]
+    if layout=='sharded':
+        return os.path.join(parent,shard(case_id),name)
+    return os.path.join(parent,name)
+
+class migration_locks:
+    ### Mutexes of the jobs and stage tasks that use an entry, held while it
+    ### is moved so that none of them starts meanwhile. Entries of running
+    ### jobs are left for a later pass.
+    def __init__(self,library):
+        from CTBB_Pipeline.ctbb_pipeline_dag import library_stages
+        self.library=library
+        self.stages=[s['name'] for s in library_stages(library)]
+        self.held=[]
+        self.refresh()
+
+    def refresh(self):
+        from CTBB_Pipeline.pypeline import parse_queue_item
+        self.case_list=self.library.__get_case_list__() # both ways: case id <-> filepath
+        with open(os.path.join(self.library.path,'.proc','active'),'r') as f:
+            active=[parse_queue_item(qi) for qi in f.read().splitlines() if qi]
+        self.active_cases=set(self.case_list.get(item['filepath']) for item in active)
+
+    def mutexes(self,kind,dose,name):
+        from CTBB_Pipeline.pypeline import mutex
+        from CTBB_Pipeline.ctbb_pipeline_dag import task_mutex
+        if kind=='raw':
+            return [mutex('simdose_%s_%s' % (name,dose),self.library.mutex_dir)]
+        if kind=='study':
+            case_id,kernel,st=name.split('_k',1)[0],name.split('_k',1)[1].split('_st')[0],name.split('_st',1)[1]
+            filepath=self.case_list.get(case_id)
+            if filepath is None:
+                return []
+            jid=(filepath,int(float(dose)),int(float(kernel)),float(st))
+            return [task_mutex(self.library,stage,jid) for stage in self.stages]
+        return []
+
+    def acquire(self,kind,dose,name):
+        ### Whether the entry may be moved now (release() when done)
+        case_id=name.split('_')[0]
+        if kind!='prmb' and case_id in self.active_cases:
+            return False
+        self.held=[]
+        for m in self.mutexes(kind,dose,name):
+            if not m.try_lock():
+                self.release()
+                return False
+            self.held.append(m)
+        return True
+
+    def release(self):
+        for m in self.held:
+            m.unlock()
+        self.held=[]
+
+def update_prm_paths(study_path,old_study_path):
+    ### Point OutputDir of the study's PRMs at its new directory
+    for prm in glob(os.path.join(study_path,'img','*.prm')):
+        with open(prm,'r') as f:
+            lines=f.read().splitlines()
+        changed=False
+        for i,line in enumerate(lines):
+            if line.startswith('OutputDir:') and old_study_path in line:
+                lines[i]=line.replace(old_study_path,study_path)
+                changed=True
+        if changed:
+            with open(prm,'w') as f:
+                f.write('\n'.join(lines)+'\n')
+
+def same_contents(path,other):
+    ### Whether two files hold the same bytes (sizes compared first)
+    if os.path.getsize(path)!=os.path.getsize(other):
+        return False
+    return filecmp.cmp(path,other,shallow=False)
+
+def move(library,kind,dose,name,path,layout):
+    ### Move one entry into layout. Returns 'moved', 'duplicate' (the same
+    ### raw file was already there: the old one is removed; of two PRMBs the
+    ### newer is kept) or 'conflict' (two study directories of one recon, or
+    ### two raw files of one name that differ: both are left in place).
+    dest=destination(library,kind,dose,name,layout)
+    if os.path.lexists(dest):
+        if kind=='raw':
+            # Reduced-dose files are named after the case, not their
+            # contents, so the same name does not make them the same data
+            if not same_contents(path,dest):
+                return 'conflict'
+            os.remove(path)
+            return 'duplicate'
+        if kind=='prmb':
+            if os.path.getmtime(path)>os.path.getmtime(dest):
+                os.rename(path,dest)
+            else:
+                os.remove(path)
+            return 'duplicate'
+        return 'conflict'
+    os.makedirs(os.path.dirname(dest),exist_ok=True)
+    os.rename(path,dest)
+    if kind=='study':
+        update_prm_paths(dest,path)
+    if layout=='flat':
+        # Shard directories left empty (and raw/prmb)
+        parents=[os.path.dirname(path),os.path.dirname(os.path.dirname(path))]
+        if kind=='prmb':
+            parents.append(os.path.join(library.raw_dir,'prmb'))
+        for parent in parents:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+    return 'moved'
+
+def migrate(library,layout,rate=0,report=None,stop=None):
+    ### Move a library's raw data and recons into layout, a file or study
+    ### directory at a time (each a single rename), while the library is in
+    ### use. The library's layout is changed first, so new files go to their
+    ### new place; entries of running jobs and stage tasks are skipped.
+    ### Interrupted, or run again later to pick up what was skipped, it
+    ### carries on from where it was. rate: moves per second (0: no limit);
+    ### report(state) is called after each batch; stop() -> True ends early.
+    ### Returns the migration state (.proc/layout).
+    if layout not in layouts:
+        raise ValueError('Unknown library layout %s (one of %s)' % (layout,', '.join(layouts)))
+    set_layout(library,layout)
+
+    state=read_migration(library)
+    if not state or state.get('layout')!=layout:
+        state={'layout':layout,'started':time.time(),'moved':0,'duplicates':0}
+    state.update({'skipped':0,'conflicts':0,'finished':None})
+
+    todo=pending(library,layout)
+    state['remaining']=len(todo)
+    write_migration(library,state)
+    logging.info('Migrating %d entries of %s to the %s layout' % (len(todo),library.path,layout))
+
+    locks=migration_locks(library)
+    batch=100
+    for i,(kind,dose,name,path) in enumerate(todo):
+        if stop is not None and stop():
+            break
+        if i%batch==0 and i>0:
+            locks.refresh()
+            write_migration(library,state)
+            if report is not None:
+                report(state)
+        if not locks.acquire(kind,dose,name):
+            state['skipped']+=1
+            state['remaining']-=1
+            continue
+        try:
+            outcome=move(library,kind,dose,name,path,layout)
+        except OSError as e:
+            logging.warning('Could not move %s: %s' % (path,e))
+            outcome='skipped'
+        finally:
+            locks.release()
+        if outcome=='moved':
+            state['moved']+=1
+        elif outcome=='duplicate':
+            state['duplicates']+=1
+        elif outcome=='conflict':
+            logging.warning('Not moving %s: %s exists' % (path,destination(library,kind,dose,name,layout)))
+            state['conflicts']+=1
+        else:
+            state['skipped']+=1
+        state['remaining']-=1
+        if rate:
+            time.sleep(1.0/rate)
+
+    if state['remaining']==0 and state['skipped']==0 and state['conflicts']==0:
+        state['finished']=time.time()
+    write_migration(library,state)
+    if report is not None:
+        report(state)
+
+    # Series moved: the recon list and catalog hold their paths
+    library.refresh_recon_list()
+    from CTBB_Pipeline.ctbb_pipeline_catalog import series_catalog,catalog_path
+    if os.path.exists(catalog_path(library.path)):
+        series_catalog(library.path).refresh()
+    logging.info('Migration to the %s layout: %s' % (layout,state))
+    return state
+
+# Benchmark
+
+def __time__(f,args):
+    t=time.time()
+    for a in args:
+        f(*a)
+    return (time.time()-t)/max(1,len(args))
+
+def benchmark(library,n_lookups=1000,seed=0):
+    ### Mean time of a resolver lookup (present and absent recons and raw
+    ### files), of listing the largest directory, and of a full scan of the
+    ### library's series (recon_glob, as refresh_recon_list does)
+    rng=random.Random(seed)
+    studies=study_dirpaths(library.path)
+    raws=raw_filepaths(library.path)
+
+    def job(p):
+        dose=os.path.relpath(p,library.recon_dir).split(os.sep)[0]
+        name=os.path.basename(p)
+        case_id,rest=name.split('_k',1)
+        kernel,st=rest.split('_st',1)
+        return (library,case_id,dose,kernel,st)
+
+    present=[job(p) for p in rng.sample(studies,min(n_lookups,len(studies)))]
+    absent=[(library,md5(str(i).encode('utf-8')).hexdigest(),100,1,1.0) for i in range(n_lookups)]
+    raw=[(library,dose,case_id) for dose,case_id,p in rng.sample(raws,min(n_lookups,len(raws)))]
+
+    directories=set(os.path.dirname(p) for p in studies)|set(os.path.dirname(p) for d,c,p in raws)
+    largest=max(directories,key=lambda d:len(os.listdir(d))) if directories else library.recon_dir
+
+    t=time.time()
+    n_series=len(recon_glob(library.path,'img','*.img'))
+    t_scan=time.time()-t
+
+    return {'layout':get_layout(library),
+            'n_studies':len(studies),
+            'n_raw':len(raws),
+            'lookup_present':__time__(lambda *a:os.path.exists(img_filepath(*a)),present),
+            'lookup_absent':__time__(lambda *a:os.path.exists(img_filepath(*a)),absent),
+            'lookup_raw':__time__(lambda *a:os.path.exists(raw_filepath(*a)),raw),
+            'largest_dir':len(os.listdir(largest)),
+            'list_largest_dir':__time__(os.listdir,[(largest,)]),
+            'scan':t_scan,
+            'n_series':n_series}
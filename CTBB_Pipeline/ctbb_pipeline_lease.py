@@ -0,0 +1,179 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_lease.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Leases for active jobs.
+#
+# Every running queue item owns one lease file per device in .proc/leases
+# recording the job, owner PID, host, attempt number and an expiry time.  The
+# owner renews the lease periodically from a background thread.  The daemon
+# treats a lease as dead once it has expired, or immediately if the owner ran
+# on this host and its PID no longer exists, and then reclaims the device.
+
+import os
+import time
+import socket
+import logging
+import threading
+
+def hostname():
+    # CTBB_PIPELINE_HOSTNAME lets several processes on one machine act as
+    # separate hosts sharing a library (for testing)
+    return os.environ.get('CTBB_PIPELINE_HOSTNAME') or socket.gethostname()
+
+def pid_alive(pid):
+    # True if a (non-zombie) process with the given PID exists on this host
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    # Dead children that have not been reaped yet still answer to kill(0)
+    try:
+        with open('/proc/%d/stat' % pid,'r') as f:
+            state=f.read().rsplit(')',1)[1].split()[0]
+        if state=='Z':
+            return False
+    except (IOError,IndexError):
+        pass
+
+    return True
+
+def write_record(path,record):
+    # Write "key: value" lines atomically (readers never see a partial file)
+    tmp_path='%s.%s.%d.tmp' % (path,hostname(),os.getpid())
+    with open(tmp_path,'w') as f:
+        for k,v in record.items():
+            f.write("%s: %s\n" % (str(k),str(v)))
+    os.rename(tmp_path,path)
+
+def read_record(path):
+    record={}
+    with open(path,'r') as f:
+        for line in f.read().splitlines():
+            if ': ' in line:
+                k,v=line.split(': ',1)
+                record[k]=v
+
+    for k in ['pid','attempt']:
+        if k in record:
+            record[k]=int(record[k])
+    for k in ['acquired','expires']:
+        if k in record:
+            record[k]=float(record[k])
+
+    return record
+
+class lease:
+    device=None
+    lease_dir=None
+    lease_file=None
+    duration=None
+    record=None
+    renew_thread=None
+    stop_event=None
+
+    def __init__(self,device,lease_dir,duration=60):
+        self.device=device
+        self.lease_dir=lease_dir
+        self.lease_file=os.path.join(lease_dir,device)
+        self.duration=duration
+        self.stop_event=threading.Event()
+
+    def acquire(self,qi,attempt=1):
+        now=time.time()
+        self.record={
+            'qi':qi,
+            'device':self.device,
+            'pid':os.getpid(),
+            'host':hostname(),
+            'attempt':attempt,
+            'acquired':now,
+            'expires':now+self.duration,
+        }
+        write_record(self.lease_file,self.record)
+        logging.info('Lease on %s acquired for %s (attempt %d)' % (self.device,qi,attempt))
+
+    def renew(self):
+        self.record['expires']=time.time()+self.duration
+        write_record(self.lease_file,self.record)
+        logging.debug('Lease on %s renewed' % self.device)
+
+    def start_renewal(self,interval):
+        ### Renew the lease every "interval" seconds until release() is called
+        def renew_loop():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.renew()
+                except Exception as e:
+                    logging.error('Failed to renew lease on %s: %s' % (self.device,e))
+
+        self.renew_thread=threading.Thread(target=renew_loop,daemon=True)
+        self.renew_thread.start()
+
+    def release(self):
+        self.stop_event.set()
+        if self.renew_thread is not None:
+            self.renew_thread.join()
+        if os.path.exists(self.lease_file):
+            os.remove(self.lease_file)
+        logging.info('Lease on %s released' % self.device)
+
+def read_leases(lease_dir):
+    # Returns all current lease records keyed by device name
+    leases={}
+    if not os.path.isdir(lease_dir):
+        return leases
+
+    for f in os.listdir(lease_dir):
+        if f.endswith('.tmp'):
+            continue
+        try:
+            leases[f]=read_record(os.path.join(lease_dir,f))
+        except (IOError,ValueError):
+            # Lease disappeared or is being rewritten; check again next pass
+            continue
+
+    return leases
+
+def claim_dead_lease(lease_dir,device):
+    ### Atomically take a dead lease out of the lease directory. Returns False
+    ### if another process (possibly on another host) got there first.
+    lease_file=os.path.join(lease_dir,device)
+    claimed='%s.%s.%d.reclaim.tmp' % (lease_file,hostname(),os.getpid())
+    try:
+        os.rename(lease_file,claimed)
+    except OSError:
+        return False
+    os.remove(claimed)
+    return True
+
+def is_dead(record,now=None):
+    # A lease is dead if it expired, or if its owner ran here and has exited
+    if now is None:
+        now=time.time()
+
+    if record.get('expires',0)<now:
+        return True
+
+    if record.get('host')==hostname() and not pid_alive(record.get('pid',-1)):
+        return True
+
+    return False
@@ -19,15 +19,13 @@
 
 import sys
 import os
-import shutil
 import logging
 from subprocess import call
 import time
 from time import strftime
 from glob import glob
 
-import random
-import tempfile
+import threading
 from hashlib import md5
 
 import traceback
@@ -36,17 +34,56 @@ import traceback
 #from pypeline import mutex
 from CTBB_Pipeline import pypeline as pype
 from CTBB_Pipeline.pypeline import mutex
+from CTBB_Pipeline.ctbb_pipeline_lease import hostname
+from CTBB_Pipeline.ctbb_pipeline_cpu import cpu_stage
+from CTBB_Pipeline import ctbb_pipeline_layout as layout
+from CTBB_Pipeline import ctbb_pipeline_usage as usage
+
+# Library-wide settings. Any of these can be overridden by a "settings.yml"
+# file in the library root directory.
+default_settings={
+    'lease_duration'       : 60, # seconds before an un-renewed job lease is considered dead
+    'lease_renew_interval' : 10, # seconds between lease renewals by a running job
+    'use_arbiter'          : True, # share devices with other libraries through the host-wide arbiter
+    'arbiter_weight'       : 1,    # fair-share weight of this library on the arbiter
+    'retry_policies'       : {},   # per-qi_status overrides of ctbb_pipeline_retry.default_retry_policies
+    'quarantine_threshold' : 3,    # failed jobs after which a raw file is quarantined
+    'staging_dir'          : None, # local scratch directory for raw data (None: read in place)
+    'staging_capacity'     : 100e9,# bytes kept in the staging directory
+    'staging_prefetch'     : 4,    # queued jobs whose raw data the daemon prefetches
+    'staging_concurrency'  : 2,    # simultaneous prefetch copies
+    'staging_bandwidth'    : 0,    # prefetch bytes/s across all copies (0: unlimited)
+    'dispatch_policy'      : 'fifo', # ctbb_pipeline_scheduler policy choosing the next job for a device ('locality': opt in)
+    'eta_interval'         : 30,   # seconds between updates of the runtime model and queue ETA
+    'cpu_affinity'         : True, # pin each job to cores near its GPU (NUMA node from /sys)
+    'cpu_stages'           : {},   # per-stage overrides of ctbb_pipeline_cpu.default_stage_settings
+    'compress_recons'      : False,# convert each finished series to int16 .imgz on the daemon's io pool (ctbb_pipeline_compress, ctbb_pipeline_dag)
+    'compress_keep_img'    : False,# keep the float32 .img next to its .imgz
+    'preempt_priority'     : 1,    # queued jobs of this priority or more preempt lower ones (None: never)
+    'stop_grace'           : 60,   # seconds a cancelled/preempted job has to exit before it is killed
+    'stages'               : {},   # stages run after each job's recon (ctbb_pipeline_dag)
+    'stage_pools'          : {},   # per-host workers of each stage resource class (see ctbb_pipeline_dag)
+    'campaign_window'      : 1000, # queued jobs the daemon keeps expanded from campaigns (ctbb_pipeline_campaign)
+    'layout'               : 'flat', # 'flat' or 'sharded' raw/ and recon/ directories (ctbb_pipeline_layout)
+    'ingest_concurrency'   : 4,    # raw files copied and hashed at once when a campaign is launched
+    'recon_store_dir'      : None, # local directory of the GUI's recon index (None: ~/.cache/ctbb_pipeline)
+}
+
+ingest_chunk_size=4<<20
 
 class ctbb_pipeline_library:
     path=None;
     mutex_dir=None;    
+    lease_dir=None;
     raw_dir=None;
     recon_dir=None;
     log_dir=None;
+    settings=None;
 
     def __init__(self,path):
         self.path=path;
         self.mutex_dir=os.path.join(path,'.proc','mutex');
+        self.lease_dir=os.path.join(path,'.proc','leases');
         self.raw_dir=os.path.join(path,'raw');
         self.recon_dir=os.path.join(path,'recon');
         self.log_dir=os.path.join(path,'log');
@@ -59,6 +96,8 @@ class ctbb_pipeline_library:
         
             self.load()
 
+        self.load_settings()
+
     def initialize_new_library(self):
         touch(os.path.join(self.path,'.ctbb_pipeline_lib'))
         touch(os.path.join(self.path,'case_list.txt'))
@@ -71,6 +110,7 @@ class ctbb_pipeline_library:
         os.mkdir(os.path.join(self.path,'eval'))
         os.mkdir(os.path.join(self.path,'.proc'))
         os.mkdir(os.path.join(self.path,'.proc','mutex'))
+        os.mkdir(os.path.join(self.path,'.proc','leases'))
         touch(os.path.join(self.path,'.proc','queue'))
         touch(os.path.join(self.path,'.proc','active'))        
         touch(os.path.join(self.path,'.proc','done'))
@@ -98,6 +138,7 @@ class ctbb_pipeline_library:
         tf = tf and os.path.isdir(os.path.join(self.path,'eval'))        
         tf = tf and os.path.isdir(os.path.join(self.path,'.proc'))
         tf = tf and os.path.isdir(os.path.join(self.path,'.proc','mutex'))        
+        tf = tf and os.path.isdir(os.path.join(self.path,'.proc','leases'))
         tf = tf and os.path.exists(os.path.join(self.path,'.proc','queue'))
         tf = tf and os.path.exists(os.path.join(self.path,'.proc','active'))        
         tf = tf and os.path.exists(os.path.join(self.path,'.proc','done'))
@@ -110,6 +151,49 @@ class ctbb_pipeline_library:
         # Check the case list vs raw data files present?
 
         # Update recon list from files present?
+
+    def load_settings(self):
+        self.settings=dict(default_settings)
+        settings_filepath=os.path.join(self.path,'settings.yml')
+        if os.path.exists(settings_filepath):
+            import yaml
+            with open(settings_filepath,'r') as f:
+                user_settings=yaml.safe_load(f)
+            if user_settings:
+                self.settings.update(user_settings)
+        return self.settings
+
+    def get_arbiter(self):
+        # Host-wide GPU arbiter for this library (None if disabled in settings)
+        if not self.settings['use_arbiter']:
+            return None
+        from CTBB_Pipeline.ctbb_pipeline_arbiter import gpu_arbiter
+        return gpu_arbiter(self.path,self.settings['arbiter_weight'])
+
+    def get_staging(self):
+        # Local scratch staging area for raw data (None if not configured)
+        if not self.settings['staging_dir']:
+            return None
+        from CTBB_Pipeline.ctbb_pipeline_staging import staging_area
+        return staging_area(self.settings['staging_dir'],
+                            self.settings['staging_capacity'],
+                            self.settings['staging_bandwidth'])
+
+    def add_active_job(self,qi):
+        with mutex('active',self.mutex_dir):
+            with open(os.path.join(self.path,'.proc','active'),'a') as f:
+                f.write('%s\n' % qi)
+
+    def remove_active_job(self,qi):
+        with mutex('active',self.mutex_dir):
+            active_filepath=os.path.join(self.path,'.proc','active')
+            with open(active_filepath,'r') as f:
+                active=f.read().splitlines()
+            if qi in active:
+                active.remove(qi)
+            with open(active_filepath,'w') as f:
+                for item in active:
+                    f.write('%s\n' % item)
                                                            
     def repair(self):
         touch(os.path.join(self.path,'.ctbb_pipeline_lib'))
@@ -131,6 +215,8 @@ class ctbb_pipeline_library:
             os.mkdir(os.path.join(self.path,'.proc'))
         if not os.path.isdir(os.path.join(self.path,'.proc','mutex')):            
             os.mkdir(os.path.join(self.path,'.proc','mutex'))
+        if not os.path.isdir(os.path.join(self.path,'.proc','leases')):
+            os.mkdir(os.path.join(self.path,'.proc','leases'))
             
         touch(os.path.join(self.path,'.proc','queue'))
         touch(os.path.join(self.path,'.proc','active'))        
@@ -138,35 +224,97 @@ class ctbb_pipeline_library:
         touch(os.path.join(self.path,'.proc','error'))
 
     def locate_raw_data(self,filepath):
-        #case_list_mutex=mutex('case_list',self.mutex_dir)
-        #case_list_mutex.lock()
-
-        with mutex('case_list',self.mutex_dir) as case_list_mutex:
-        
-            # Returns either a hash value (of raw file) or "False" if raw data unavailable
+        # Returns either a hash value (of raw file) or "False" if raw data unavailable
+        with mutex('case_list',self.mutex_dir):
             case_list=self.__get_case_list__()
-            
-            # Check if we already have file in library
-            if filepath in case_list.keys():
-                logging.info('File %s (%s) found case library' % (filepath,case_list[filepath]))
-                case_id=case_list[filepath]
-            else:
-                if os.path.exists(filepath):
-                    local_file_info=self.__get_local_file_hash__(filepath)
-            
-                    digest=local_file_info[0]
-                    tmp_path=local_file_info[1]
-                    if not (digest in case_list.keys()):
-                        logging.info('Adding raw data file to library')
-                        self.__add_raw_data__(filepath,tmp_path,digest)
-                    case_id=digest;
-                else:
-                    # Requested file does not exist
-                    logging.info('Requested raw data file does not exist')
-                    case_id=False            
-        
+
+        # Check if we already have file in library
+        if filepath in case_list.keys():
+            logging.info('File %s (%s) found case library' % (filepath,case_list[filepath]))
+            return case_list[filepath]
+
+        if not os.path.exists(filepath):
+            # Requested file does not exist
+            logging.info('Requested raw data file does not exist')
+            return False
+
+        # Copied and hashed outside the case_list mutex, which every other job
+        # needs, and only added to the case list under it (jobs fetching the
+        # same file at once copy it to the same place)
+        logging.info('Adding raw data file to library')
+        with cpu_stage(self,'fetch_raw'):
+            # Read from the staged copy when there is one
+            staging=self.get_staging()
+            source=staging.stage(filepath,pin=True) if staging is not None else filepath
+            case_id=self.__ingest_raw_file__(source)
+        self.__publish_case_list__({filepath:case_id})
         return case_id
 
+    def ingest_raw_data(self,filepaths,concurrency=None,progress=None,interval=1.0,stop=None):
+        # Copy and hash the raw files of filepaths not in the library yet,
+        # several at a time, and add them to the case list in one go, so that
+        # jobs find their raw data in place instead of each fetching it under
+        # the case_list mutex. progress(status) is called every interval
+        # seconds (see ingest_status). Once stop() returns True, files not
+        # started are skipped and copies under way are abandoned (the files
+        # already ingested are still added). Returns {filepath: case id} of
+        # the files added.
+        from concurrent.futures import ThreadPoolExecutor,wait
+        if concurrency is None:
+            concurrency=self.settings['ingest_concurrency']
+
+        with mutex('case_list',self.mutex_dir):
+            case_list=self.__get_case_list__()
+        todo=[]
+        for f in filepaths:
+            if f and f not in case_list and f not in todo and os.path.exists(f):
+                todo.append(f)
+        if not todo:
+            return {}
+
+        status={'n_total':len(todo),'n_done':0,'n_failed':0,
+                'bytes_total':sum([os.path.getsize(f) for f in todo]),'bytes_done':0,
+                'elapsed':0.0,'eta':None}
+        lock=threading.Lock()
+        def advance(n):
+            with lock:
+                status['bytes_done']+=n
+
+        logging.info('Ingesting %d raw data files (%d bytes), %d at a time' % (len(todo),status['bytes_total'],concurrency))
+        start=time.time()
+        case_ids={}
+        with ThreadPoolExecutor(max_workers=max(1,int(concurrency))) as pool:
+            futures={pool.submit(self.__ingest_raw_file__,f,advance,stop):f for f in todo}
+            pending=set(futures)
+            stopped=False
+            while pending:
+                finished,pending=wait(pending,timeout=interval)
+                for future in finished:
+                    if future.cancelled():
+                        continue
+                    try:
+                        case_ids[futures[future]]=future.result()
+                        status['n_done']+=1
+                    except ingest_stopped:
+                        pass
+                    except (IOError,OSError) as e:
+                        logging.warning('Could not ingest %s: %s' % (futures[future],e))
+                        status['n_failed']+=1
+                if not stopped and stop is not None and stop():
+                    logging.info('Ingestion stopped with %d of %d files done' % (status['n_done'],status['n_total']))
+                    stopped=True
+                    for future in pending:
+                        future.cancel()
+                with lock:
+                    status['elapsed']=time.time()-start
+                    if status['bytes_done']>0:
+                        status['eta']=status['elapsed']*(status['bytes_total']-status['bytes_done'])/status['bytes_done']
+                    if progress is not None:
+                        progress(dict(status))
+
+        self.__publish_case_list__(case_ids)
+        return case_ids
+
     def locate_reduced_dose_data(self,filepath,dose):
         logging.info('Checking for reduced dose data')
 
@@ -176,27 +324,38 @@ class ctbb_pipeline_library:
         #case_list_mutex.lock()
 
         with mutex('case_list',self.mutex_dir) as case_list_mutex:
-
             case_list=self.__get_case_list__()
-            
-            case_id=case_list[filepath]
-            logging.info('Case ID for current case is %s' % case_id)
-            full_dose_filepath=os.path.join(self.raw_dir,'100',case_id)
-            reduced_dose_filepath=os.path.join(self.raw_dir,str(dose),case_id)
-            
-            # If reduction dir doesn't exist, create it.
-            if not os.path.isdir(os.path.join(self.raw_dir,str(dose))):
-                os.mkdir(os.path.join(self.raw_dir,str(dose)))
-            
+
+        case_id=case_list[filepath]
+        logging.info('Case ID for current case is %s' % case_id)
+        full_dose_filepath=layout.raw_filepath(self,100,case_id)
+
+        # Creates the reduction dir if it doesn't exist
+        reduced_dose_filepath=layout.raw_filepath(self,dose,case_id,create=True)
+
+        # Only one job runs the dose reduction for a given case and dose; the
+        # others wait for it, while reductions of other cases go ahead
+        with mutex('simdose_%s_%s' % (case_id,dose),self.mutex_dir):
             if os.path.exists(reduced_dose_filepath):
                 logging.info('Reduced dose data found')
             else:
                 logging.info('Reduced dose data not found.  Running dose reduction tool.')
-                system_call="ctbb_simdose %s %s %s" % ( full_dose_filepath,str(dose),reduced_dose_filepath )
+                staging=self.get_staging()
+                if staging is not None:
+                    full_dose_filepath=staging.stage(full_dose_filepath,pin=True)
+                # Written under a temporary name so that the reduced dose file
+                # only ever appears complete
+                tmp_filepath='%s.%s.%d.tmp' % (reduced_dose_filepath,hostname(),os.getpid())
+                system_call="ctbb_simdose %s %s %s" % ( full_dose_filepath,str(dose),tmp_filepath )
                 logging.info('Sending the following call to system: %s' % system_call);
-                exit_status=self.__child_process__(system_call)
+                with cpu_stage(self,'dose_reduction') as stage:
+                    exit_status=self.__child_process__(system_call,stage.prefix(),'dose_reduction')
                 logging.info('Dose reduction job exited with exit status %s' % str(exit_status))
-           
+                if exit_status==0:
+                    os.rename(tmp_filepath,reduced_dose_filepath)
+                elif os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+
         return exit_status
 
     def get_recon_list(self):
@@ -220,11 +379,18 @@ class ctbb_pipeline_library:
         # Get list of all IMG files in recon directory
         #paths=glob(os.path.join(self.path,'recon','*/*/*.img'))
         #print("Searching for IMG files...")        
-        paths=glob(os.path.join(self.path,'recon','*','*','*','*.img'))
+        paths=layout.recon_glob(self.path,'*','*.img')
+
+        # Compressed series (see ctbb_pipeline_compress), unless the .img of
+        # the same series is still there
+        from CTBB_Pipeline.ctbb_pipeline_compress import extension
+        stems=set(os.path.splitext(p)[0] for p in paths)
+        paths+=[p for p in layout.recon_glob(self.path,'*','*'+extension)
+                if os.path.splitext(p)[0] not in stems]
 
         if not paths:
             #print("Searching for HR2 files...")
-            paths=glob(os.path.join(self.path,'recon','*','*','*','*.hr2'))
+            paths=layout.recon_glob(self.path,'*','*.hr2')
         
         # Parse paths into sensible things:
         filenames=[]
@@ -247,28 +413,81 @@ class ctbb_pipeline_library:
 
             csv_entries[i]=curr_item
 
+        # Written whole and renamed into place, so that readers (e.g. the
+        # GUI's recon store, see get_recon_store) never see part of it
         import csv        
-        with open(os.path.join(self.path,'recons.csv'),'w',newline='') as f:
+        csv_filepath=os.path.join(self.path,'recons.csv')
+        tmp_filepath='%s.%s.%d.tmp' % (csv_filepath,hostname(),os.getpid())
+        with open(tmp_filepath,'w',newline='') as f:
         #with open(os.path.join(self.path,'recons.csv'),'w') as f:            
             wr=csv.writer(f,quoting=csv.QUOTE_MINIMAL,lineterminator=os.linesep)
             wr.writerow(['org_raw_filepath','pipeline_id','dose','kernel','slice_thickness','img_series_filepath'])
             for c in csv_entries:
                 wr.writerow(c)
+        os.rename(tmp_filepath,csv_filepath)
+
+    def get_recon_store(self):
+        # Opens a new connection to this host's copy of recons.csv, updated
+        # from it first; callers should close() it when done and call
+        # update_recon_store to pick up later changes
+        from CTBB_Pipeline.ctbb_pipeline_recon_store import recon_store,store_path
+        store=recon_store(store_path(self.path,self.settings['recon_store_dir']))
+        self.update_recon_store(store)
+        return store
+
+    def update_recon_store(self,store):
+        return store.update_from_csv(os.path.join(self.path,'recons.csv'))
             
-    def __add_raw_data__(self,filepath_org,filepath_tmp,digest):
-        out_dir=os.path.join(self.path,'raw','100')
-        if not os.path.isdir(out_dir):
-            os.mkdir(out_dir)
-        
-        #os.rename(filepath_tmp,os.path.join(out_dir,digest))
-        shutil.move(filepath_tmp,os.path.join(out_dir,digest))
-        self.__add_to_case_list__(filepath_org,digest)
-
-    def __add_to_case_list__(self,filepath,digest):
-        logging.info("Adding %s:%s to case list" % (digest,filepath))
-        with open(os.path.join(self.path,'case_list.txt'),'a') as f:
-            f.write("%s,%s\n" % (filepath,digest))
-        
+    def __ingest_raw_file__(self,filepath,advance=None,stop=None):
+        # One pass over the source: copied next to its final place (so that
+        # the rename is atomic) and hashed on the way
+        out_dir=os.path.join(self.raw_dir,'100')
+        os.makedirs(out_dir,exist_ok=True)
+        tmp_filepath=os.path.join(out_dir,'ingest.%s.%d.%d.tmp' % (hostname(),os.getpid(),threading.get_ident()))
+        h=md5()
+        try:
+            with open(filepath,'rb') as f_src, open(tmp_filepath,'wb') as f_dst:
+                while True:
+                    if stop is not None and stop():
+                        raise ingest_stopped(filepath)
+                    chunk=f_src.read(ingest_chunk_size)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    f_dst.write(chunk)
+                    if advance is not None:
+                        advance(len(chunk))
+            digest=h.hexdigest()
+            out_filepath=layout.raw_filepath(self,100,digest,create=True)
+            if os.path.exists(out_filepath):
+                os.remove(tmp_filepath) # Same data under another name
+            else:
+                os.rename(tmp_filepath,out_filepath)
+        except:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+        return digest
+
+    def __publish_case_list__(self,case_ids):
+        # Add {filepath: case id} to the case list at once: readers see all
+        # of them or none
+        with mutex('case_list',self.mutex_dir):
+            case_list=self.__get_case_list__()
+            new=[(f,case_ids[f]) for f in sorted(case_ids) if f not in case_list]
+            if not new:
+                return
+            case_list_filepath=os.path.join(self.path,'case_list.txt')
+            with open(case_list_filepath,'r') as f:
+                content=f.read()
+            if content and not content.endswith('\n'):
+                content+='\n'
+            tmp_filepath='%s.%s.%d.tmp' % (case_list_filepath,hostname(),os.getpid())
+            with open(tmp_filepath,'w') as f:
+                f.write(content+''.join(['%s,%s\n' % (filepath,digest) for filepath,digest in new]))
+            os.rename(tmp_filepath,case_list_filepath)
+        logging.info('Added %d files to the case list' % len(new))
+
     def __get_case_list__(self):
         # Returns current case list as dictionary with filepaths as keys and file hashes as values
         case_list_dict={}
@@ -287,27 +506,31 @@ class ctbb_pipeline_library:
 
         return case_list_dict
 
-    def __get_local_file_hash__(self,filepath):
-        # Copy file to temporary location
-        tmp_filepath=os.path.join(tempfile.mkdtemp(),str(random.getrandbits(128)))
-        logging.debug('Temporary path to file: %s' % tmp_filepath)
-        shutil.copy(filepath,tmp_filepath)
-        logging.info("Computing hash of %s" % filepath)
-        
-        with open(tmp_filepath,'rb') as f:
-            digest=md5(f.read()).hexdigest()
-
-        return (digest,tmp_filepath)
-
-    def __child_process__(self,c):
-        import subprocess
+    def __child_process__(self,c,prefix=(),stage=None):
         exit_code=0
-        devnull=open('/dev/null','w')        
-        exit_code=os.system("%s > /dev/null 2>&1" % c); # Blocking call? // 
-        #subprocess.Popen(c.split(' '),stderr=devnull,stdout=devnull) # non-blocking
+        # Blocking call; prefix (e.g. nice/ionice, see ctbb_pipeline_cpu) is
+        # put in front of the command. Its resource use goes in the log (see
+        # ctbb_pipeline_usage)
+        command=c.split()[0] if c.split() else ''
+        exit_code,record=usage.run(' '.join(list(prefix)+[c]),shell=True,command=command)
         logging.debug('System call exited with status %s' % str(exit_code))
+        usage.log_usage(stage or record['command'],record)
         return exit_code
                   
+class ingest_stopped(Exception):
+    ### A raw file's ingestion abandoned at the caller's request
+    pass
+
+def ingest_status(status):
+    ### One line summary of ingest_raw_data's progress
+    s='{n_done}/{n_total} files, {:.1f}/{:.1f} GB'.format(status['bytes_done']/1e9,status['bytes_total']/1e9,**status)
+    if status['n_failed']:
+        s+=', {} failed'.format(status['n_failed'])
+    if status['eta'] is not None and status['n_done']+status['n_failed']<status['n_total']:
+        eta=int(status['eta'])
+        s+=', ETA {}:{:02d}:{:02d}'.format(eta//3600,(eta%3600)//60,eta%60)
+    return s
+
 def touch(path):
     with open(path,'a'):
         os.utime(path,None);
@@ -0,0 +1,174 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_preview.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# QA preview stage: PNG previews of each series for the "quick review" QA
+# documents (ctbb_pipeline_qa_docs), written to the study's qa/ directory:
+#
+#     image.png    - middle axial slice
+#     mip.png      - axial maximum intensity projection
+#     coronal.png  - coronal reformat through the middle of the image
+#
+# The middle slice is read on its own from the memory-mapped series; the MIP
+# and the coronal reformat are built together in one pass over z-slabs. A
+# window/level is applied with NumPy and the PNGs are written by a minimal
+# 8-bit grayscale encoder (zlib only), so matplotlib is not needed. Series
+# are processed in parallel on a process pool, skipping those whose previews
+# are newer than the image data.
+
+import os
+import zlib
+import struct
+import logging
+
+import numpy as np
+
+from CTBB_Pipeline.pypeline import pipeline_img_series,map_series
+
+# Named (window, level) presets in HU
+windows={'lung':(1500,-600),
+         'mediastinum':(350,50),
+         'soft':(400,40),
+         'bone':(2000,400)}
+default_window='lung'
+
+preview_names=['image','mip','coronal']
+default_slab_size=32
+
+def encode_png(image):
+    ### 8-bit grayscale PNG of a 2D uint8 array, as bytes
+    image=np.ascontiguousarray(image,dtype=np.uint8)
+    height,width=image.shape
+
+    def chunk(tag,data):
+        return (struct.pack('>I',len(data))+tag+data+
+                struct.pack('>I',zlib.crc32(tag+data) & 0xffffffff))
+
+    # Each scanline is prefixed with its filter type (0: none)
+    raw=np.zeros((height,width+1),dtype=np.uint8)
+    raw[:,1:]=image
+
+    return (b'\x89PNG\r\n\x1a\n'+
+            chunk(b'IHDR',struct.pack('>IIBBBBB',width,height,8,0,0,0,0))+
+            chunk(b'IDAT',zlib.compress(raw.tobytes(),6))+
+            chunk(b'IEND',b''))
+
+def write_png(filepath,image):
+    ### Write a 2D uint8 array as an 8-bit grayscale PNG
+    tmp='%s.%d.tmp' % (filepath,os.getpid())
+    with open(tmp,'wb') as f:
+        f.write(encode_png(image))
+    os.rename(tmp,filepath)
+
+def window_level(hu,window,level):
+    ### Map HU to 0-255 for display
+    lo=level-window/2.0
+    out=(np.asarray(hu,dtype=np.float32)-lo)*(255.0/window)
+    np.clip(out,0,255,out=out)
+    return out.astype(np.uint8)
+
+def series_paths(img_filepath):
+    # Returns the preview filepaths of a series (the study's qa/ directory)
+    study_dirpath=os.path.dirname(os.path.dirname(os.path.abspath(img_filepath)))
+    qa_dirpath=os.path.join(study_dirpath,'qa')
+    paths={'qa':qa_dirpath}
+    for name in preview_names:
+        paths[name]=os.path.join(qa_dirpath,name+'.png')
+    return paths
+
+def is_up_to_date(img_filepath):
+    # Previews are current if every one is newer than the image data
+    img_mtime=os.path.getmtime(img_filepath)
+    for name in preview_names:
+        p=series_paths(img_filepath)[name]
+        if not os.path.exists(p) or os.path.getmtime(p)<img_mtime:
+            return False
+    return True
+
+def reformat_aspect(image,slice_spacing,pixel_size):
+    # Stretch the rows (slices) of a reformat so that z has the same scale as
+    # x, by nearest neighbour
+    n=image.shape[0]
+    if n<2 or pixel_size<=0 or slice_spacing<=0:
+        return image
+    n_rows=max(1,int(round((n-1)*slice_spacing/pixel_size))+1)
+    rows=np.rint(np.linspace(0,n-1,n_rows)).astype(np.int64)
+    return image[rows]
+
+def preview_series(img_filepath,window=None,level=None,slab_size=default_slab_size):
+    ### Write the preview PNGs of one series. Returns their filepaths.
+    if window is None or level is None:
+        window,level=windows[default_window]
+
+    series=pipeline_img_series(img_filepath,os.path.splitext(img_filepath)[0]+'.prm')
+    header=series.header
+    n=header.NoOfSlices
+    if not n:
+        raise ValueError('No slices in %s' % img_filepath)
+
+    paths=series_paths(img_filepath)
+    if not os.path.isdir(paths['qa']):
+        os.makedirs(paths['qa'])
+
+    # Middle axial slice: a single slice read from the memory map
+    mid=series.read_slab(n//2,n//2+1)[0]
+
+    # MIP and coronal reformat in one pass over the volume
+    row=header.Height//2
+    mip=None
+    coronal=np.zeros((n,header.Width),dtype=np.float32)
+    for start,slab in series.iter_slabs(slab_size):
+        slab_max=slab.max(axis=0)
+        mip=slab_max if mip is None else np.maximum(mip,slab_max)
+        coronal[start:start+slab.shape[0]]=slab[:,row,:]
+
+    # Superior at the top, as the scanner's table moves into the gantry
+    if n>1 and header.EndPos<header.StartPos:
+        coronal=coronal[::-1]
+    slice_spacing=abs(header.EndPos-header.StartPos)/(n-1) if n>1 else 0
+    pixel_size=header.ReconstructionDiameter/float(header.Width) if header.ReconstructionDiameter else 0
+    coronal=reformat_aspect(coronal,slice_spacing,pixel_size)
+
+    write_png(paths['image'],window_level(mid,window,level))
+    write_png(paths['mip'],window_level(mip,window,level))
+    write_png(paths['coronal'],window_level(coronal,window,level))
+    return [paths[name] for name in preview_names]
+
+def preview_library(library,n_processes=None,force=False,**kwargs):
+    ### Write the previews of every IMG series in a pipeline library that does
+    ### not have current ones, on a process pool. Returns {img_filepath: paths
+    ### or None if it failed} for the series processed.
+    library.refresh_recon_list()
+    recon_list=library.get_recon_list()
+
+    img_filepaths=[r['img_series_filepath'] for r in recon_list
+                   if r['img_series_filepath'].endswith(('.img','.imgz')) and os.path.exists(r['img_series_filepath'])]
+    todo=[p for p in img_filepaths if force or not is_up_to_date(p)]
+
+    logging.info('Writing previews of %d of %d series' % (len(todo),len(img_filepaths)))
+
+    results={}
+    if todo:
+        for img_filepath,paths in map_series(preview_series,todo,n_processes,**kwargs):
+            results[img_filepath]=paths
+
+    n_failed=len([p for p in results if results[p] is None])
+    if n_failed:
+        logging.warning('%d series failed preview' % n_failed)
+
+    return results
@@ -0,0 +1,290 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_recon_store.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Indexed store of a library's reconstructions.
+#
+# Holds the same rows as recons.csv in an SQLite table with an index on each
+# column the GUI sorts or filters by, so that a page of a sorted, filtered
+# view is an index lookup rather than a sort of the whole list in Python.
+#
+# The store is a cache on local disk (SQLite's locking is not safe on NFS,
+# where libraries usually live): one per library per host, in the library's
+# 'recon_store_dir' setting, or ~/.cache/ctbb_pipeline. recons.csv stays the
+# shared copy; update_from_csv brings the store up to date with it whenever
+# it has been rewritten.
+#
+# Every row carries a sequence number, and removed rows are kept in a short
+# log, so that viewers can ask for the changes since the last sequence number
+# they saw instead of re-reading everything.
+
+import os
+import csv
+import sqlite3
+from hashlib import md5
+
+columns=['org_raw_filepath','pipeline_id','dose','kernel','slice_thickness','img_series_filepath']
+sort_columns=['org_raw_filepath','pipeline_id','dose','kernel','slice_thickness','img_series_filepath']
+n_removed_log=10000 # Removed rows remembered for incremental updates
+
+schema='''
+CREATE TABLE IF NOT EXISTS recons (
+    img_series_filepath TEXT PRIMARY KEY,
+    org_raw_filepath    TEXT,
+    pipeline_id         TEXT,
+    dose                NUMERIC,
+    kernel              NUMERIC,
+    slice_thickness     NUMERIC,
+    seq                 INTEGER,
+    csv_row             TEXT
+);
+CREATE INDEX IF NOT EXISTS recons_org_raw_filepath ON recons (org_raw_filepath,img_series_filepath);
+CREATE INDEX IF NOT EXISTS recons_pipeline_id      ON recons (pipeline_id,img_series_filepath);
+CREATE INDEX IF NOT EXISTS recons_dose             ON recons (dose,img_series_filepath);
+CREATE INDEX IF NOT EXISTS recons_kernel           ON recons (kernel,img_series_filepath);
+CREATE INDEX IF NOT EXISTS recons_slice_thickness  ON recons (slice_thickness,img_series_filepath);
+CREATE INDEX IF NOT EXISTS recons_seq              ON recons (seq);
+CREATE TABLE IF NOT EXISTS removed (
+    seq                 INTEGER PRIMARY KEY,
+    added_seq           INTEGER,
+    img_series_filepath TEXT,
+    org_raw_filepath    TEXT,
+    pipeline_id         TEXT,
+    dose                NUMERIC,
+    kernel              NUMERIC,
+    slice_thickness     NUMERIC
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value INTEGER
+);
+INSERT OR IGNORE INTO meta VALUES ('seq',0);
+INSERT OR IGNORE INTO meta VALUES ('pruned',0);
+INSERT OR IGNORE INTO meta VALUES ('csv_mtime',0);
+INSERT OR IGNORE INTO meta VALUES ('csv_size',-1);
+'''
+
+def cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME',os.path.expanduser('~/.cache')),'ctbb_pipeline')
+
+def store_path(library_path,store_dir=None):
+    ### Local store of a library: named after the library's absolute path
+    library_path=os.path.abspath(library_path)
+    name='recons_%s_%s.db' % (os.path.basename(library_path.rstrip(os.sep)),md5(library_path.encode('utf-8')).hexdigest()[:16])
+    return os.path.join(store_dir or cache_dir(),name)
+
+def csv_row(r):
+    # Rows are compared as written in recons.csv, since SQLite stores numeric
+    # columns in its own form
+    return '\t'.join([str(r[c]) for c in columns])
+
+class view:
+    ### A sorted, filtered view of the store. Filters are a dictionary of
+    ### column -> list of accepted values, plus an optional 'case' entry that
+    ### is matched as a prefix of the pipeline ID or original raw filepath.
+    sort_column=None
+    descending=None
+    filters=None
+
+    def __init__(self,sort_column='img_series_filepath',descending=False,filters=None):
+        if sort_column not in sort_columns:
+            raise ValueError('Cannot sort by %s' % sort_column)
+        self.sort_column=sort_column
+        self.descending=descending
+        self.filters=dict(filters) if filters else {}
+
+    def where(self,table='recons'):
+        clauses=[]
+        args=[]
+        for column,values in self.filters.items():
+            if column=='case':
+                # Prefix match written as a range so that it uses the index
+                clauses.append('((pipeline_id>=? AND pipeline_id<?) OR (org_raw_filepath>=? AND org_raw_filepath<?))')
+                args+=[values,values+'\uffff',values,values+'\uffff']
+            elif column in columns:
+                if not values:
+                    continue
+                clauses.append('%s.%s IN (%s)' % (table,column,','.join('?'*len(values))))
+                args+=list(values)
+            else:
+                raise ValueError('Cannot filter by %s' % column)
+        return clauses,args
+
+    def order_by(self):
+        direction='DESC' if self.descending else 'ASC'
+        if self.sort_column=='img_series_filepath':
+            return 'img_series_filepath %s' % direction
+        return '%s %s, img_series_filepath %s' % (self.sort_column,direction,direction)
+
+    def before(self,row):
+        ### Clause selecting rows that sort before row (a dictionary) in this view
+        op='>' if self.descending else '<'
+        if self.sort_column=='img_series_filepath':
+            return 'img_series_filepath %s ?' % op,[row['img_series_filepath']]
+        c=self.sort_column
+        return ('(%s %s ? OR (%s = ? AND img_series_filepath %s ?))' % (c,op,c,op),
+                [row[c],row[c],row['img_series_filepath']])
+
+class recon_store:
+    path=None
+    db=None
+
+    def __init__(self,path,timeout=30.0):
+        # A connection can only be used from the thread that opened it, so
+        # each thread that needs the store should open its own
+        self.path=path
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        self.db=sqlite3.connect(path,timeout=timeout)
+        self.db.row_factory=sqlite3.Row
+        with self.db:
+            self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def __meta__(self,key):
+        return self.db.execute('SELECT value FROM meta WHERE key=?',(key,)).fetchone()[0]
+
+    def seq(self):
+        return self.__meta__('seq')
+
+    def sync(self,rows):
+        ### Make the store match rows (dictionaries keyed by columns). Only the
+        ### differences are written; a changed row is removed and added again.
+        ### Returns (n_added, n_removed).
+        rows={r['img_series_filepath']:r for r in rows}
+        with self.db:
+            existing=dict(self.db.execute('SELECT img_series_filepath,csv_row FROM recons'))
+            removed=[p for p in existing if p not in rows or existing[p]!=csv_row(rows[p])]
+            added=[rows[p] for p in rows if p not in existing or existing[p]!=csv_row(rows[p])]
+            if not added and not removed:
+                return 0,0
+
+            seq=self.seq()
+            for p in removed:
+                seq+=1
+                self.db.execute('INSERT INTO removed SELECT ?,seq,img_series_filepath,org_raw_filepath,pipeline_id,dose,kernel,slice_thickness FROM recons WHERE img_series_filepath=?',(seq,p))
+                self.db.execute('DELETE FROM recons WHERE img_series_filepath=?',(p,))
+            for r in added:
+                seq+=1
+                self.db.execute('INSERT INTO recons VALUES (?,?,?,?,?,?,?,?)',
+                                (r['img_series_filepath'],r['org_raw_filepath'],r['pipeline_id'],
+                                 r['dose'],r['kernel'],r['slice_thickness'],seq,csv_row(r)))
+            self.db.execute("UPDATE meta SET value=? WHERE key='seq'",(seq,))
+
+            # Bound the removal log; viewers older than it have to reload
+            if self.db.execute('DELETE FROM removed WHERE seq<=?',(seq-n_removed_log,)).rowcount:
+                self.db.execute("UPDATE meta SET value=? WHERE key='pruned'",(seq-n_removed_log,))
+
+        return len(added),len(removed)
+
+    def update_from_csv(self,csv_filepath):
+        ### sync with recons.csv if it changed since the last call. Returns
+        ### (n_added, n_removed).
+        try:
+            st=os.stat(csv_filepath)
+        except OSError:
+            return 0,0
+        if (st.st_mtime_ns,st.st_size)==(self.__meta__('csv_mtime'),self.__meta__('csv_size')):
+            return 0,0
+        with open(csv_filepath,'r',newline='') as f:
+            rows=[r for r in csv.DictReader(f) if r.get('img_series_filepath')]
+        n=self.sync(rows)
+        with self.db:
+            self.db.execute("UPDATE meta SET value=? WHERE key='csv_mtime'",(st.st_mtime_ns,))
+            self.db.execute("UPDATE meta SET value=? WHERE key='csv_size'",(st.st_size,))
+        return n
+
+    def count(self,v):
+        clauses,args=v.where()
+        sql='SELECT COUNT(*) FROM recons'
+        if clauses:
+            sql+=' WHERE '+' AND '.join(clauses)
+        return self.db.execute(sql,args).fetchone()[0]
+
+    def page(self,v,offset,limit):
+        ### Rows offset..offset+limit of the view, as lists in column order
+        clauses,args=v.where()
+        sql='SELECT %s FROM recons' % ','.join(columns)
+        if clauses:
+            sql+=' WHERE '+' AND '.join(clauses)
+        sql+=' ORDER BY %s LIMIT ? OFFSET ?' % v.order_by()
+        return [list(r) for r in self.db.execute(sql,args+[limit,offset])]
+
+    def position(self,v,row,exclude_since=None):
+        ### Number of rows in the view that sort before row. Rows inserted after
+        ### sequence number exclude_since are not counted.
+        clauses,args=v.where()
+        c,a=v.before(row)
+        clauses.append(c)
+        args+=a
+        if exclude_since is not None:
+            clauses.append('seq<=?')
+            args.append(exclude_since)
+        sql='SELECT COUNT(*) FROM recons WHERE '+' AND '.join(clauses)
+        return self.db.execute(sql,args).fetchone()[0]
+
+    def distinct(self,column):
+        if column not in columns:
+            raise ValueError('Unknown column %s' % column)
+        return [r[0] for r in self.db.execute('SELECT DISTINCT %s FROM recons ORDER BY %s' % (column,column))]
+
+    def changes(self,v,since):
+        ### Changes to the view since sequence number since, as
+        ###     (seq, removed positions, [(position,row), ...] inserted)
+        ### Removed positions refer to the old view and should be applied in the
+        ### order given (descending); inserts should then be applied in order
+        ### (ascending). Returns None if the changes are no longer known and the
+        ### view has to be reloaded.
+        with self.db:
+            seq=self.seq()
+            if seq==since:
+                return seq,[],[]
+
+            if since<self.__meta__('pruned'):
+                return None
+
+            clauses,args=v.where('removed')
+            # Rows both added and removed since then were never in the old view
+            sql='SELECT * FROM removed WHERE seq>? AND added_seq<=?'
+            if clauses:
+                sql+=' AND '+' AND '.join(clauses)
+            removed=[dict(r) for r in self.db.execute(sql,[since,since]+args)]
+
+            clauses,args=v.where()
+            sql='SELECT %s FROM recons WHERE seq>?' % ','.join(columns)
+            if clauses:
+                sql+=' AND '+' AND '.join(clauses)
+            sql+=' ORDER BY %s' % v.order_by()
+            inserted=[dict(r) for r in self.db.execute(sql,[since]+args)]
+
+            # Position of each removed row in the old view: old rows still present
+            # that sort before it plus removed rows that sort before it
+            key=lambda r: (r[v.sort_column],r['img_series_filepath'])
+            removed.sort(key=key,reverse=v.descending)
+            removed_positions=[]
+            for i,r in enumerate(removed):
+                removed_positions.append(self.position(v,r,exclude_since=since)+i)
+            removed_positions.reverse()
+
+            # Inserted rows at their position in the new view
+            inserts=[]
+            for r in inserted:
+                inserts.append((self.position(v,r),[r[c] for c in columns]))
+
+        return seq,removed_positions,inserts
@@ -0,0 +1,267 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_retry.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Automatic retry of failed queue items.
+#
+# Failed jobs are recorded in .proc/error as "qi:qi_status.NAME:class" where
+# class is "transient", "permanent" or "unknown" (see classify_failure).  The
+# daemon feeds new error lines to a retry_manager, which:
+#
+#     - never retries permanent failures
+#     - retries transient/unknown failures after an exponential backoff,
+#       up to the max_attempts of the policy for that qi_status
+#     - counts jobs that were given up on against their raw file, and
+#       quarantines the raw file once the count reaches quarantine_threshold
+#
+# State is kept in .proc so that it survives a daemon restart:
+#     .proc/retry        - "due_time<TAB>qi" retries waiting for their backoff
+#     .proc/failures     - "count<TAB>raw filepath" jobs given up on per raw file
+#     .proc/quarantine   - raw filepaths that are no longer scheduled
+#     .proc/error.offset - how far into .proc/error the daemon has read
+
+import os
+import time
+import logging
+
+from CTBB_Pipeline import pypeline as pype
+from CTBB_Pipeline.pypeline import mutex
+
+failure_classes=['transient','permanent','unknown']
+
+# Substrings of ctbb_recon/ctbb_simdose stderr (case-insensitive) that identify
+# a failure as transient (worth retrying) or permanent (will fail again)
+transient_patterns=[
+    'out of memory',
+    'cuda_error_out_of_memory',
+    'cudaerrormemoryallocation',
+    'all cuda-capable devices are busy',
+    'cudaerrordevicesunavailable',
+    'device busy',
+    'device or resource busy',
+    'resource temporarily unavailable',
+    'the launch timed out',
+    'stale file handle',
+    'input/output error',
+]
+
+permanent_patterns=[
+    'no such file or directory',
+    'permission denied',
+    'could not open',
+    'invalid parameter',
+    'unrecognized',
+]
+
+# Retry policy per qi_status name. Backoff before attempt n+1 is
+#     min(backoff*backoff_factor**(n-1),max_backoff) seconds
+# Policies can be overridden per library with the "retry_policies" setting.
+default_retry_policies={
+    'NO_RAW'               : {'max_attempts':2, 'backoff':300, 'backoff_factor':2, 'max_backoff':3600},
+    'DOSE_REDUCTION_ERROR' : {'max_attempts':3, 'backoff':60,  'backoff_factor':2, 'max_backoff':1800},
+    'PRM_CREATION_ERROR'   : {'max_attempts':2, 'backoff':30,  'backoff_factor':2, 'max_backoff':600},
+    'RECONSTRUCTION_ERROR' : {'max_attempts':4, 'backoff':30,  'backoff_factor':2, 'max_backoff':1800},
+    'JOB_LOST'             : {'max_attempts':3, 'backoff':0,   'backoff_factor':2, 'max_backoff':600},
+    'QUARANTINED'          : {'max_attempts':1, 'backoff':0,   'backoff_factor':1, 'max_backoff':0},
+    'CANCELLED'            : {'max_attempts':1, 'backoff':0,   'backoff_factor':1, 'max_backoff':0},
+}
+
+def classify_failure(stderr_text,exit_code=None):
+    ### Classify a failed child process from its stderr and exit code
+    if exit_code is not None and exit_code<0:
+        # Killed by a signal (OOM killer, user, host shutdown)
+        return 'transient'
+
+    text=(stderr_text or '').lower()
+    for p in transient_patterns:
+        if p in text:
+            return 'transient'
+    for p in permanent_patterns:
+        if p in text:
+            return 'permanent'
+
+    return 'unknown'
+
+def classify_stderr_file(stderr_filepath,exit_code=None):
+    text=''
+    if stderr_filepath and os.path.exists(stderr_filepath):
+        with open(stderr_filepath,'r',errors='replace') as f:
+            text=f.read()
+    return classify_failure(text,exit_code)
+
+def format_error_line(qi,status,failure_class='unknown'):
+    return '%s:%s:%s' % (qi,str(status),failure_class)
+
+def parse_error_line(line):
+    # Returns (qi,status name,failure class). Lines written before failure
+    # classification existed ("qi:qi_status.NAME") are classed as unknown.
+    parts=line.rsplit(':',2)
+    if len(parts)==3 and parts[2] in failure_classes:
+        qi,status,failure_class=parts
+    else:
+        qi,status=line.rsplit(':',1)
+        failure_class='unknown'
+    status=status.split('.')[-1]
+    return qi,status,failure_class
+
+def append_error(library,qi,status,failure_class='unknown'):
+    with mutex('error',library.mutex_dir):
+        with open(os.path.join(library.path,'.proc','error'),'a') as f:
+            f.write("%s\n" % format_error_line(qi,status,failure_class))
+
+class retry_manager:
+    library=None
+    policies=None
+    quarantine_threshold=None
+    scheduled=None   # list of (due time, qi)
+    failures=None    # raw filepath -> number of jobs given up on
+    quarantine=None  # set of raw filepaths
+
+    def __init__(self,library):
+        self.library=library
+        self.policies={}
+        for k,v in default_retry_policies.items():
+            self.policies[k]=dict(v)
+        for k,v in library.settings.get('retry_policies',{}).items():
+            self.policies.setdefault(k,dict(default_retry_policies['RECONSTRUCTION_ERROR'])).update(v)
+        self.quarantine_threshold=library.settings.get('quarantine_threshold',3)
+        self.load()
+
+    def __proc_file__(self,name):
+        return os.path.join(self.library.path,'.proc',name)
+
+    def load(self):
+        self.scheduled=[]
+        if os.path.exists(self.__proc_file__('retry')):
+            with open(self.__proc_file__('retry'),'r') as f:
+                for line in f.read().splitlines():
+                    if line:
+                        due,qi=line.split('\t',1)
+                        self.scheduled.append((float(due),qi))
+
+        self.failures={}
+        if os.path.exists(self.__proc_file__('failures')):
+            with open(self.__proc_file__('failures'),'r') as f:
+                for line in f.read().splitlines():
+                    if line:
+                        count,filepath=line.split('\t',1)
+                        self.failures[filepath]=int(count)
+
+        self.quarantine=set()
+        if os.path.exists(self.__proc_file__('quarantine')):
+            with open(self.__proc_file__('quarantine'),'r') as f:
+                self.quarantine=set([l for l in f.read().splitlines() if l])
+
+    def save(self):
+        with open(self.__proc_file__('retry'),'w') as f:
+            for due,qi in self.scheduled:
+                f.write('%f\t%s\n' % (due,qi))
+        with open(self.__proc_file__('failures'),'w') as f:
+            for filepath,count in self.failures.items():
+                f.write('%d\t%s\n' % (count,filepath))
+        with open(self.__proc_file__('quarantine'),'w') as f:
+            for filepath in sorted(self.quarantine):
+                f.write('%s\n' % filepath)
+
+    def backoff(self,status,attempt):
+        policy=self.policies.get(status,self.policies['RECONSTRUCTION_ERROR'])
+        delay=policy['backoff']*(policy['backoff_factor']**(attempt-1))
+        return min(delay,policy['max_backoff'])
+
+    def read_new_errors(self):
+        ### New lines appended to .proc/error since the last call
+        error_filepath=self.__proc_file__('error')
+        offset_filepath=self.__proc_file__('error.offset')
+
+        offset=0
+        if os.path.exists(offset_filepath):
+            with open(offset_filepath,'r') as f:
+                offset=int(f.read().strip() or 0)
+
+        with mutex('error',self.library.mutex_dir):
+            size=os.path.getsize(error_filepath)
+            if size<offset:
+                offset=0 # Error file was truncated by hand
+            with open(error_filepath,'r') as f:
+                f.seek(offset)
+                text=f.read()
+                offset=f.tell()
+
+        with open(offset_filepath,'w') as f:
+            f.write('%d\n' % offset)
+
+        return [l for l in text.splitlines() if l]
+
+    def poll(self,now=None):
+        ### Process new failures: schedule retries or give up on the job
+        if now is None:
+            now=time.time()
+
+        # Daemons on other hosts update the same files (under the queue mutex)
+        self.load()
+
+        changed=False
+        for line in self.read_new_errors():
+            qi,status,failure_class=parse_error_line(line)
+            if status in ['QUARANTINED','CANCELLED']:
+                continue
+
+            attempt=int(pype.get_queue_item_option(qi,'attempt',1))
+            policy=self.policies.get(status,self.policies['RECONSTRUCTION_ERROR'])
+
+            if failure_class!='permanent' and attempt<policy['max_attempts']:
+                delay=self.backoff(status,attempt)
+                retry_qi=pype.set_queue_item_option(qi,'attempt',attempt+1)
+                logging.info('Retrying %s (%s, %s) in %d s' % (pype.queue_item_key(qi),status,failure_class,delay))
+                self.scheduled.append((now+delay,retry_qi))
+            else:
+                logging.warning('Giving up on %s after %d attempt(s) (%s, %s)' % (pype.queue_item_key(qi),attempt,status,failure_class))
+                self.record_failure(pype.parse_queue_item(qi)['filepath'])
+            changed=True
+
+        if changed:
+            self.save()
+
+    def record_failure(self,filepath):
+        self.failures[filepath]=self.failures.get(filepath,0)+1
+        if self.failures[filepath]>=self.quarantine_threshold and filepath not in self.quarantine:
+            logging.warning('Quarantining raw file %s after %d failed jobs' % (filepath,self.failures[filepath]))
+            self.quarantine.add(filepath)
+
+    def is_quarantined(self,qi):
+        return pype.parse_queue_item(qi)['filepath'] in self.quarantine
+
+    def due(self,now=None):
+        ### Retries whose backoff has elapsed (removed from the schedule)
+        if now is None:
+            now=time.time()
+
+        ready=[qi for due,qi in self.scheduled if due<=now and not self.is_quarantined(qi)]
+        n_scheduled=len(self.scheduled)
+        self.scheduled=[(due,qi) for due,qi in self.scheduled if due>now and not self.is_quarantined(qi)]
+        if len(self.scheduled)!=n_scheduled:
+            self.save()
+        return ready
+
+    def pending(self):
+        return len(self.scheduled)
+
+    def next_due(self):
+        if not self.scheduled:
+            return None
+        return min([due for due,qi in self.scheduled])
@@ -0,0 +1,254 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_runtime.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Job runtime prediction and queue ETAs.
+#
+# Finished queue item logs (library/log/*_qi.log) are mined once each for
+# their stage timings (the same START/END markers ctbb_pipeline_metrics
+# reads) and stored with features of the job's PRMB in .proc/runtimes:
+#
+#     megavoxels  - slices x Nx x Ny / 1e6, slices = scan length / slice thickness
+#     views       - megavoxels x detector coverage / table feed (views per voxel)
+#     rotations   - scan length / table feed
+#     raw_size    - bytes of the original raw file
+#
+# Reconstruction time is fitted by least squares on these features (or, with
+# too little history, by seconds per megavoxel); dose reduction and raw
+# copying by seconds per byte. A job's prediction is its reconstruction time
+# plus whichever of the other stages its data still needs.
+
+import os
+import time
+import heapq
+from datetime import datetime
+
+from CTBB_Pipeline.pypeline import parse_queue_item,queue_item_key,read_prm
+from CTBB_Pipeline import ctbb_pipeline_layout as layout
+
+history_columns=['log','qi','fetch_raw','dose_reduction','recon','total',
+                 'ran_fetch','ran_simdose','megavoxels','views','rotations','raw_size']
+feature_columns=['megavoxels','views','rotations']
+
+default_recon_rate=2.0       # seconds per megavoxel before there is any history
+default_transfer_rate=1e-8   # seconds per byte (simdose and raw copy) likewise
+min_fit_samples=8            # history needed before fitting the full model
+
+def parse_log_time(line):
+    return time.mktime(datetime.strptime(line[0:19],'%Y-%m-%d %H:%M:%S').timetuple())+float(line[20:23])/1000.0
+
+def mine_qi_log(filepath):
+    ### Stage timings of a queue item as (finished, row). row is None unless
+    ### the job finished successfully.
+    stages={'FETCH RAW':'fetch_raw','DOSE REDUCTION':'dose_reduction','RECON':'recon','QUEUE ITEM':'total'}
+    start={}
+    failed=False
+    row={'log':os.path.basename(filepath),'ran_fetch':0,'ran_simdose':0}
+    with open(filepath,'r') as f:
+        for line in f.read().splitlines():
+            if 'START: ' in line or 'END: ' in line:
+                marker=line.split(': ',1)[1].strip()
+                if marker in stages:
+                    if 'START: ' in line:
+                        start[marker]=parse_log_time(line)
+                    elif marker in start:
+                        row[stages[marker]]=parse_log_time(line)-start[marker]
+            elif 'Lease on ' in line and ' acquired for ' in line:
+                row['qi']=queue_item_key(line.split(' acquired for ',1)[1].rsplit(' (attempt',1)[0])
+            elif 'Adding raw data file to library' in line:
+                row['ran_fetch']=1
+            elif 'Reduced dose data not found' in line:
+                row['ran_simdose']=1
+            elif 'Something went wrong' in line:
+                failed=True
+    finished='total' in row
+    if failed or 'qi' not in row or any([s not in row for s in stages.values()]):
+        return finished,None
+    return finished,row
+
+class runtime_model:
+    library=None
+    history=None
+    seen=None
+    features_cache=None
+    recon_coefficients=None
+    recon_rate=None
+    simdose_rate=None
+    fetch_rate=None
+    overhead=None
+
+    def __init__(self,library):
+        self.library=library
+        self.features_cache={}
+        self.load()
+        self.fit()
+
+    def __history_file__(self):
+        return os.path.join(self.library.path,'.proc','runtimes')
+
+    def load(self):
+        self.history=[]
+        self.seen=set()
+        if os.path.exists(self.__history_file__()):
+            with open(self.__history_file__(),'r') as f:
+                for line in f.read().splitlines()[1:]:
+                    fields=line.split('\t')
+                    if len(fields)!=len(history_columns):
+                        continue
+                    row=dict(zip(history_columns,fields))
+                    for c in history_columns[2:]:
+                        row[c]=float(row[c])
+                    self.history.append(row)
+                    self.seen.add(row['log'])
+
+    def update(self):
+        ### Mine queue item logs not seen before. Returns the number added.
+        new_rows=[]
+        for name in os.listdir(self.library.log_dir):
+            if not name.endswith('_qi.log') or name in self.seen:
+                continue
+            try:
+                finished,row=mine_qi_log(os.path.join(self.library.log_dir,name))
+            except (OSError,ValueError):
+                continue
+            if not finished:
+                continue # Still running; look again next time
+            self.seen.add(name)
+            features=self.features(row['qi']) if row is not None else None
+            if features is None:
+                continue # Failed jobs say nothing about runtime
+            row.update(features)
+            new_rows.append(row)
+
+        if new_rows:
+            write_header=not os.path.exists(self.__history_file__())
+            with open(self.__history_file__(),'a') as f:
+                if write_header:
+                    f.write('\t'.join(history_columns)+'\n')
+                for row in new_rows:
+                    f.write('\t'.join([str(row[c]) for c in history_columns])+'\n')
+            self.history+=new_rows
+            self.fit()
+        return len(new_rows)
+
+    def features(self,qi):
+        ### Features of a queue item from its PRMB (None if there is no PRMB)
+        item=parse_queue_item(qi)
+        key=(item['filepath'],item['slice_thickness'])
+        if key in self.features_cache:
+            return self.features_cache[key]
+
+        prmb_filepath=layout.prmb_filepath(self.library,item['filepath'])
+        try:
+            prmb=read_prm(prmb_filepath)
+            length=abs(float(prmb['EndPos'])-float(prmb['StartPos']))
+            feed=float(prmb.get('PitchValue',1.0)) or 1.0
+            coverage=float(prmb.get('Nrows',1))*float(prmb.get('CollSlicewidth',1.0))
+            megavoxels=(length/float(item['slice_thickness'])+1)*float(prmb.get('Nx',512))*float(prmb.get('Ny',512))/1e6
+        except (OSError,KeyError,ValueError,ZeroDivisionError):
+            return None
+        try:
+            raw_size=float(os.path.getsize(item['filepath']))
+        except OSError:
+            raw_size=0.0
+
+        features={'megavoxels':megavoxels,
+                  'views':megavoxels*coverage/feed,
+                  'rotations':length/feed,
+                  'raw_size':raw_size}
+        self.features_cache[key]=features
+        return features
+
+    def fit(self):
+        def median(values,default):
+            values=sorted(values)
+            return values[len(values)//2] if values else default
+
+        rows=self.history
+        self.recon_rate=median([r['recon']/r['megavoxels'] for r in rows if r['megavoxels']>0],default_recon_rate)
+        self.simdose_rate=median([r['dose_reduction']/r['raw_size'] for r in rows if r['ran_simdose'] and r['raw_size']>0],default_transfer_rate)
+        self.fetch_rate=median([r['fetch_raw']/r['raw_size'] for r in rows if r['ran_fetch'] and r['raw_size']>0],default_transfer_rate)
+        self.overhead=median([max(0.0,r['total']-r['fetch_raw']-r['dose_reduction']-r['recon']) for r in rows],0.0)
+
+        self.recon_coefficients=None
+        if len(rows)>=min_fit_samples:
+            import numpy as np
+            A=np.array([[1.0]+[r[c] for c in feature_columns] for r in rows])
+            b=np.array([r['recon'] for r in rows])
+            # Features that move together (e.g. one protocol only) leave the
+            # system rank deficient; the minimum norm solution still fits the
+            # history, it just cannot tell those features apart
+            coefficients,residuals,rank,sv=np.linalg.lstsq(A,b,rcond=None)
+            if rank>=2:
+                self.recon_coefficients=[float(c) for c in coefficients]
+
+    def predict_recon(self,features):
+        rate_estimate=self.recon_rate*features['megavoxels']
+        if self.recon_coefficients is None:
+            return rate_estimate
+        c=self.recon_coefficients
+        estimate=c[0]+sum([c[i+1]*features[f] for i,f in enumerate(feature_columns)])
+        # Never trust a linear fit far outside its data to go negative
+        return estimate if estimate>0 else rate_estimate
+
+    def predict(self,qi,data_ready=None):
+        ### Predicted seconds for a queue item. With data_ready(filepath,dose),
+        ### the dose reduction and raw copy are only counted if still needed.
+        features=self.features(qi)
+        if features is None:
+            return self.overhead+default_recon_rate*(512*512*100/1e6)
+        t=self.overhead+self.predict_recon(features)
+
+        item=parse_queue_item(qi)
+        need_fetch=need_simdose=True
+        if data_ready is not None:
+            need_fetch=not data_ready(item['filepath'],'100')
+            need_simdose=not data_ready(item['filepath'],item['dose'])
+        if need_fetch:
+            t+=self.fetch_rate*features['raw_size']
+        if need_simdose and str(item['dose'])!='100':
+            t+=self.simdose_rate*features['raw_size']
+        return t
+
+def campaign_of(qi):
+    return parse_queue_item(qi)['options'].get('campaign','')
+
+def estimate_completion(queue,durations,busy,n_devices,now=None):
+    ### ETA of every queued job if dispatched in queue order onto n_devices.
+    ### busy is a list of (qi, seconds remaining) for running jobs. Returns
+    ### {'queue': finish time, 'campaigns': {campaign: finish time}}.
+    if now is None:
+        now=time.time()
+    free=[max(0.0,remaining) for qi,remaining in busy]
+    free+=[0.0]*max(1,n_devices-len(free))
+
+    campaigns={}
+    for qi,remaining in busy:
+        c=campaign_of(qi)
+        campaigns[c]=max(campaigns.get(c,0.0),max(0.0,remaining))
+
+    heapq.heapify(free)
+    for qi,d in zip(queue,durations):
+        t=heapq.heappop(free)+d
+        heapq.heappush(free,t)
+        c=campaign_of(qi)
+        campaigns[c]=max(campaigns.get(c,0.0),t)
+
+    end=max(campaigns.values()) if campaigns else 0.0
+    return {'queue':now+end,
+            'campaigns':{(c or 'default'):now+t for c,t in campaigns.items()}}
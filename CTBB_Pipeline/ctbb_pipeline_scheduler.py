@@ -0,0 +1,369 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_scheduler.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Dispatch policies: which queued job the daemon starts on a free device.
+#
+# A policy sees the queue once per daemon pass and is then asked, for each
+# free device in turn, for the index of the queue item to start there:
+#
+#     policy.update(queue,active)    # active: queue items currently running
+#     i=policy.select(queue,device)  # index into queue, or None to leave idle
+#     policy.dispatched(qi,device)   # after queue[i] was popped and started
+#
+# Policies are chosen with 'dispatch_policy' in the library's settings.yml
+# (default fifo, the order jobs were queued in) and looked up by name in the
+# policies dictionary below; new policies only need to be added there.
+#
+# Policies do not touch the filesystem themselves: whether a job's raw data is
+# ready is asked of a data_ready(filepath,dose) function, and how long a job
+# will take of a predict(qi) function (see ctbb_pipeline_runtime), so the
+# same policies can be driven by something other than a live library.
+
+import os
+import time
+import heapq
+import bisect
+from collections import OrderedDict
+
+from CTBB_Pipeline.pypeline import parse_queue_item
+from CTBB_Pipeline.ctbb_pipeline_layout import raw_filepath
+
+class dispatch_policy:
+    ### Base policy: first come, first served
+    name='fifo'
+    data_ready=None
+    predict=None
+
+    def __init__(self,data_ready=None,predict=None):
+        self.data_ready=data_ready
+        self.predict=predict
+
+    def update(self,queue,active):
+        pass
+
+    def select(self,queue,device):
+        return 0 if queue else None
+
+    def dispatched(self,qi,device):
+        pass
+
+class fifo_policy(dispatch_policy):
+    name='fifo'
+
+full_dose='100'
+
+def data_key(qi):
+    ### (raw filepath, dose) of a queue item: the data its dose reduction
+    ### produces and its reconstruction reads
+    item=parse_queue_item(qi)
+    return (item['filepath'],item['dose'])
+
+class locality_policy(dispatch_policy):
+    ### Prefer jobs whose raw data is already there and was read recently.
+    ###
+    ### Jobs are launched case -> dose -> slice thickness -> kernel, so under
+    ### FIFO the variants of one (case, dose) land on every device at once and
+    ### all but one wait on its dose reduction. Instead, each queued job in the
+    ### first 'window' entries is scored:
+    ###
+    ###     3  data ready and read recently on this host (likely still cached)
+    ###     2  data ready
+    ###     1  data not ready, and no running job is producing it (cold: start
+    ###        its dose reduction on this device, spreading cold cases out)
+    ###     0  data being produced by a running job (would only wait)
+    ###
+    ### and the best score wins, ties going to the job queued first. A job at
+    ### the head of the queue is never passed over more than max_bypass times.
+    ### A case that is not in the library yet has no data at any dose until
+    ### its full-dose raw file has been copied in, so all of its jobs wait on
+    ### whichever job is doing that.
+    name='locality'
+    window=None
+    max_bypass=None
+    hot_keys=None
+    recent=None     # (filepath, dose) -> time last dispatched, most recent last
+    producing=None  # (filepath, dose) keys a running job is producing
+    bypassed=None   # head of queue -> times passed over
+
+    def __init__(self,data_ready,predict=None,window=64,max_bypass=32,hot_keys=8):
+        dispatch_policy.__init__(self,data_ready,predict)
+        self.window=window
+        self.max_bypass=max_bypass
+        self.hot_keys=hot_keys
+        self.recent=OrderedDict()
+        self.producing=set()
+        self.bypassed={}
+
+    def update(self,queue,active):
+        self.producing=set()
+        for qi in active:
+            key=self.blocking_key(qi)
+            if key is not None:
+                self.producing.add(key)
+        if queue and queue[0] not in self.bypassed:
+            self.bypassed={queue[0]:0}
+
+    def blocking_key(self,qi):
+        ### Data a queue item would have to wait for, or None if it is ready
+        filepath,dose=data_key(qi)
+        if not self.data_ready(filepath,full_dose):
+            return (filepath,full_dose)
+        if not self.data_ready(filepath,dose):
+            return (filepath,dose)
+        return None
+
+    def score(self,qi):
+        key=self.blocking_key(qi)
+        if key is None:
+            return 3 if data_key(qi) in self.recent else 2
+        if key in self.producing:
+            return 0
+        return 1
+
+    def select(self,queue,device):
+        if not queue:
+            return None
+        if self.bypassed.get(queue[0],0)>=self.max_bypass:
+            return 0
+
+        best=0
+        best_score=-1
+        for i,qi in enumerate(queue[0:self.window]):
+            s=self.score(qi)
+            if s>best_score:
+                best,best_score=i,s
+                if s==3:
+                    break
+
+        if best!=0:
+            self.bypassed[queue[0]]=self.bypassed.get(queue[0],0)+1
+        return best
+
+    def dispatched(self,qi,device):
+        blocking=self.blocking_key(qi)
+        if blocking is not None:
+            self.producing.add(blocking)
+        key=data_key(qi)
+        self.recent.pop(key,None)
+        self.recent[key]=time.time()
+        while len(self.recent)>self.hot_keys:
+            self.recent.popitem(last=False)
+
+class sjf_policy(dispatch_policy):
+    ### Shortest predicted job first. Suits interactive use: small requests
+    ### are not stuck behind long reconstructions. The head of the queue is
+    ### passed over at most max_bypass times, so long jobs still run.
+    ###
+    ### A prediction only changes when the job's data becomes ready, which
+    ### only a running job on the same raw file can bring about. Predictions
+    ### are therefore kept across passes and dropped for a raw file when one
+    ### of its jobs leaves the active list (and all of them every refresh
+    ### seconds, which also follows the runtime model as it is refitted).
+    ###
+    ### The window is mirrored in a heap keyed on (prediction, arrival), with
+    ### entries that went stale (job started, prediction redone) skipped when
+    ### they reach the top. As long as the queue only loses the jobs the
+    ### policy picked, a select costs a comparison of the window and a few
+    ### heap operations; any other change to the window rebuilds the mirror.
+    name='sjf'
+    longest_first=False
+    window=None
+    max_bypass=None
+    refresh=None
+    bypassed=None
+    predictions=None # queue item -> predicted seconds
+    by_filepath=None # raw filepath -> queue items with a prediction
+    active=None
+    refreshed=None
+    mirror=None      # the window as last seen, minus dispatched jobs
+    ranks=None       # arrival number of each job in mirror (increasing)
+    keys=None        # arrival number -> heap key of the job
+    ranks_of=None    # queue item -> its arrival numbers in mirror
+    heap=None        # (key, arrival number), possibly stale
+    next_rank=0
+    selected=None    # index last returned by select
+
+    def __init__(self,data_ready,predict,window=1000,max_bypass=256,refresh=60.0):
+        dispatch_policy.__init__(self,data_ready,predict)
+        self.window=window
+        self.max_bypass=max_bypass
+        self.refresh=refresh
+        self.bypassed={}
+        self.predictions={}
+        self.by_filepath={}
+        self.active=set()
+        self.refreshed=time.time()
+        self.reset()
+
+    def reset(self):
+        self.mirror=[]
+        self.ranks=[]
+        self.keys={}
+        self.ranks_of={}
+        self.heap=[]
+        self.selected=None
+
+    def update(self,queue,active):
+        active=set(active)
+        if time.time()-self.refreshed>self.refresh:
+            self.predictions={}
+            self.by_filepath={}
+            self.refreshed=time.time()
+            self.reset()
+        else:
+            for qi in self.active-active:
+                for cached in self.by_filepath.pop(data_key(qi)[0],()):
+                    self.predictions.pop(cached,None)
+                    self.rekey(cached)
+        self.active=active
+        if queue and queue[0] not in self.bypassed:
+            self.bypassed={queue[0]:0}
+
+    def predicted(self,qi):
+        if qi not in self.predictions:
+            self.predictions[qi]=self.predict(qi)
+            self.by_filepath.setdefault(data_key(qi)[0],set()).add(qi)
+        return self.predictions[qi]
+
+    def key(self,qi):
+        return -self.predicted(qi) if self.longest_first else self.predicted(qi)
+
+    def add(self,qi):
+        rank=self.next_rank
+        self.next_rank+=1
+        key=self.key(qi)
+        self.mirror.append(qi)
+        self.ranks.append(rank)
+        self.keys[rank]=key
+        self.ranks_of.setdefault(qi,[]).append(rank)
+        heapq.heappush(self.heap,(key,rank))
+
+    def rekey(self,qi):
+        for rank in self.ranks_of.get(qi,()):
+            key=self.key(qi)
+            self.keys[rank]=key
+            heapq.heappush(self.heap,(key,rank))
+
+    def remove(self,i):
+        qi=self.mirror.pop(i)
+        rank=self.ranks.pop(i)
+        del self.keys[rank]
+        ranks=self.ranks_of[qi]
+        ranks.remove(rank)
+        if not ranks:
+            del self.ranks_of[qi]
+
+    def sync(self,queue):
+        ### Bring the mirror in line with the window of queue
+        n=len(self.mirror)
+        if queue[0:n]!=self.mirror:
+            self.reset()
+            n=0
+        end=len(queue) if self.window is None else min(self.window,len(queue))
+        for qi in queue[n:end]:
+            self.add(qi)
+        if len(self.heap)>2*len(self.keys)+64:
+            self.heap=[(key,rank) for rank,key in self.keys.items()]
+            heapq.heapify(self.heap)
+
+    def select(self,queue,device):
+        self.selected=None
+        if not queue:
+            return None
+        self.sync(queue)
+        if self.max_bypass is not None and self.bypassed.get(queue[0],0)>=self.max_bypass:
+            self.selected=0
+            return 0
+
+        # First of the shortest (longest) predictions, ties going to the job
+        # queued first
+        while self.keys.get(self.heap[0][1])!=self.heap[0][0]:
+            heapq.heappop(self.heap)
+        best=bisect.bisect_left(self.ranks,self.heap[0][1])
+
+        if best!=0:
+            self.bypassed[queue[0]]=self.bypassed.get(queue[0],0)+1
+        self.selected=best
+        return best
+
+    def dispatched(self,qi,device):
+        i=self.selected
+        if i is not None and i<len(self.mirror) and self.mirror[i]==qi:
+            self.remove(i)
+        self.selected=None
+        if self.predictions.pop(qi,None) is not None:
+            cached=self.by_filepath.get(data_key(qi)[0])
+            if cached is not None:
+                cached.discard(qi)
+
+class lpt_policy(sjf_policy):
+    ### Longest predicted job first. For batches: starting the long
+    ### reconstructions early keeps one from running alone at the end while
+    ### the other devices sit idle, which minimizes the total campaign time.
+    name='lpt'
+    longest_first=True
+
+    def __init__(self,data_ready,predict,window=None,max_bypass=None):
+        # No bypass limit: every job runs before the queue drains anyway
+        sjf_policy.__init__(self,data_ready,predict,window,max_bypass)
+
+policies={
+    'fifo'     : fifo_policy,
+    'locality' : locality_policy,
+    'sjf'      : sjf_policy,
+    'lpt'      : lpt_policy,
+}
+
+def library_data_ready(library):
+    ### data_ready(filepath,dose) for a live library: the case is in the
+    ### library and its raw data at that dose exists
+    state={'case_list':None,'mtime':None}
+    case_list_filepath=os.path.join(library.path,'case_list.txt')
+
+    def data_ready(filepath,dose):
+        try:
+            mtime=os.path.getmtime(case_list_filepath)
+        except OSError:
+            return False
+        if mtime!=state['mtime']:
+            state['case_list']=library.__get_case_list__()
+            state['mtime']=mtime
+        case_id=state['case_list'].get(filepath)
+        if case_id is None:
+            return False
+        return os.path.exists(raw_filepath(library,dose,case_id))
+
+    return data_ready
+
+def get_policy(library,name=None,model=None):
+    ### Policy for a live library. model is the ctbb_pipeline_runtime model
+    ### used for predictions (one is created if needed and not given).
+    if name is None:
+        name=library.settings['dispatch_policy']
+    if name not in policies:
+        raise ValueError('Unknown dispatch policy %s (choose from %s)' % (name,', '.join(sorted(policies))))
+
+    data_ready=library_data_ready(library)
+    predict=None
+    if name in ['sjf','lpt']:
+        if model is None:
+            from CTBB_Pipeline.ctbb_pipeline_runtime import runtime_model
+            model=runtime_model(library)
+        predict=lambda qi: model.predict(qi,data_ready)
+    return policies[name](data_ready,predict)
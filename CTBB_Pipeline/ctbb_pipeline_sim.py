@@ -0,0 +1,437 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_sim.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Offline discrete-event simulation of the daemon, for trying dispatch
+# policies on a workload before using them on a library.
+#
+# The workload is either replayed from a library (the stage timings of its
+# finished queue item logs, as mined by ctbb_pipeline_runtime) or drawn from
+# a synthetic distribution. The simulation follows what a job does in
+# ctbb_queue_item and the library:
+#
+#     - the daemon makes a dispatch pass every poll_interval seconds while a
+#       device is free, asking the policy (the same ctbb_pipeline_scheduler
+#       objects the daemon uses) for the job to start on each free device
+#     - a job holds its device from dispatch to the end of its reconstruction
+#     - every job looks its raw file up in the case list under the
+#       library-wide case_list mutex; if the file is not there yet, the job
+#       copies it in under a fetch_raw slot only (jobs needing the same file
+#       at once each copy it), then takes case_list again to publish it
+#     - one job runs the dose reduction of a (case, dose); others wait for it
+#     - copying, dose reduction and reconstruction each take one of their
+#       stage's CPU slots (ctbb_pipeline_cpu; None: unlimited)
+#     - a mutex or slot released to a waiting job reaches it after
+#       lock_handoff seconds (the waiter's polling backoff)
+#
+# The policy's data_ready is answered from the simulated library and its
+# predict from the job's true duration, optionally with lognormal noise of
+# prediction_error (the runtime model's typical error).
+
+import math
+import time
+import heapq
+import random
+import itertools
+from collections import deque
+
+from CTBB_Pipeline.pypeline import parse_queue_item,format_queue_item
+from CTBB_Pipeline.ctbb_pipeline_scheduler import policies
+from CTBB_Pipeline.ctbb_pipeline_bench import percentiles
+
+default_options={
+    'devices'          : 8,
+    'poll_interval'    : 5.0,   # seconds between daemon passes (the daemon sleeps 5 s)
+    'dispatch_latency' : 0.2,   # seconds from dispatch to the job running
+    'lock_handoff'     : 0.1,   # seconds for a released mutex/slot to reach its waiter
+    'cpu_slots'        : {'fetch_raw':2,'dose_reduction':None,'recon':None},
+    'prediction_error' : 0.0,   # sigma of lognormal noise on predicted durations
+    'policy_options'   : {},    # keyword arguments of the policy (e.g. window)
+    'window'           : 1000,  # queued jobs seen by a policy without a window of its own (lpt),
+                                # as the daemon queues no more than campaign_window from campaigns
+    'seed'             : 0,
+}
+
+default_synthetic={
+    'jobs'              : 1000,
+    'doses'             : [100,50,25,10],
+    'kernels'           : [1,2,3],
+    'slice_thicknesses' : [0.6,1.0,2.0],
+    'recon_time'        : 60.0, # median seconds at 1.0 mm; scales with 1/slice thickness
+    'simdose_time'      : 30.0,
+    'fetch_time'        : 20.0,
+    'overhead'          : 2.0,
+    'sigma'             : 0.3,  # lognormal spread of every duration
+    'arrival_rate'      : 0.0,  # jobs per second (0: all queued at once)
+    'seed'              : 0,
+}
+
+full_dose='100'
+
+class sim_job:
+    __slots__=['qi','filepath','dose','arrival','recon','overhead','noise',
+               'device','dispatch','start','end','data_wait','produced']
+
+    def __init__(self,qi,arrival,recon,overhead):
+        item=parse_queue_item(qi)
+        self.qi=qi
+        self.filepath=item['filepath']
+        self.dose=str(item['dose'])
+        self.arrival=arrival
+        self.recon=recon
+        self.overhead=overhead
+        self.noise=1.0
+        self.device=None
+        self.dispatch=None
+        self.start=None
+        self.end=None
+        self.data_wait=0.0
+        self.produced=False
+
+class workload:
+    ### Jobs in queue order, plus how long producing each case's raw data
+    ### (fetch_time[filepath]) and each reduced dose (simdose_time[(filepath,
+    ### dose)]) takes
+    jobs=None
+    fetch_time=None
+    simdose_time=None
+
+    def __init__(self,jobs,fetch_time,simdose_time):
+        self.jobs=jobs
+        self.fetch_time=fetch_time
+        self.simdose_time=simdose_time
+
+def synthetic_workload(**options):
+    ### Cases are launched like ctbb_pipeline_launch does: case -> dose ->
+    ### slice thickness -> kernel
+    o=dict(default_synthetic)
+    o.update(options)
+    rng=random.Random(o['seed'])
+    jitter=lambda median: median*math.exp(rng.gauss(0.0,o['sigma']))
+
+    per_case=len(o['doses'])*len(o['kernels'])*len(o['slice_thicknesses'])
+    n_cases=int(math.ceil(o['jobs']/float(per_case)))
+    jobs=[]
+    fetch_time={}
+    simdose_time={}
+    t=0.0
+    for c in range(n_cases):
+        filepath='/raw/case%06d.ptr' % c
+        fetch_time[filepath]=jitter(o['fetch_time'])
+        for d in o['doses']:
+            if str(d)!=full_dose:
+                simdose_time[(filepath,str(d))]=jitter(o['simdose_time'])
+            for st in o['slice_thicknesses']:
+                for k in o['kernels']:
+                    if len(jobs)>=o['jobs']:
+                        break
+                    if o['arrival_rate']>0:
+                        t+=rng.expovariate(o['arrival_rate'])
+                    qi=format_queue_item({'filepath':filepath,'dose':str(d),'kernel':str(k),
+                                          'slice_thickness':str(st),'options':{}})
+                    jobs.append(sim_job(qi,t,jitter(o['recon_time']/float(st)),jitter(o['overhead'])))
+    return workload(jobs,fetch_time,simdose_time)
+
+def replay_workload(library,repeat=1):
+    ### Workload of a library's finished jobs, in the order they ran, with
+    ### their measured stage timings. repeat>1 replays it several times over
+    ### as distinct cases (for campaigns larger than the history).
+    from CTBB_Pipeline.ctbb_pipeline_runtime import runtime_model
+    model=runtime_model(library)
+    model.update()
+    rows=sorted(model.history,key=lambda r: r['log'])
+    if not rows:
+        raise ValueError('No finished jobs in %s to replay' % library.path)
+
+    def median(values):
+        values=sorted(values)
+        return values[len(values)//2] if values else 0.0
+    default_fetch=median([r['fetch_raw'] for r in rows if r['ran_fetch']])
+    default_simdose=median([r['dose_reduction'] for r in rows if r['ran_simdose']])
+
+    jobs=[]
+    fetch_time={}
+    simdose_time={}
+    for k in range(repeat):
+        for r in rows:
+            item=parse_queue_item(r['qi'])
+            filepath=item['filepath'] if k==0 else '%s#%d' % (item['filepath'],k)
+            dose=str(item['dose'])
+            if r['ran_fetch'] or filepath not in fetch_time:
+                fetch_time[filepath]=r['fetch_raw'] if r['ran_fetch'] else fetch_time.get(filepath,default_fetch)
+            if dose!=full_dose and (r['ran_simdose'] or (filepath,dose) not in simdose_time):
+                simdose_time[(filepath,dose)]=r['dose_reduction'] if r['ran_simdose'] else simdose_time.get((filepath,dose),default_simdose)
+            item['filepath']=filepath
+            overhead=max(0.0,r['total']-r['fetch_raw']-r['dose_reduction']-r['recon'])
+            jobs.append(sim_job(format_queue_item(item),0.0,r['recon'],overhead))
+    return workload(jobs,fetch_time,simdose_time)
+
+class sim_resource:
+    ### Mutex or pool of CPU slots (capacity None: unlimited). Waiters are
+    ### served in order, each lock_handoff seconds after the release.
+    __slots__=['sim','name','free','waiters','n_waited','wait_total']
+
+    def __init__(self,sim,name,capacity):
+        self.sim=sim
+        self.name=name
+        self.free=capacity
+        self.waiters=deque()
+        self.n_waited=0
+        self.wait_total=0.0
+
+    def acquire(self,callback,job):
+        if self.free is None:
+            callback(job)
+        elif self.free>0:
+            self.free-=1
+            callback(job)
+        else:
+            self.waiters.append((self.sim.now,callback,job))
+
+    def release(self):
+        if self.free is None:
+            return
+        if self.waiters:
+            t,callback,job=self.waiters.popleft()
+            t_grant=self.sim.now+self.sim.options['lock_handoff']
+            self.n_waited+=1
+            self.wait_total+=t_grant-t
+            self.sim.at(t_grant,callback,job)
+        else:
+            self.free+=1
+
+class simulation:
+    ### One run of a workload under one policy. simulation(w,'sjf').run()
+    ### returns the report.
+    options=None
+    policy=None
+    jobs=None
+    fetch_time=None
+    simdose_time=None
+
+    def __init__(self,workload,policy,**options):
+        self.options=dict(default_options)
+        self.options.update(options)
+        slots=dict(default_options['cpu_slots'])
+        slots.update(options.get('cpu_slots') or {})
+
+        self.jobs=workload.jobs
+        self.fetch_time=workload.fetch_time
+        self.simdose_time=workload.simdose_time
+        self.by_qi={j.qi:j for j in self.jobs}
+
+        rng=random.Random(self.options['seed'])
+        for j in self.jobs:
+            j.noise=math.exp(rng.gauss(0.0,self.options['prediction_error'])) if self.options['prediction_error'] else 1.0
+            j.device=j.dispatch=j.start=j.end=None
+            j.data_wait=0.0
+            j.produced=False
+
+        self.now=0.0
+        self.events=[]
+        self.seq=itertools.count()
+        self.n_events=0
+
+        self.ready=set()      # (filepath, dose) present in the library
+        self.producing={}     # (filepath, dose) -> jobs waiting on its dose reduction
+        self.case_list=sim_resource(self,'case_list',1)
+        self.slots={stage:sim_resource(self,stage,slots.get(stage)) for stage in ['fetch_raw','dose_reduction','recon']}
+
+        self.devices=['dev%d@sim' % i for i in range(self.options['devices'])]
+        self.running={}       # device -> job
+        self.queue=[]
+        self.queued=[]        # jobs, parallel to queue
+        self.pass_times=set()
+
+        self.policy=policies[policy](self.data_ready,self.predict,**self.options['policy_options'])
+        if getattr(self.policy,'window',0) is None:
+            self.policy.window=self.options['window']
+
+    ## Interface given to the policy
+    def data_ready(self,filepath,dose):
+        return (filepath,str(dose)) in self.ready
+
+    def predict(self,qi):
+        j=self.by_qi[qi]
+        t=j.overhead+j.recon
+        if (j.filepath,full_dose) not in self.ready:
+            t+=self.fetch_time.get(j.filepath,0.0)
+        if j.dose!=full_dose and (j.filepath,j.dose) not in self.ready:
+            t+=self.simdose_time.get((j.filepath,j.dose),0.0)
+        return t*j.noise
+
+    ## Event loop
+    def at(self,t,callback,arg=None):
+        heapq.heappush(self.events,(t,next(self.seq),callback,arg))
+
+    def run(self):
+        t_wall=time.time()
+        for j in self.jobs:
+            if j.arrival<=0:
+                self.queue.append(j.qi)
+                self.queued.append(j)
+            else:
+                self.at(j.arrival,self.arrive,j)
+        self.schedule_pass(0.0)
+
+        events=self.events
+        while events:
+            t,seq,callback,arg=heapq.heappop(events)
+            self.now=t
+            self.n_events+=1
+            callback(arg)
+
+        return self.report(time.time()-t_wall)
+
+    def arrive(self,job):
+        self.queue.append(job.qi)
+        self.queued.append(job)
+        self.schedule_pass(self.now)
+
+    ## Daemon
+    def schedule_pass(self,t):
+        interval=self.options['poll_interval']
+        tick=math.ceil(t/interval-1e-9)*interval if interval>0 else t
+        if tick not in self.pass_times:
+            self.pass_times.add(tick)
+            self.at(tick,self.dispatch_pass)
+
+    def dispatch_pass(self,arg):
+        self.pass_times.discard(self.now)
+        free=[d for d in self.devices if d not in self.running]
+        if not free or not self.queue:
+            return
+        self.policy.update(self.queue,[j.qi for j in self.running.values()])
+        left_idle=False
+        for dev in free:
+            if not self.queue:
+                break
+            i=self.policy.select(self.queue,dev)
+            if i is None:
+                left_idle=True
+                continue
+            qi=self.queue.pop(i)
+            job=self.queued.pop(i)
+            self.policy.dispatched(qi,dev)
+            job.device=dev
+            job.dispatch=self.now
+            self.running[dev]=job
+            self.at(self.now+self.options['dispatch_latency']+job.overhead,self.fetch_step,job)
+        if left_idle and self.queue:
+            self.schedule_pass(self.now+self.options['poll_interval'])
+
+    ## Job stages
+    def fetch_step(self,job):
+        job.start=self.now
+        job.data_wait=self.now
+        self.case_list.acquire(self.fetch_locked,job)
+
+    def fetch_locked(self,job):
+        # Lookup only: the copy is made outside the mutex
+        job.data_wait=self.now-job.data_wait
+        self.case_list.release()
+        if (job.filepath,full_dose) in self.ready:
+            self.simdose_step(job)
+        else:
+            job.produced=True
+            self.slots['fetch_raw'].acquire(self.fetch_run,job)
+
+    def fetch_run(self,job):
+        self.at(self.now+self.fetch_time.get(job.filepath,0.0),self.fetch_done,job)
+
+    def fetch_done(self,job):
+        self.slots['fetch_raw'].release()
+        # Waiting to publish counts as data wait too
+        job.data_wait-=self.now
+        self.case_list.acquire(self.fetch_published,job)
+
+    def fetch_published(self,job):
+        job.data_wait+=self.now
+        self.ready.add((job.filepath,full_dose))
+        self.case_list.release()
+        self.simdose_step(job)
+
+    def simdose_step(self,job):
+        key=(job.filepath,job.dose)
+        if job.dose==full_dose or key in self.ready:
+            self.recon_step(job)
+        elif key in self.producing:
+            self.producing[key].append((self.now,job))
+        else:
+            self.producing[key]=[]
+            job.produced=True
+            self.slots['dose_reduction'].acquire(self.simdose_run,job)
+
+    def simdose_run(self,job):
+        self.at(self.now+self.simdose_time.get((job.filepath,job.dose),0.0),self.simdose_done,job)
+
+    def simdose_done(self,job):
+        key=(job.filepath,job.dose)
+        self.ready.add(key)
+        self.slots['dose_reduction'].release()
+        t_grant=self.now+self.options['lock_handoff']
+        for t,waiter in self.producing.pop(key):
+            waiter.data_wait+=t_grant-t
+            self.at(t_grant,self.recon_step,waiter)
+        self.recon_step(job)
+
+    def recon_step(self,job):
+        self.slots['recon'].acquire(self.recon_run,job)
+
+    def recon_run(self,job):
+        self.at(self.now+job.recon,self.recon_done,job)
+
+    def recon_done(self,job):
+        self.slots['recon'].release()
+        job.end=self.now
+        del self.running[job.device]
+        self.schedule_pass(self.now)
+
+    ## Results
+    def report(self,wall_time):
+        jobs=[j for j in self.jobs if j.end is not None]
+        report={'policy':self.policy.name,'jobs':len(jobs)}
+        if not jobs:
+            return report
+        t0=min([j.arrival for j in jobs])
+        makespan=max([j.end for j in jobs])-t0
+        busy=sum([j.end-j.dispatch for j in jobs])
+        report['makespan']=makespan
+        report['jobs_per_hour']=3600.0*len(jobs)/makespan if makespan>0 else float('nan')
+        report['device_utilization']=busy/(len(self.devices)*makespan) if makespan>0 else float('nan')
+        report['queueing_delay']=percentiles([j.dispatch-j.arrival for j in jobs])
+        report['data_wait']=percentiles([j.data_wait for j in jobs])
+
+        n_produced=len([j for j in jobs if j.produced])
+        n_waited=len([j for j in jobs if not j.produced and j.data_wait>self.options['lock_handoff']])
+        report['cache']={'hit_rate':float(len(jobs)-n_produced-n_waited)/len(jobs),
+                         'produced':n_produced,
+                         'waited':n_waited}
+
+        report['lock_wait']={}
+        for r in [self.case_list]+list(self.slots.values()):
+            if r.n_waited:
+                report['lock_wait'][r.name]={'count':r.n_waited,'total':r.wait_total}
+
+        report['simulation']={'events':self.n_events,'wall_time':wall_time,
+                              'events_per_second':self.n_events/wall_time if wall_time>0 else float('nan')}
+        return report
+
+def simulate(workload,policy_names,**options):
+    ### {policy name: report} for each policy on the same workload
+    return {name:simulation(workload,name,**options).run() for name in policy_names}
@@ -0,0 +1,275 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_slice_server.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# HTTP slice server for browsing a library's reconstructions without
+# loading whole volumes.
+#
+# Series are indexed from the library's catalog (catalog.npy) by name, the
+# IMG filename without extension (e.g. <id>_d100_k1_st1.0). Slices are read
+# one at a time from the memory-mapped series and kept, in HU, in a bounded
+# LRU cache shared by all request threads. Requests:
+#
+#     GET /series                     -> JSON list of series and their headers
+#     GET /series/<name>              -> JSON header of one series
+#     GET /series/<name>/slice/<z>    -> one slice
+#     GET /series/<name>/slab/<z0>-<z1> -> slices z0 to z1-1, stacked
+#
+# Slice and slab requests take query parameters:
+#
+#     format=png|f32|i16   PNG (windowed; the default), raw float32 HU or
+#                          raw int16 HU, little endian, slice by slice
+#     roi=x0,y0,x1,y1      crop to columns x0..x1-1 and rows y0..y1-1
+#     step=N               keep every Nth pixel (thumbnails)
+#     window=W&level=L     PNG window/level in HU, or window=lung|bone|...
+#
+# Raw replies carry their shape (slices, rows, columns) in an X-Shape
+# header. PNG slabs are the slices stacked top to bottom.
+
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+from urllib.parse import urlparse,parse_qs
+
+import numpy as np
+
+from CTBB_Pipeline.pypeline import pipeline_img_series
+from CTBB_Pipeline.ctbb_pipeline_catalog import series_catalog
+from CTBB_Pipeline.ctbb_pipeline_compress import series_filepath
+from CTBB_Pipeline.ctbb_pipeline_preview import encode_png,window_level,windows,default_window
+
+default_port=8010
+default_cache_bytes=256*1024*1024
+max_slab_slices=256
+
+class slice_cache:
+    ### Thread-safe LRU cache of HU slices, bounded in bytes
+    max_bytes=None
+    n_bytes=None
+    slices=None
+    hits=None
+    misses=None
+    lock=None
+
+    def __init__(self,max_bytes=default_cache_bytes):
+        self.max_bytes=max_bytes
+        self.n_bytes=0
+        self.slices=OrderedDict()
+        self.hits=0
+        self.misses=0
+        self.lock=threading.Lock()
+
+    def get(self,key,load):
+        ### Cached value for key, calling load() on a miss. Loads happen
+        ### outside the lock so that a slow read does not block other threads.
+        with self.lock:
+            if key in self.slices:
+                self.slices.move_to_end(key)
+                self.hits+=1
+                return self.slices[key]
+            self.misses+=1
+
+        value=load()
+
+        with self.lock:
+            if key not in self.slices:
+                self.slices[key]=value
+                self.n_bytes+=value.nbytes
+            while self.n_bytes>self.max_bytes and len(self.slices)>1:
+                k,v=self.slices.popitem(last=False)
+                self.n_bytes-=v.nbytes
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {'slices':len(self.slices),'bytes':self.n_bytes,'max_bytes':self.max_bytes,
+                    'hits':self.hits,'misses':self.misses}
+
+class series_index:
+    ### Series of a library by name, from its catalog. Opened series are kept
+    ### along with the image file's mtime, and reopened if it changes.
+    library_path=None
+    catalog=None
+    rows=None
+    opened=None
+    lock=None
+
+    def __init__(self,library_path):
+        self.library_path=library_path
+        self.catalog=series_catalog(library_path)
+        self.opened={}
+        self.lock=threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            self.catalog.refresh()
+            rows={}
+            for r in self.catalog.table:
+                img_filepath=r['img_filepath'].decode('utf-8')
+                name=os.path.splitext(os.path.basename(img_filepath))[0]
+                rows[name]=r
+            self.rows=rows
+        logging.info('Slice server indexed %d series' % len(self.rows))
+
+    def describe(self,name):
+        r=self.rows[name]
+        d={'name':name}
+        for f in r.dtype.names:
+            v=r[f]
+            d[f]=v.decode('utf-8') if isinstance(v,bytes) else v.item()
+        return d
+
+    def series(self,name):
+        ### (pipeline_img_series, mtime) of a series; KeyError if unknown
+        # The catalog may still hold the .img of a series compressed since
+        img_filepath=series_filepath(self.rows[name]['img_filepath'].decode('utf-8'))
+        mtime=os.path.getmtime(img_filepath)
+        with self.lock:
+            s=self.opened.get(name)
+            if s is None or s[1]!=mtime:
+                s=(pipeline_img_series(img_filepath,os.path.splitext(img_filepath)[0]+'.prm'),mtime)
+                self.opened[name]=s
+        return s
+
+class request_error(Exception):
+    status=None
+
+    def __init__(self,status,message):
+        Exception.__init__(self,message)
+        self.status=status
+
+def parse_roi(value):
+    x0,y0,x1,y1=[int(v) for v in value.split(',')]
+    return x0,y0,x1,y1
+
+class __slice_handler__(BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+
+    def log_message(self,format,*args):
+        logging.debug('Slice server: '+format % args)
+
+    def reply(self,status,body,content_type,headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type',content_type)
+        self.send_header('Content-Length',str(len(body)))
+        self.send_header('Access-Control-Allow-Origin','*')
+        for k,v in headers.items():
+            self.send_header(k,v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self,obj,status=200):
+        self.reply(status,json.dumps(obj).encode('utf-8'),'application/json')
+
+    def do_GET(self):
+        url=urlparse(self.path)
+        query={k:v[-1] for k,v in parse_qs(url.query).items()}
+        parts=[p for p in url.path.split('/') if p]
+        try:
+            if parts==['series']:
+                if 'refresh' in query:
+                    self.server.index.refresh()
+                self.reply_json([self.server.index.describe(n) for n in sorted(self.server.index.rows)])
+            elif parts==['stats']:
+                self.reply_json(self.server.cache.stats())
+            elif len(parts)==2 and parts[0]=='series':
+                self.reply_json(self.server.index.describe(self.lookup(parts[1])))
+            elif len(parts)==4 and parts[0]=='series' and parts[2] in ['slice','slab']:
+                name=self.lookup(parts[1])
+                if parts[2]=='slice':
+                    z0=int(parts[3])
+                    z1=z0+1
+                else:
+                    z0,z1=[int(z) for z in parts[3].split('-')]
+                self.send_slices(name,z0,z1,query)
+            else:
+                raise request_error(404,'Not found: %s' % url.path)
+        except request_error as e:
+            self.reply_json({'error':str(e)},e.status)
+        except (ValueError,KeyError) as e:
+            self.reply_json({'error':'Bad request: %s' % e},400)
+        except (BrokenPipeError,ConnectionResetError):
+            pass
+        except Exception as e:
+            logging.error('Slice server request %s failed: %s' % (self.path,e))
+            self.reply_json({'error':str(e)},500)
+
+    def lookup(self,name):
+        if name not in self.server.index.rows:
+            raise request_error(404,'No series %s' % name)
+        return name
+
+    def send_slices(self,name,z0,z1,query):
+        series,mtime=self.server.index.series(name)
+        n=series.header.NoOfSlices
+        if not (0<=z0<z1<=n):
+            raise request_error(416,'Slices %d-%d out of range (0-%d)' % (z0,z1,n))
+        if z1-z0>max_slab_slices:
+            raise request_error(413,'At most %d slices per request' % max_slab_slices)
+
+        fmt=query.get('format','png')
+        step=max(1,int(query.get('step',1)))
+        x0,y0,x1,y1=parse_roi(query['roi']) if 'roi' in query else (0,0,series.header.Width,series.header.Height)
+
+        # Cached slices are whole (uncropped) HU slices; the ROI and step are
+        # views into them
+        slices=[self.server.cache.get((series.img_filepath,mtime,z),
+                                      lambda z=z: series.read_slab(z,z+1)[0])[y0:y1:step,x0:x1:step]
+                for z in range(z0,z1)]
+        stack=np.stack(slices)
+
+        if fmt=='png':
+            w=query.get('window',default_window)
+            if w in windows:
+                window,level=windows[w]
+            else:
+                window,level=float(w),float(query.get('level',0))
+            image=window_level(stack.reshape(-1,stack.shape[2]),window,level)
+            self.reply(200,encode_png(image),'image/png')
+        elif fmt in ['f32','i16']:
+            if fmt=='f32':
+                data=stack.astype('<f4')
+            else:
+                data=np.clip(np.rint(stack),-32768,32767).astype('<i2')
+            self.reply(200,data.tobytes(),'application/octet-stream',
+                       {'X-Shape':'%d,%d,%d' % data.shape,'X-Dtype':data.dtype.str})
+        else:
+            raise request_error(400,'Unknown format %s (png, f32 or i16)' % fmt)
+
+class slice_server(ThreadingHTTPServer):
+    daemon_threads=True
+    index=None
+    cache=None
+
+    def __init__(self,library_path,host='127.0.0.1',port=default_port,cache_bytes=default_cache_bytes):
+        self.index=series_index(library_path)
+        self.cache=slice_cache(cache_bytes)
+        ThreadingHTTPServer.__init__(self,(host,port),__slice_handler__)
+
+    def start(self):
+        t=threading.Thread(target=self.serve_forever,daemon=True)
+        t.start()
+        logging.info('Slice server listening on http://%s:%d' % self.server_address[0:2])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
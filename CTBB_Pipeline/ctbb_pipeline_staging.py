@@ -0,0 +1,320 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_staging.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Local scratch staging tier for raw data.
+#
+# Raw files on network shares (original case list entries) and in the library
+# (raw/<dose>/<case id>, see ctbb_pipeline_layout) are copied to a local scratch directory before they
+# are needed, so that hashing, ctbb_simdose and ctbb_recon read from local
+# disk. Enabled by setting 'staging_dir' in the library's settings.yml:
+#
+#     staging_dir:         /scratch/ctbb_staging
+#     staging_capacity:    500e9  # bytes kept on scratch (LRU eviction)
+#     staging_prefetch:    4      # queued jobs to prefetch for
+#     staging_concurrency: 2      # simultaneous prefetch copies
+#     staging_bandwidth:   0      # prefetch bytes/s across all copies (0: no limit)
+#
+# Staged files are named by a key derived from the source, written under a
+# temporary name and renamed into place, and their mtime is bumped on every
+# use so that eviction removes the least recently used files first. Several
+# libraries may share one staging directory.
+#
+# A staged file that a job is about to read is pinned: an empty
+# "<file>.pin.<pid>" next to it, which eviction skips for as long as that
+# process is alive. Jobs pin what they stage until they exit, and the daemon
+# pins the files of the jobs it prefetches for and of running jobs.
+
+import os
+import time
+import logging
+import threading
+from hashlib import md5
+
+from CTBB_Pipeline.pypeline import parse_queue_item
+from CTBB_Pipeline.ctbb_pipeline_layout import raw_filepath
+from CTBB_Pipeline.ctbb_pipeline_lease import pid_alive
+
+chunk_size=4<<20
+
+def staging_key(src):
+    # A source that changes (size or mtime) gets a new key and is restaged
+    st=os.stat(src)
+    ident='%s:%d:%d' % (os.path.abspath(src),st.st_size,int(st.st_mtime))
+    return md5(ident.encode('utf-8')).hexdigest()
+
+class rate_limiter:
+    ### Token bucket shared by all prefetch copies
+    def __init__(self,bytes_per_second):
+        self.rate=float(bytes_per_second)
+        self.lock=threading.Lock()
+        self.next_time=time.time()
+
+    def consume(self,n_bytes):
+        if self.rate<=0:
+            return
+        with self.lock:
+            now=time.time()
+            start=max(self.next_time,now)
+            self.next_time=start+n_bytes/self.rate
+        delay=start-now
+        if delay>0:
+            time.sleep(delay)
+
+class staging_area:
+    path=None
+    capacity=None
+    limiter=None
+    hits=0
+    misses=0
+
+    def __init__(self,path,capacity,bandwidth=0):
+        self.path=path
+        self.capacity=int(float(capacity))
+        self.limiter=rate_limiter(bandwidth)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def staged_path(self,src):
+        return os.path.join(self.path,staging_key(src))
+
+    def is_staged(self,src):
+        return os.path.exists(self.staged_path(src))
+
+    def stage(self,src,throttle=False,pin=False):
+        ### Local copy of src, copying it now if needed. Returns the path to use,
+        ### which is src itself if it could not be staged. With pin, the copy
+        ### is pinned for this process (see unpin_all).
+        try:
+            dst=self.staged_path(src)
+        except OSError:
+            return src
+
+        # Pinned before it is looked at, so that it cannot be evicted between
+        # here and the reader opening it
+        if pin:
+            self.pin(dst)
+        try:
+            os.utime(dst,None)
+            self.hits+=1
+            return dst
+        except OSError:
+            pass
+
+        self.misses+=1
+        try:
+            self.make_room(os.path.getsize(src))
+            self.copy(src,dst,throttle)
+        except OSError as e:
+            logging.warning('Could not stage %s: %s' % (src,e))
+            if pin:
+                self.unpin(dst)
+            return src
+        return dst
+
+    def pin(self,dst):
+        with open('%s.pin.%d' % (dst,os.getpid()),'a'):
+            pass
+
+    def unpin(self,dst):
+        try:
+            os.remove('%s.pin.%d' % (dst,os.getpid()))
+        except OSError:
+            pass
+
+    def unpin_all(self):
+        ### Release every pin of this process
+        suffix='.pin.%d' % os.getpid()
+        for name in os.listdir(self.path):
+            if name.endswith(suffix):
+                self.unpin(os.path.join(self.path,name[:-len(suffix)]))
+
+    def pinned(self,dst):
+        ### Whether a live process has pinned dst (pins of dead ones are removed)
+        prefix=os.path.basename(dst)+'.pin.'
+        for name in os.listdir(self.path):
+            if not name.startswith(prefix):
+                continue
+            try:
+                pid=int(name[len(prefix):])
+            except ValueError:
+                continue
+            if pid_alive(pid):
+                return True
+            try:
+                os.remove(os.path.join(self.path,name))
+            except OSError:
+                pass
+        return False
+
+    def copy(self,src,dst,throttle):
+        tmp='%s.%d.%d.tmp' % (dst,os.getpid(),threading.get_ident())
+        t_start=time.time()
+        try:
+            with open(src,'rb') as f_in:
+                with open(tmp,'wb') as f_out:
+                    while True:
+                        data=f_in.read(chunk_size)
+                        if not data:
+                            break
+                        if throttle:
+                            self.limiter.consume(len(data))
+                        f_out.write(data)
+            os.rename(tmp,dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        t=time.time()-t_start
+        size=os.path.getsize(dst)
+        logging.info('Staged %s (%.1f MB in %.1f s)' % (src,size/1e6,t))
+
+    def entries(self):
+        ### (mtime, size, path) of every staged file, least recently used first
+        entries=[]
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp') or '.pin.' in name or '.evict.' in name:
+                continue
+            p=os.path.join(self.path,name)
+            try:
+                st=os.stat(p)
+            except OSError:
+                continue
+            entries.append((st.st_mtime,st.st_size,p))
+        entries.sort()
+        return entries
+
+    def usage(self):
+        return sum(e[1] for e in self.entries())
+
+    def make_room(self,n_bytes):
+        ### Evict least recently used files until n_bytes more fit under the cap.
+        ### Pinned files are kept.
+        entries=self.entries()
+        total=sum(e[1] for e in entries)
+        for mtime,size,p in entries:
+            if total+n_bytes<=self.capacity:
+                break
+            if self.pinned(p):
+                continue
+            # Taken out of use first, then checked again: a reader pins before
+            # it looks, so a pin that appeared meanwhile means put it back
+            evicted='%s.evict.%d' % (p,os.getpid())
+            try:
+                os.rename(p,evicted)
+            except OSError:
+                continue
+            if self.pinned(p):
+                os.rename(evicted,p)
+                continue
+            try:
+                os.remove(evicted)
+                total-=size
+                logging.info('Evicted %s from staging area' % os.path.basename(p))
+            except OSError:
+                pass
+        if total+n_bytes>self.capacity:
+            raise OSError('staging area full (%d of %d bytes used)' % (total,self.capacity))
+
+def raw_sources(library,qi,case_list=None):
+    ### Files a queue item will read: the share copy if the raw file is not in
+    ### the library yet, otherwise the library's full- or reduced-dose file
+    item=parse_queue_item(qi)
+    if case_list is None:
+        case_list=library.__get_case_list__()
+    filepath=item['filepath']
+    if filepath not in case_list:
+        return [filepath] if os.path.exists(filepath) else []
+
+    case_id=case_list[filepath]
+    reduced=raw_filepath(library,item['dose'],case_id)
+    if os.path.exists(reduced):
+        return [reduced]
+    return [raw_filepath(library,100,case_id)]
+
+class prefetcher:
+    ### Copies the raw files of the next few queued jobs to the staging area on
+    ### background threads, and keeps them and those of running jobs pinned.
+    ### Used by the daemon.
+    def __init__(self,library,staging,n_jobs,concurrency):
+        from queue import Queue
+        self.library=library
+        self.staging=staging
+        self.n_jobs=n_jobs
+        self.pending=Queue()
+        self.in_flight=set()
+        self.wanted=set()
+        self.pins=set()
+        self.lock=threading.Lock()
+        self.threads=[]
+        for i in range(max(1,int(concurrency))):
+            t=threading.Thread(target=self.__worker__,daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def update(self,queue,running=()):
+        ### Schedule the files of the first n_jobs queue items, and pin the
+        ### staged files of those and of the running queue items
+        case_list=self.library.__get_case_list__()
+        wanted=set()
+        for i,qi in enumerate(list(queue[0:self.n_jobs])+list(running)):
+            try:
+                sources=raw_sources(self.library,qi,case_list)
+            except (ValueError,IndexError):
+                continue
+            for src in sources:
+                wanted.add(src)
+                if i>=self.n_jobs:
+                    continue
+                with self.lock:
+                    if src in self.in_flight or self.staging.is_staged(src):
+                        continue
+                    self.in_flight.add(src)
+                self.pending.put(src)
+
+        with self.lock:
+            self.wanted=wanted
+            pins=set()
+            for src in wanted:
+                try:
+                    dst=self.staging.staged_path(src)
+                except OSError:
+                    continue
+                if os.path.exists(dst):
+                    self.staging.pin(dst)
+                    pins.add(dst)
+            for dst in self.pins-pins:
+                self.staging.unpin(dst)
+            self.pins=pins
+
+    def __worker__(self):
+        # Background copies must not starve the I/O of running jobs
+        from CTBB_Pipeline.ctbb_pipeline_cpu import lower_thread_priority
+        lower_thread_priority(self.library,'fetch_raw')
+        while True:
+            src=self.pending.get()
+            try:
+                dst=self.staging.stage(src,throttle=True)
+                with self.lock:
+                    if src in self.wanted and dst!=src:
+                        self.staging.pin(dst)
+                        self.pins.add(dst)
+            except Exception as e:
+                logging.warning('Prefetch of %s failed: %s' % (src,e))
+            finally:
+                with self.lock:
+                    self.in_flight.discard(src)
@@ -0,0 +1,340 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_status.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Status API served by the daemon over a local Unix-domain socket.
+#
+# The daemon keeps its view of the library (queue depth, active job per
+# device, recent completions and errors) in a job_state object and serves it
+# so that viewers never have to re-read the .proc files.  The protocol is one
+# JSON object per line.  Requests:
+#
+#     {"cmd": "snapshot"}   -> one reply line with the full state
+#     {"cmd": "subscribe"}  -> the full state, then one line per change:
+#                              {"event": "queue",    "depth": N}
+#                              {"event": "started",  "device": "dev0@host", "qi": ...}
+#                              {"event": "finished", "device": "dev0@host", "qi": ...}
+#                              {"event": "done",     "qi": ...}
+#                              {"event": "error",    "qi": ..., "status": ..., "class": ...}
+#                              {"event": "eta",      "eta": {"queue": t, "campaigns": {name: t}, ...}}
+#     {"cmd": "ping"}       -> {"ok": true}
+#
+# Additional commands can be registered with status_server.add_command().
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import socketserver
+import tempfile
+from hashlib import md5
+from collections import deque
+from queue import Queue,Empty
+
+from CTBB_Pipeline.ctbb_pipeline_lease import hostname
+
+n_recent=50 # Completions/errors kept for snapshots
+
+def socket_path(library_path,host=None):
+    # One daemon (and socket) per host sharing the library. Unix socket paths
+    # are limited to ~108 bytes; fall back to the temp dir
+    if host is None:
+        host=hostname()
+    path=os.path.join(os.path.abspath(library_path),'.proc','daemon@%s.sock' % host)
+    if len(path.encode('utf-8'))>100:
+        digest=md5(('%s@%s' % (os.path.abspath(library_path),host)).encode('utf-8')).hexdigest()
+        path=os.path.join(tempfile.gettempdir(),'ctbb_pipeline_%s.sock' % digest)
+    return path
+
+class tail_reader:
+    ### Incrementally read lines appended to a file, starting backlog_bytes
+    ### from its end (None: from the beginning)
+    filepath=None
+    offset=None
+    skip_partial=None
+
+    def __init__(self,filepath,backlog_bytes=65536):
+        self.filepath=filepath
+        self.offset=0
+        if os.path.exists(filepath) and backlog_bytes is not None:
+            self.offset=max(0,os.path.getsize(filepath)-backlog_bytes)
+        # Starting mid-file means the first line read is probably partial
+        self.skip_partial=self.offset>0
+
+    def read(self):
+        if not os.path.exists(self.filepath):
+            return []
+        size=os.path.getsize(self.filepath)
+        if size<self.offset:
+            self.offset=0 # File was truncated
+        if size==self.offset:
+            return []
+        with open(self.filepath,'rb') as f:
+            f.seek(self.offset)
+            data=f.read()
+
+        # Only consume complete lines
+        end=data.rfind(b'\n')+1
+        self.offset+=end
+        lines=data[:end].decode('utf-8',errors='replace').splitlines()
+        if self.skip_partial and lines:
+            lines=lines[1:]
+            self.skip_partial=False
+        return [l for l in lines if l]
+
+class job_state:
+    ### Thread-safe view of the library maintained by the daemon
+    lock=None
+    queue_depth=None
+    queue_head=None
+    active=None
+    done=None
+    errors=None
+    extra=None
+    subscribers=None
+    done_reader=None
+    error_reader=None
+
+    def __init__(self,library_path):
+        self.lock=threading.Lock()
+        self.queue_depth=0
+        self.queue_head=[]
+        self.active={}
+        self.done=deque(maxlen=n_recent)
+        self.errors=deque(maxlen=n_recent)
+        self.extra={}
+        self.subscribers=[]
+        self.done_reader=tail_reader(os.path.join(library_path,'.proc','done'))
+        self.error_reader=tail_reader(os.path.join(library_path,'.proc','error'))
+        # Seed recent completions/errors
+        for line in self.done_reader.read():
+            self.done.append(line)
+        for line in self.error_reader.read():
+            self.errors.append(self.__parse_error__(line))
+
+    def __parse_error__(self,line):
+        from CTBB_Pipeline.ctbb_pipeline_retry import parse_error_line
+        try:
+            qi,status,failure_class=parse_error_line(line)
+        except ValueError:
+            qi,status,failure_class=line,'UNKNOWN','unknown'
+        return {'qi':qi,'status':status,'class':failure_class}
+
+    def snapshot(self):
+        with self.lock:
+            s={
+                'time':time.time(),
+                'queue_depth':self.queue_depth,
+                'queue_head':list(self.queue_head),
+                'active':dict(self.active),
+                'done':list(self.done),
+                'errors':list(self.errors),
+            }
+            s.update(self.extra)
+            return s
+
+    def subscribe(self):
+        q=Queue()
+        with self.lock:
+            self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self,q):
+        with self.lock:
+            if q in self.subscribers:
+                self.subscribers.remove(q)
+
+    def __publish__(self,events):
+        # Lock must be held
+        for q in self.subscribers:
+            for e in events:
+                q.put(e)
+
+    def update(self,queue,leases,**extra):
+        ### Called by the daemon once per pass with its current queue and leases
+        events=[]
+
+        new_done=self.done_reader.read()
+        new_errors=[self.__parse_error__(l) for l in self.error_reader.read()]
+        active={device:record.get('qi') for device,record in leases.items()}
+
+        with self.lock:
+            if len(queue)!=self.queue_depth:
+                events.append({'event':'queue','depth':len(queue)})
+            self.queue_depth=len(queue)
+            self.queue_head=list(queue[0:20])
+
+            for device,qi in active.items():
+                if self.active.get(device)!=qi:
+                    events.append({'event':'started','device':device,'qi':qi})
+            for device,qi in self.active.items():
+                if active.get(device)!=qi:
+                    events.append({'event':'finished','device':device,'qi':qi})
+            self.active=active
+
+            for line in new_done:
+                self.done.append(line)
+                events.append({'event':'done','qi':line})
+            for e in new_errors:
+                self.errors.append(e)
+                d={'event':'error'}
+                d.update(e)
+                events.append(d)
+
+            for k,v in extra.items():
+                if self.extra.get(k)!=v:
+                    events.append({'event':k,k:v})
+                self.extra[k]=v
+
+            self.__publish__(events)
+
+        return events
+
+class __status_handler__(socketserver.StreamRequestHandler):
+
+    def send(self,obj):
+        self.wfile.write((json.dumps(obj)+'\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        state=self.server.state
+        for line in self.rfile:
+            try:
+                request=json.loads(line.decode('utf-8'))
+            except ValueError:
+                self.send({'error':'malformed request'})
+                continue
+
+            cmd=request.get('cmd')
+            if cmd=='snapshot':
+                self.send(state.snapshot())
+            elif cmd=='ping':
+                self.send({'ok':True})
+            elif cmd=='subscribe':
+                self.stream(state)
+                return
+            elif cmd in self.server.commands:
+                try:
+                    self.send(self.server.commands[cmd](request))
+                except Exception as e:
+                    logging.error('Status API command %s failed: %s' % (cmd,e))
+                    self.send({'error':str(e)})
+            else:
+                self.send({'error':'unknown command %s' % cmd})
+
+    def stream(self,state):
+        q=state.subscribe()
+        try:
+            self.send(state.snapshot())
+            while not self.server.stopping:
+                try:
+                    e=q.get(timeout=1.0)
+                except Empty:
+                    continue
+                self.send(e)
+        except (BrokenPipeError,ConnectionResetError):
+            pass
+        finally:
+            state.unsubscribe(q)
+
+class status_server(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads=True
+    state=None
+    commands=None
+    stopping=False
+    path=None
+
+    def __init__(self,library_path,state):
+        self.state=state
+        self.commands={}
+        self.path=socket_path(library_path)
+        if os.path.exists(self.path):
+            os.remove(self.path) # Left behind by a daemon that did not exit cleanly
+        socketserver.UnixStreamServer.__init__(self,self.path,__status_handler__)
+
+    def add_command(self,name,function):
+        # function(request dict) -> reply dict
+        self.commands[name]=function
+
+    def start(self):
+        t=threading.Thread(target=self.serve_forever,daemon=True)
+        t.start()
+        logging.info('Status API listening on %s' % self.path)
+
+    def stop(self):
+        self.stopping=True
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class status_client:
+    path=None
+    timeout=None
+
+    def __init__(self,library_path,timeout=5.0):
+        self.path=socket_path(library_path)
+        self.timeout=timeout
+
+    def available(self):
+        return os.path.exists(self.path)
+
+    def __connect__(self):
+        s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        s.connect(self.path)
+        return s
+
+    def request(self,request):
+        s=self.__connect__()
+        try:
+            s.sendall((json.dumps(request)+'\n').encode('utf-8'))
+            f=s.makefile('rb')
+            return json.loads(f.readline().decode('utf-8'))
+        finally:
+            s.close()
+
+    def snapshot(self):
+        return self.request({'cmd':'snapshot'})
+
+    def subscribe(self):
+        ### Generator yielding the initial snapshot and then each change event
+        s=self.__connect__()
+        s.settimeout(None)
+        try:
+            s.sendall((json.dumps({'cmd':'subscribe'})+'\n').encode('utf-8'))
+            f=s.makefile('rb')
+            for line in f:
+                yield json.loads(line.decode('utf-8'))
+        finally:
+            s.close()
+
+def read_snapshot_from_files(library_path):
+    ### Fallback used when no daemon is running: build a snapshot from .proc
+    from CTBB_Pipeline.ctbb_pipeline_lease import read_leases
+    from CTBB_Pipeline.ctbb_pipeline_library import ctbb_pipeline_library
+    from CTBB_Pipeline import ctbb_pipeline_campaign as campaigns
+    proc_dir=os.path.join(library_path,'.proc')
+    with open(os.path.join(proc_dir,'queue'),'r') as f:
+        queue=f.read().splitlines()
+    state=job_state(library_path)
+    state.update(queue,read_leases(os.path.join(proc_dir,'leases')),
+                 campaigns=campaigns.progress(ctbb_pipeline_library(library_path)))
+    return state.snapshot()
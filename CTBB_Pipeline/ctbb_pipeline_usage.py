@@ -0,0 +1,132 @@
+# CTBB_Pipeline_Package is GPU Queuing Software
+# Copyright (C) 2017 John Hoffman
+
+# ctbb_pipeline_usage.py (this file) is part of CTBB_Pipeline and CTBB_Pipeline_Package.
+#
+# CTBB_Pipeline is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CTBB_Pipeline and CTBB_Pipeline_Package is distributed in the hope
+# that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CTBB_Pipeline and CTBB_Pipeline_Package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+# Resource accounting of the external programs a job runs (ctbb_info,
+# ctbb_simdose, ctbb_recon).
+#
+# run() starts the program, waits for it to exit without reaping it, reads
+# its /proc/<pid>/io (which by then includes the children it reaped, e.g. the
+# program a shell started) and then reaps it with wait4, whose rusage gives
+# CPU time and peak RSS. Each call gives a record:
+#
+#     command      program that was run
+#     exit_status  as subprocess.call (negative: killed by that signal)
+#     wall         seconds from start to exit
+#     utime/stime  user/system CPU seconds
+#     maxrss_kb    peak resident set size (largest of the process tree)
+#     rchar/wchar  bytes read/written through system calls
+#     read_bytes/write_bytes  bytes read from/written to storage
+#
+# log_usage writes a record to the job's log as a "USAGE: stage=... ..." line,
+# which ctbb_pipeline_metrics reads back with parse_usage. Where
+# /proc/<pid>/io cannot be read (not Linux, or a kernel without task I/O
+# accounting) the I/O fields are 0.
+
+import os
+import time
+import logging
+import subprocess
+
+usage_fields=['command','exit_status','wall','utime','stime','maxrss_kb',
+              'rchar','wchar','read_bytes','write_bytes']
+io_fields=['rchar','wchar','read_bytes','write_bytes']
+
+def read_proc_io(pid):
+    ### /proc/<pid>/io as a dict of ints (empty if it cannot be read)
+    io={}
+    try:
+        with open('/proc/%d/io' % pid,'r') as f:
+            for line in f.read().splitlines():
+                key,value=line.split(':',1)
+                io[key.strip()]=int(value)
+    except (OSError,ValueError):
+        return {}
+    return io
+
+def exit_code(status):
+    ### wait status -> return code as subprocess.call gives it
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def run(args,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,shell=False,command=None):
+    ### Blocking call like subprocess.call. Returns (exit_status,record).
+    ### command names the program in the record (default: the first argument).
+    t_start=time.time()
+    p=subprocess.Popen(args,shell=shell,stdout=stdout,stderr=stderr)
+    io={}
+    try:
+        # Wait for the exit but leave the process a zombie, so that its
+        # /proc/<pid>/io is still there to read
+        if hasattr(os,'waitid'):
+            os.waitid(os.P_PID,p.pid,os.WEXITED|os.WNOWAIT)
+            io=read_proc_io(p.pid)
+        pid,status,rusage=os.wait4(p.pid,0)
+    except:
+        p.kill()
+        p.wait()
+        raise
+    p.returncode=exit_code(status) # Reaped; Popen must not wait for it again
+
+    if command is None and shell:
+        command=args.split()[0] if args.split() else ''
+    elif command is None:
+        command=args[0]
+
+    record={
+        'command'     : os.path.basename(command),
+        'exit_status' : p.returncode,
+        'wall'        : time.time()-t_start,
+        'utime'       : rusage.ru_utime,
+        'stime'       : rusage.ru_stime,
+        'maxrss_kb'   : rusage.ru_maxrss,
+    }
+    for key in io_fields:
+        record[key]=io.get(key,0)
+    return p.returncode,record
+
+def format_usage(stage,record):
+    ### One line "stage=... command=... exit_status=... ..." for a record
+    fields=['stage=%s' % stage]
+    for key in usage_fields:
+        value=record[key]
+        fields.append('%s=%s' % (key,('%.3f' % value) if isinstance(value,float) else value))
+    return ' '.join(fields)
+
+def log_usage(stage,record):
+    logging.info('USAGE: %s' % format_usage(stage,record))
+
+def parse_usage(line):
+    ### Record (with its 'stage') from a log line, or None if it has none
+    if 'USAGE: ' not in line:
+        return None
+    record={}
+    for token in line.split('USAGE: ',1)[1].split():
+        if '=' not in token:
+            continue
+        key,value=token.split('=',1)
+        if key in ['stage','command']:
+            record[key]=value
+        elif key in ['wall','utime','stime']:
+            record[key]=float(value)
+        else:
+            record[key]=int(value)
+    if 'stage' not in record:
+        return None
+    return record
@@ -24,35 +24,122 @@
 
 import sys
 import os
+import ast
 import time
 
 import logging
-import yaml
+import threading
 
-from subprocess import call
+from enum import Enum
 
-import numpy as np
+from CTBB_Pipeline.ctbb_pipeline_lease import hostname
+from CTBB_Pipeline import ctbb_pipeline_usage as usage
+
+# numpy and yaml are imported where they are used: most entry points only
+# need mutex and the queue item helpers, and should start quickly
 
 path_file="\\\skynet\cvib\PechinTest2\scripts\paths.yml"
 
+mu_water=0.01926 # Attenuation of water used to convert IMG data into HU
+
 def test_func():
     print("pypeline successfully loaded")
 
+def __map_series_worker__(args):
+    func,item,kwargs=args
+    try:
+        return (item,func(item,**kwargs))
+    except Exception as e:
+        logging.error('%s of %s failed: %s' % (func.__name__,item,e))
+        return (item,None)
+
+def map_series(func,items,n_processes=None,**kwargs):
+    ### Call func(item,**kwargs) for each item on a process pool and yield
+    ### (item,result) as they finish. A failure is logged and yields a None
+    ### result rather than killing the pool. func must be a module-level
+    ### function so that it can be sent to the workers.
+    from multiprocessing import Pool
+    with Pool(processes=n_processes) as pool:
+        for item,result in pool.imap_unordered(__map_series_worker__,[(func,item,kwargs) for item in items]):
+            yield (item,result)
+
 def touch(path):
     with open(path,'a'):
         os.utime(path,None);
 
 def load_paths():
+    import yaml
     try:    
         with open('paths.yml','r') as f:
-            path_dict=yaml.load(f)
+            path_dict=yaml.safe_load(f)
     except:
         with open(path_file,'r') as f:
-            path_dict=yaml.load(f)
+            path_dict=yaml.safe_load(f)
         
     return path_dict
 
+def parse_prm_value(v):
+    # Numbers, (nested) [a,b,...] lists of numbers, or strings. Raises
+    # ValueError for lists of anything else but flat lists of words.
+    if v.startswith('[') and v.endswith(']'):
+        try:
+            value=ast.literal_eval(v)
+        except (ValueError,SyntaxError):
+            if '[' in v[1:]:
+                raise ValueError('Cannot parse %s' % v)
+            items=[i.strip() for i in v[1:-1].split(',')]
+            return [parse_prm_value(i) for i in items if i]
+        if not isinstance(value,list):
+            raise ValueError('Cannot parse %s' % v)
+        return value
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+def parse_prm(string):
+    ### Parse a CTBangBang parameter file (PRM/PRMB) into a dictionary.
+    ###
+    ### Parameter files are flat "Key:<tab or spaces>value" lines with % or #
+    ### comments, which are parsed directly. Anything else falls back to the
+    ### YAML parser (the C loader if PyYAML was built with it).
+    prm={}
+    for line in string.splitlines():
+        for c in '%#':
+            if c in line:
+                line=line[0:line.index(c)]
+        line=line.strip()
+        if not line:
+            continue
+        key,sep,value=line.partition(':')
+        key=key.strip()
+        value=value.strip()
+        if not sep or not key or ' ' in key or not value or value[0] in '{|>&*!\'"':
+            return parse_prm_yaml(string)
+        if value.startswith('[') and not value.endswith(']'):
+            return parse_prm_yaml(string)
+        try:
+            prm[key]=parse_prm_value(value)
+        except ValueError:
+            return parse_prm_yaml(string)
+    return prm
+
+def parse_prm_yaml(string):
+    import yaml
+    Loader=getattr(yaml,'CSafeLoader',yaml.SafeLoader)
+    string=string.replace('\t',' ').replace('%','#')
+    return yaml.load(string,Loader=Loader) or {}
+
+def read_prm(filepath):
+    with open(filepath,'r',encoding='utf8') as f:
+        return parse_prm(f.read())
+
 def load_config(filepath):
+    import yaml
 
     logging.info('Loading configuration file: %s' % filepath)
 
@@ -60,7 +147,7 @@ def load_config(filepath):
     with open(filepath,'r') as f:
         yml_string=f.read();
 
-    config_dict=yaml.load(yml_string)
+    config_dict=yaml.safe_load(yml_string)
 
     # We only require that a case list and output library be defined
     if ('case_list' not in config_dict.keys()) or ('library' not in config_dict.keys()):
@@ -91,9 +178,60 @@ def load_config(filepath):
             #config_dict={}
             
     return config_dict
-        
+
+class qi_status(Enum):
+    SUCCESS              = 0
+    NO_RAW               = 1
+    DOSE_REDUCTION_ERROR = 2
+    PRM_CREATION_ERROR   = 3
+    RECONSTRUCTION_ERROR = 4
+    JOB_LOST             = 5 # Job process died without reporting (see ctbb_pipeline_lease)
+    QUARANTINED          = 6 # Raw file failed too often and is no longer scheduled
+    CANCELLED            = 7 # Cancelled by the user (see ctbb_pipeline_control)
+
+# Queue items are text lines of the form:
+#     /path/to/raw/file,dose,kernel,slice_thickness[,key=value,...]
+# The first four fields identify the job (its "key"). Any trailing key=value
+# fields carry scheduling information (e.g. attempt=2) and are optional.
+
+def parse_queue_item(qi):
+    fields=qi.strip().split(',')
+    item={
+        'filepath'        : fields[0],
+        'dose'            : fields[1],
+        'kernel'          : fields[2],
+        'slice_thickness' : fields[3],
+        'options'         : {},
+    }
+    for f in fields[4:]:
+        if '=' in f:
+            k,v=f.split('=',1)
+            item['options'][k]=v
+    return item
+
+def format_queue_item(item):
+    fields=[item['filepath'],str(item['dose']),str(item['kernel']),str(item['slice_thickness'])]
+    for k,v in item['options'].items():
+        fields.append('%s=%s' % (k,v))
+    return ','.join(fields)
+
+def queue_item_key(qi):
+    return ','.join(qi.strip().split(',')[0:4])
+
+def set_queue_item_option(qi,key,value):
+    item=parse_queue_item(qi)
+    item['options'][key]=str(value)
+    return format_queue_item(item)
+
+def get_queue_item_option(qi,key,default=None):
+    return parse_queue_item(qi)['options'].get(key,default)
 
 class mutex:
+    ### Lock shared by every process (on every host) using a library.
+    ###
+    ### The lock is taken by hard-linking a uniquely named file to the mutex
+    ### file, which is atomic even over NFS (unlike checking for the file and
+    ### then creating it). The mutex file records the owner's host and PID.
     name=None;
     mutex_dir=None;
     mutex_file=None;
@@ -110,16 +248,94 @@ class mutex:
     def __exit__(self,type,value,traceback):
         self.unlock()
 
+    def __owner_file__(self,pid=None):
+        # Write a uniquely named file describing the (would-be) owner
+        tmp='%s.%s.%d.%d.tmp' % (self.mutex_file,hostname(),os.getpid(),threading.get_ident())
+        with open(tmp,'w') as f:
+            f.write('%s %d %f\n' % (hostname(),os.getpid() if pid is None else pid,time.time()))
+        return tmp
+
+    def try_lock(self):
+        tmp=self.__owner_file__()
+        try:
+            os.link(tmp,self.mutex_file)
+        except OSError:
+            pass
+        try:
+            # Over NFS link() can report failure after succeeding; the link
+            # count of our own file is what tells
+            return os.stat(tmp).st_nlink==2
+        finally:
+            os.remove(tmp)
+
     def lock(self):
-        # If mutex alread locked, wait for other process to unlock
-        while os.path.exists(self.mutex_file):
+        # If mutex already locked, wait for other process to unlock
+        t_start=time.time()
+        delay=0.05
+        while not self.try_lock():
             logging.debug('Mutex ' + self.name  + ' locked. Sleeping and trying again')
-            time.sleep(5)
-        touch(self.mutex_file)
+            time.sleep(delay)
+            delay=min(2*delay,5)
+
+        # Lock wait time is mined by ctbb_pipeline_bench
+        t_wait=time.time()-t_start
+        if t_wait>0.001:
+            logging.info('Mutex %s acquired after waiting %.3f s' % (self.name,t_wait))
 
     def unlock(self):
         os.remove(self.mutex_file)
 
+    def owner(self):
+        ### (host, pid) of the current holder, or None if unlocked
+        return self.__parse_owner__(self.__read_owner__(self.mutex_file))
+
+    def __read_owner__(self,path):
+        try:
+            with open(path,'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def __parse_owner__(self,record):
+        try:
+            fields=record.split()
+            return (fields[0],int(fields[1]))
+        except (AttributeError,IndexError,ValueError):
+            return None
+
+    def claim_if_dead(self,is_dead):
+        ### Remove the lock if is_dead((host, pid)) says its holder is gone.
+        ### Returns the dead holder's (host, pid), or None if the lock was left.
+        ###
+        ### The lock file is first renamed to a private name, and the holder
+        ### read again there: if the lock was released and taken by someone
+        ### else between the two reads, it is put back rather than removed.
+        record=self.__read_owner__(self.mutex_file)
+        owner=self.__parse_owner__(record)
+        if owner is None or not is_dead(owner):
+            return None
+        claimed='%s.%s.%d.%d.dead.tmp' % (self.mutex_file,hostname(),os.getpid(),threading.get_ident())
+        try:
+            os.rename(self.mutex_file,claimed)
+        except OSError:
+            return None # Released, or claimed by another process meanwhile
+        try:
+            if self.__read_owner__(claimed)!=record:
+                # Not the dead holder's lock any more: restore it (link, so
+                # as not to overwrite a lock taken in the meantime)
+                try:
+                    os.link(claimed,self.mutex_file)
+                except OSError:
+                    logging.warning('Mutex %s changed hands while its dead holder was removed' % self.name)
+                return None
+            return owner
+        finally:
+            os.remove(claimed)
+
+    def adopt(self):
+        ### Take over a lock held on our behalf (e.g. by the daemon for a job)
+        os.rename(self.__owner_file__(),self.mutex_file)
+
     def check_state(self):
         state=os.path.exists(self.mutex_file)
 
@@ -163,7 +379,8 @@ class case_list:
     def get_prmbs(self):
         logging.info('Generating parameter files and reading into pipeline');
 
-        prmbs=[];
+        self.prmbs=[];
+        self.prmbs_raw=[];
 
         for f in self.case_list:
     
@@ -171,19 +388,16 @@ class case_list:
                 continue
             
             # Generate the parameter file
-            devnull=open(os.devnull,'w')
-            call(['ctbb_info','-b',f],stdout=devnull,stderr=devnull);
+            exit_status,record=usage.run(['ctbb_info','-b',f])
+            usage.log_usage('prmb',record)
     
             # Open the parameter file and read into pipeline
             with open(f+'.prmb') as f_prmb:
                 self.prmbs_raw.append(f_prmb.read())
-                prmbs.append(f_prmb.read())
 
-        # Sanitize and parse into dictionaries
-        for s in prmbs:
-            s=s.replace('\t','  ')
-            s=s.replace('%','#')
-            self.prmbs.append(yaml.load(s))
+        # Parse into dictionaries
+        for s in self.prmbs_raw:
+            self.prmbs.append(parse_prm(s))
 
 
 class study_directory:
@@ -259,81 +473,104 @@ class study_directory:
 #            with open(os.path.join(self.path,f),'w') as fid:
 #                fid.write(s);
 
+class series_header:
+    ### Immutable metadata of one reconstructed series. Naming conventions are
+    ### those given in MATLAB where applicable, which follow the DICOM standard.
+    __slots__=('StartPos',
+               'EndPos',
+               'DataCollectionDiameter',
+               'ReconstructionDiameter',
+               'Width',
+               'Height',
+               'ConvolutionKernel',
+               'ImagePositionPatient',
+               'ImageOrientationPatient',
+               'DataCollectionCenterPatient',
+               'ReconstructionTargetCenterPatient',
+               'SliceThickness',
+               'SpiralPitchFactor',
+               'TableFeedPerRotation',
+               'SingleCollimationWidth',
+               'TotalCollimationWidth',
+               'NoOfSlices')
+
+    def __init__(self,**kwargs):
+        for f in self.__slots__:
+            object.__setattr__(self,f,kwargs.get(f))
+
+    def __setattr__(self,name,value):
+        raise AttributeError('series_header is immutable')
+
+    def __repr__(self):
+        return 'series_header(%s)' % ', '.join('%s=%r' % (f,getattr(self,f)) for f in self.__slots__)
+
+    def _asdict(self):
+        return {f:getattr(self,f) for f in self.__slots__}
+
+    @classmethod
+    def from_prm(cls,prm,img_filepath=None):
+        ### Map a parameter file dictionary over to a header. The number of slices
+        ### is taken from the size of the image file if there is one.
+        total_collimation=float(prm['Nrows'])*prm['CollSlicewidth']
+        n_slices=None
+        if img_filepath is not None and img_filepath.endswith('.imgz') and os.path.exists(img_filepath):
+            from CTBB_Pipeline.ctbb_pipeline_compress import read_header
+            n_slices=read_header(img_filepath)['NoOfSlices']
+        elif img_filepath is not None and os.path.exists(img_filepath):
+            n_pixels=os.path.getsize(img_filepath)//4 # Pixels are single-precision floats (4 bytes)
+            n_slices=int(n_pixels//(int(prm['Nx'])*int(prm['Ny'])))
+
+        return cls(Width                             = prm['Nx'],
+                   Height                            = prm['Ny'],
+                   StartPos                          = prm['StartPos'],
+                   EndPos                            = prm['EndPos'],
+                   DataCollectionDiameter            = prm['AcqFOV'],
+                   ReconstructionDiameter            = prm['ReconFOV'],
+                   ConvolutionKernel                 = prm['ReconKernel'],
+                   ImagePositionPatient              = None,
+                   ImageOrientationPatient           = prm['ImageOrientationPatient'],
+                   DataCollectionCenterPatient       = None,
+                   ReconstructionTargetCenterPatient = (prm['Xorigin'],prm['Yorigin'],prm['StartPos']),
+                   SliceThickness                    = prm['SliceThickness'],
+                   TableFeedPerRotation              = prm['PitchValue'],
+                   SingleCollimationWidth            = prm['CollSlicewidth'],
+                   TotalCollimationWidth             = total_collimation,
+                   SpiralPitchFactor                 = prm['PitchValue']/total_collimation,
+                   NoOfSlices                        = n_slices)
+
 class pipeline_img_series:
-    from collections import namedtuple    
-    fields=('StartPos'
-            ' EndPos'
-            ' DataCollectionDiameter'
-            ' ReconstructionDiameter'
-            ' Width'
-            ' Height'
-            ' ConvolutionKernel'
-            ' ImagePositionPatient'
-            ' ImageOrientationPatient'
-            ' DataCollectionCenterPatient'
-            ' ReconstructionTargetCenterPatient'
-            ' SliceThickness'
-            ' SpiralPitchFactor'
-            ' TableFeedPerRotation'
-            ' SingleCollimationWidth'
-            ' TotalCollimationWidth'
-            ' NoOfSlices'
-    )    
-    header=namedtuple('header',fields)
+    fields=series_header.__slots__
     img_filepath=None
     prm_filepath=None
+    header=None
     stack=None
+    compressed=None
     
     def __init__(self,img_filepath,prm_filepath):
         ### Constructor reads PRM file and loads metadata. Note that image data is NOT
         ### loaded by default. This is done through the to_memory() method.
+        ### img_filepath may name the series' .img or its compressed .imgz
+        ### (see ctbb_pipeline_compress); whichever exists is read.
+        from CTBB_Pipeline.ctbb_pipeline_compress import series_filepath,is_compressed,compressed_series
 
         # Copy our filepaths into the object
-        self.img_filepath=img_filepath
+        self.img_filepath=series_filepath(img_filepath)
         self.prm_filepath=prm_filepath
-        
-        # Load up the "header" information
-        # I.E. Map the parameter file dictionary over to our headers structure
-        # Note: naming conventions are those given in MATLAB where applicable
-        # The MATLAB naming conventions follow the DICOM standard.
-        with open(self.prm_filepath,'r',encoding='utf8') as f:
-            #print(os.path.abspath(self.prm_filepath))
-            logging.error(self.prm_filepath)
-            string=f.read()
-            string=string.replace('\t',' ') # Pull out the tabs in case we're using old CTBangBang stuff
-            prm=yaml.load(string)
-
-        self.header.Width                             = prm['Nx']
-        self.header.Height                            = prm['Ny']            
-        self.header.StartPos                          = prm['StartPos']
-        self.header.EndPos                            = prm['EndPos']
-        self.header.DataCollectionDiameter            = prm['AcqFOV']
-        self.header.ReconstructionDiameter            = prm['ReconFOV']
-        self.header.ConvolutionKernel                 = prm['ReconKernel']
-        self.header.ImagePositionPatient              = None
-        self.header.ImageOrientationPatient           = prm['ImageOrientationPatient']
-        self.header.DataCollectionCenterPatient       = None
-        self.header.ReconstructionTargetCenterPatient = (prm['Xorigin'],prm['Yorigin'],prm['StartPos'])
-        self.header.SliceThickness                    = prm['SliceThickness']
-        self.header.TableFeedPerRotation              = prm['PitchValue']
-        self.header.SingleCollimationWidth            = prm['CollSlicewidth']
-        self.header.TotalCollimationWidth             = float(prm['Nrows'])*prm['CollSlicewidth']
-        self.header.SpiralPitchFactor                 = self.header.TableFeedPerRotation/self.header.TotalCollimationWidth
-
-        # Determine the number of slices in the image
-        with open(self.img_filepath,'r') as f:
-            f.seek(0,os.SEEK_END)
-            eof=f.tell()
-            n_pixels=eof/4 # Pixels are single-precision floats (4 bytes)
-            self.header.NoOfSlices=int(int(n_pixels)/(int(self.header.Width)*int(self.header.Height)))
+        self.header=series_header.from_prm(read_prm(self.prm_filepath),self.img_filepath)
+        if is_compressed(self.img_filepath):
+            self.compressed=compressed_series(self.img_filepath)
 
+    def print_header(self):
         # Print a copy of the mapped metadata
-        self.fields=self.fields.split(' ')
         for f in self.fields:
-            print('{}: {}'.format(f,eval('self.header.{}'.format(f))))
-        
+            print('{}: {}'.format(f,getattr(self.header,f)))
+
     def to_memory(self):
         ### Method to load the image stack into memory (as a numpy array)
+        import numpy as np
+        if self.compressed is not None:
+            self.stack=self.read_slab(0,self.header.NoOfSlices)
+            return
         with open(self.img_filepath,'r') as f:
             f.seek(0,os.SEEK_SET);
             self.stack=np.fromfile(f,'float32')
@@ -343,8 +580,41 @@ class pipeline_img_series:
         self.stack=1000*(self.stack-0.01926)/(0.01926) # Convert to HU
         self.stack=np.transpose(self.stack,(0,2,1)) # Images from CTBangBang are transposed, this corrects it
 
+    def to_memmap(self):
+        ### Method to map the image stack without reading it into memory. Values are
+        ### raw attenuation in the on-disk (transposed) orientation. A compressed
+        ### series cannot be mapped, and is decompressed into memory instead.
+        import numpy as np
+        if self.compressed is not None:
+            stack=self.compressed.read_hu(0,self.header.NoOfSlices)
+            stack*=mu_water/1000.0
+            stack+=mu_water
+            return stack
+        return np.memmap(self.img_filepath,dtype='float32',mode='r',
+                         shape=(self.header.NoOfSlices,self.header.Width,self.header.Height))
+
+    def read_slab(self,start,stop):
+        ### Method to read slices [start,stop) as a HU numpy array oriented the same
+        ### way as to_memory(). Only the requested slices are read from disk.
+        ### A compressed series only decompresses the chunks holding them.
+        import numpy as np
+        if self.compressed is not None:
+            return np.transpose(self.compressed.read_hu(start,stop),(0,2,1))
+        stack=self.to_memmap()
+        slab=np.array(stack[start:stop],dtype='float32')
+        slab-=mu_water
+        slab*=1000.0/mu_water
+        return np.transpose(slab,(0,2,1))
+
+    def iter_slabs(self,slab_size=32):
+        ### Generator yielding (first slice index, HU slab) pairs of at most
+        ### slab_size slices so that whole volumes never have to be in memory
+        for start in range(0,self.header.NoOfSlices,slab_size):
+            yield start,self.read_slab(start,min(start+slab_size,self.header.NoOfSlices))
+
     def to_hr2(self,outpath):
         ### Method to convert img file to hr2
+        import numpy as np
         ## Attempt to load the QIA toolbox, raise error if it doesn't work
         try:
             path_dict=load_paths()
@@ -23,7 +23,6 @@
 import sys
 import os
 import logging
-from subprocess import call
 from time import strftime
 from pyqtgraph.PyQt4 import QtGui, QtCore, uic
 import shutil
@@ -34,7 +33,13 @@ import traceback
 
 from ctbb_pipeline_library import ctbb_pipeline_library as ctbb_plib
 from ctbb_pipeline_library import mutex
+from ctbb_pipeline_library import ingest_status
 from pypeline import load_config
+from CTBB_Pipeline.ctbb_pipeline_status import status_client
+from CTBB_Pipeline import ctbb_pipeline_campaign as campaigns
+from CTBB_Pipeline.ctbb_pipeline_layout import prmb_filepath
+from CTBB_Pipeline import ctbb_pipeline_usage as usage
+from CTBB_Pipeline.ctbb_pipeline_recon_store import view,sort_columns
 
 class update_thread(QtCore.QThread):
     received = QtCore.pyqtSignal([str],[unicode]);
@@ -53,6 +58,7 @@ class MyWindow(QtGui.QMainWindow):
     test_library=None;
     update_thread=None;
     run_dir=None;
+    ingest_raw=True;
 
     def __init__(self,config_dict={}):
         logging.getLogger("PyQt4").setLevel(logging.WARNING)
@@ -85,8 +91,7 @@ class MyWindow(QtGui.QMainWindow):
             self.set_gui_from_config(config_dict)
 
     def refresh_gui(self):
-        print('Refreshing temporarily disabled')
-        #self.refresh_library_tab()
+        self.refresh_library_tab()
         #self.refresh_active_jobs_tab()
 
     def set_gui_from_config(self,config_dict):
@@ -94,6 +99,9 @@ class MyWindow(QtGui.QMainWindow):
         self.select_cases_callback(config_dict)
         self.select_library_callback(config_dict)
 
+        # Not shown in the GUI; kept for the configurations it writes
+        self.ingest_raw=config_dict.get('ingest_raw',True)
+
         # Set dose checkboxes
         for d in config_dict['doses']:
             if d==100:
@@ -222,8 +230,7 @@ class MyWindow(QtGui.QMainWindow):
             self.ui.selectLibrary_edit.setText(dirname)
             self.current_library=pipeline_lib
             
-            print('Refresh currently disabled')
-            #self.refresh_library_tab()
+            self.refresh_library_tab()
             #self.refresh_active_jobs_tab()
         except NameError:
             exc_type, exc_value, exc_traceback = sys.exc_info()     
@@ -249,7 +256,7 @@ class MyWindow(QtGui.QMainWindow):
             logging.info('Queue high priority callback active')
             self.flush_prmbs()
             ds,sts,ks=self.gather_run_parameters()
-            config_file=self.generate_config_file(ds,sts,ks)
+            config_file=self.generate_config_file(ds,sts,ks,priority='high')
             self.launch_pipeline(config_file)
         except NameError:
             exc_type, exc_value, exc_traceback = sys.exc_info()     
@@ -263,6 +270,9 @@ class MyWindow(QtGui.QMainWindow):
             sys.exit()
 
     def close_application_callback(self):
+        model=self.ui.library_tableView.model()
+        if isinstance(model,library_table_model):
+            model.stop()
         try:
             sys.exit()
         except NameError:
@@ -300,7 +310,7 @@ class MyWindow(QtGui.QMainWindow):
             logging.info(''.join('ERROR TRACEBACK: ' + line for line in lines))
                 
 
-    def generate_config_file(self,doses,slice_thicknesses,kernels):
+    def generate_config_file(self,doses,slice_thicknesses,kernels,priority='normal'):
         f=tempfile.NamedTemporaryFile()
 
         case_string   = "case_list: %s\n" % self.current_case_list_path
@@ -320,12 +330,50 @@ class MyWindow(QtGui.QMainWindow):
             f.write(sts_string)
         if kernels:
             f.write(kernel_string)
+        if priority!='normal':
+            f.write("priority: %s\n" % priority)
+        if not self.ingest_raw:
+            f.write("ingest_raw: false\n")
 
         f.seek(0,0)
             
         return f
 
+    def ingest_raw_data(self):
+        # Copy the new raw data into the library before its jobs are queued.
+        # The copy runs on a worker thread; the window keeps responding (in a
+        # local event loop) and the dialog can cancel it. Returns False if it
+        # was cancelled or failed.
+        worker=ingest_worker(self.current_library,self.current_cases,self)
+        dialog=QtGui.QProgressDialog('Ingesting raw data...','Cancel',0,1000,self)
+        dialog.setWindowTitle('Ingesting raw data')
+        dialog.setWindowModality(QtCore.Qt.WindowModal)
+        dialog.setMinimumDuration(0)
+        def progress(status):
+            dialog.setValue(int(1000*status['bytes_done']/max(1,status['bytes_total'])))
+            dialog.setLabelText('Ingesting raw data: %s' % ingest_status(status))
+        worker.progress.connect(progress)
+        dialog.canceled.connect(worker.cancel)
+        loop=QtCore.QEventLoop()
+        worker.finished.connect(loop.quit)
+        worker.start()
+        loop.exec_()
+        # Closing the dialog signals canceled, so take the outcome first
+        cancelled,error=worker.cancelled,worker.error
+        dialog.close()
+        if error is not None:
+            self.error_dialog('Could not ingest the raw data: %s' % error)
+            return False
+        return not cancelled
+
     def launch_pipeline(self,config_file):
+        # 'ingest_raw: false' in the configuration leaves the copies to the jobs
+        config=yaml.safe_load(config_file.read()) or {}
+        config_file.seek(0,0)
+        if config.get('ingest_raw',True):
+            if not self.ingest_raw_data():
+                logging.info('Raw data ingestion cancelled; nothing launched')
+                return
         # Test code:
         #print('')
         print(config_file.name)
@@ -344,9 +392,7 @@ class MyWindow(QtGui.QMainWindow):
         prmb_text=raw_prm_text.split('#####! DO NOT EDIT THIS LINE !#####\n')
         for i in range(1,len(prmb_text)):
 
-            output_file_name=os.path.basename(self.current_cases[i-1])+'.prmb'
-            output_dir_name=os.path.join(self.current_library.path,'raw')
-            output_fullpath=os.path.join(output_dir_name,output_file_name);
+            output_fullpath=prmb_filepath(self.current_library,self.current_cases[i-1],create=True)
             
             with open(output_fullpath,'w') as f:
                 f.write(prmb_text[i])
@@ -401,15 +447,15 @@ class MyWindow(QtGui.QMainWindow):
 
     def refresh_library_tab(self):
         logging.info('Refreshing library tab')
-        self.current_library.refresh_recon_list()
-        with open(os.path.join(self.current_library.path,'recons.csv'),'r') as f:
-            recon_list=f.read().splitlines();
-            
-        for i in range(len(recon_list)):
-            recon_list[i]=recon_list[i].split(',')
-
-        table_model=MyTableModel(recon_list)
-        self.ui.library_tableView.setModel(table_model)
+        # The model reads the recon store on its own thread and fetches rows a
+        # page at a time, so this returns immediately even for large libraries
+        model=self.ui.library_tableView.model()
+        if not isinstance(model,library_table_model) or model.library.path!=self.current_library.path:
+            if isinstance(model,library_table_model):
+                model.stop()
+            model=library_table_model(self.current_library)
+            self.ui.library_tableView.setModel(model)
+        model.refresh()
 
     def refresh_active_jobs_tab(self):
         logging.info('Refreshing active jobs tab')
@@ -418,17 +464,42 @@ class MyWindow(QtGui.QMainWindow):
         self.ui.completed_listWidget.clear()
         self.ui.error_listWidget.clear()
         
-        # Repopulate contents
+        # Repopulate contents. Ask the daemon if one is running rather than
+        # re-reading the (potentially very large) .proc files.
         proc_dir=os.path.join(self.current_library.path,'.proc')
+        client=status_client(self.current_library.path)
+
+        snapshot=None
+        if client.available():
+            try:
+                snapshot=client.snapshot()
+            except OSError:
+                # e.g. the stale socket of a daemon that was killed
+                logging.info('Daemon status socket not answering; reading .proc instead')
+
+        if snapshot is not None:
+            queue_list=snapshot['queue_head']
+            if snapshot['queue_depth']>len(queue_list):
+                queue_list.append('... %d more' % (snapshot['queue_depth']-len(queue_list)))
+            done_list=snapshot['done']
+            error_list=['%s:%s:%s' % (e['qi'],e['status'],e['class']) for e in snapshot['errors']]
+            progress=snapshot.get('campaigns') or {}
+        else:
+            with open(os.path.join(proc_dir,'queue'),'r') as f:
+                queue_list=f.read().splitlines()
+
+            with open(os.path.join(proc_dir,'done'),'r') as f:
+                done_list=f.read().splitlines()
+            
+            with open(os.path.join(proc_dir,'error'),'r') as f:
+                error_list=f.read().splitlines()
 
-        with open(os.path.join(proc_dir,'queue'),'r') as f:
-            queue_list=f.read().splitlines()
+            progress=campaigns.progress(self.current_library)
 
-        with open(os.path.join(proc_dir,'done'),'r') as f:
-            done_list=f.read().splitlines()
-            
-        with open(os.path.join(proc_dir,'error'),'r') as f:
-            error_list=f.read().splitlines()
+        # Campaigns only put their jobs in the queue as it drains; list what
+        # each has left ahead of the queue itself
+        queue_list=['campaign %s: %d of %d done, %d still to queue' % (name,p['done'],p['total'],p['unexpanded'])
+                    for name,p in sorted(progress.items()) if p['done']<p['total']]+queue_list
 
         done_list.reverse()
 
@@ -441,39 +512,216 @@ class MyWindow(QtGui.QMainWindow):
         if error_list:
             self.ui.error_listWidget.addItems(error_list)
 
-class MyTableModel(QtCore.QAbstractTableModel):
-    header_labels=['File','Case ID','Dose','Kernel','Slice Thickness','Recon Path']
-    
-    def __init__(self, datain, parent=None, *args):
-        QtCore.QAbstractTableModel.__init__(self, parent, *args)
-        self.arraydata = datain
+class ingest_worker(QtCore.QThread):
+    ### Runs the library's ingest_raw_data on the given raw files
+    progress = QtCore.pyqtSignal(object) # status (see ingest_status)
 
-    def rowCount(self, parent):
-        return len(self.arraydata)
+    def __init__(self,library,filepaths,parent=None):
+        QtCore.QThread.__init__(self,parent)
+        import threading
+        self.library=library
+        self.filepaths=filepaths
+        self.stopping=threading.Event()
+        self.cancelled=False
+        self.error=None
+        self.case_ids={}
 
-    def columnCount(self, parent):
-        return len(self.arraydata[0])
+    def cancel(self):
+        self.cancelled=True
+        self.stopping.set()
 
-    def data(self, index, role):
-        if not index.isValid():
+    def run(self):
+        try:
+            self.case_ids=self.library.ingest_raw_data(self.filepaths,progress=self.progress.emit,stop=self.stopping.is_set)
+        except Exception as e:
+            logging.error('Raw data ingestion failed: %s' % e)
+            self.error=e
+
+class recon_store_worker(QtCore.QThread):
+    ### Serves page, count and change requests against the library's recon
+    ### store. All store access (and the recon directory scan) happens here.
+    count_ready   = QtCore.pyqtSignal(int,int,int)        # generation, count, seq
+    page_ready    = QtCore.pyqtSignal(int,int,int,object) # generation, seq, page, rows
+    changes_ready = QtCore.pyqtSignal(int,int,object)     # generation, seq, (removed,inserted) or None
+
+    poll_interval=5.0
+    max_incremental=2000 # Larger change sets just reload the view
+
+    def __init__(self,library,parent=None):
+        QtCore.QThread.__init__(self,parent)
+        from queue import Queue
+        self.library=library
+        self.requests=Queue()
+        self.stopping=False
+        self.generation=0
+        self.view=None
+        self.since=None
+
+    def request(self,*args):
+        self.requests.put(args)
+
+    def run(self):
+        from queue import Empty
+        store=self.library.get_recon_store()
+        try:
+            while not self.stopping:
+                try:
+                    r=self.requests.get(timeout=self.poll_interval)
+                except Empty:
+                    r=('poll',)
+                try:
+                    self.handle(store,r)
+                except Exception as e:
+                    logging.error('Recon store request %s failed: %s' % (r[0],e))
+        finally:
+            store.close()
+
+    def handle(self,store,r):
+        if r[0]=='reset':
+            self.generation,self.view=r[1],r[2]
+            self.since=store.seq()
+            self.count_ready.emit(self.generation,store.count(self.view),self.since)
+        elif r[0]=='page':
+            generation,page,page_size=r[1:]
+            if generation!=self.generation:
+                return
+            # Deliver outstanding changes first so the page lines up with the model
+            self.poll(store)
+            rows=store.page(self.view,page*page_size,page_size)
+            self.page_ready.emit(self.generation,self.since,page,rows)
+        elif r[0]=='refresh':
+            self.library.refresh_recon_list()
+            self.poll(store)
+        elif r[0]=='poll':
+            self.poll(store)
+
+    def poll(self,store):
+        self.library.update_recon_store(store)
+        if self.view is None or store.seq()==self.since:
+            return
+        changes=store.changes(self.view,self.since)
+        if changes is not None:
+            seq,removed,inserted=changes
+            if len(removed)+len(inserted)>self.max_incremental:
+                changes=None
+        if changes is None:
+            self.since=store.seq()
+            self.changes_ready.emit(self.generation,self.since,None)
+        else:
+            self.since=seq
+            self.changes_ready.emit(self.generation,seq,(removed,inserted))
+
+class library_table_model(QtCore.QAbstractTableModel):
+    ### Lazy, paged view of the library's reconstructions
+    header_labels=['File','Case ID','Dose','Kernel','Slice Thickness','Recon Path']
+    page_size=256
+
+    def __init__(self,library,parent=None):
+        QtCore.QAbstractTableModel.__init__(self,parent)
+        self.library=library
+        self.view=view()
+        self.generation=0
+        self.seq=None
+        self.n_rows=0
+        self.pages={}
+        self.requested=set()
+
+        self.worker=recon_store_worker(library)
+        self.worker.count_ready.connect(self.on_count)
+        self.worker.page_ready.connect(self.on_page)
+        self.worker.changes_ready.connect(self.on_changes)
+        self.worker.start()
+        self.reset()
+
+    def stop(self):
+        self.worker.stopping=True
+        self.worker.wait()
+
+    def refresh(self):
+        # Rescan the recon directory (on the worker thread)
+        self.worker.request('refresh')
+
+    def reset(self):
+        self.generation+=1
+        self.pages={}
+        self.requested=set()
+        self.worker.request('reset',self.generation,self.view)
+
+    def set_filters(self,filters):
+        # filters: {'dose':[...],'kernel':[...],'slice_thickness':[...],'case':'prefix'}
+        self.view=view(self.view.sort_column,self.view.descending,filters)
+        self.reset()
+
+    def rowCount(self,parent=QtCore.QModelIndex()):
+        return self.n_rows
+
+    def columnCount(self,parent=QtCore.QModelIndex()):
+        return len(self.header_labels)
+
+    def data(self,index,role):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
             return QtCore.QVariant()
-        elif role != QtCore.Qt.DisplayRole:
+        page,i=divmod(index.row(),self.page_size)
+        if page not in self.pages:
+            if page not in self.requested:
+                self.requested.add(page)
+                self.worker.request('page',self.generation,page,self.page_size)
             return QtCore.QVariant()
-        return QtCore.QVariant(self.arraydata[index.row()][index.column()])
+        rows=self.pages[page]
+        if i>=len(rows):
+            return QtCore.QVariant()
+        return QtCore.QVariant(str(rows[i][index.column()]))
 
     def headerData(self,section,orientation,role=QtCore.Qt.DisplayRole):
-
         if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
             return self.header_labels[section]
         return QtCore.QAbstractTableModel.headerData(self, section, orientation, role)
 
-    def sort(self, Ncol, order):
-        import operator
-        self.emit(QtCore.SIGNAL("layouAboutToBeChanged()"))
-        self.arraydata = sorted(self.arraydata, key=operator.itemgetter(Ncol))
-        if order == QtCore.Qt.DescendingOrder:
-            self.arraydata.reverse()
-        self.emit(QtCore.SIGNAL("layoutChanged()"))
+    def sort(self,Ncol,order):
+        self.view=view(sort_columns[Ncol],order==QtCore.Qt.DescendingOrder,self.view.filters)
+        self.reset()
+
+    def on_count(self,generation,count,seq):
+        if generation!=self.generation:
+            return
+        self.beginResetModel()
+        self.n_rows=count
+        self.seq=seq
+        self.pages={}
+        self.requested=set()
+        self.endResetModel()
+
+    def on_page(self,generation,seq,page,rows):
+        self.requested.discard(page)
+        if generation!=self.generation or seq!=self.seq:
+            return
+        self.pages[page]=rows
+        first=page*self.page_size
+        last=min(self.n_rows,first+len(rows))-1
+        if last>=first:
+            self.dataChanged.emit(self.index(first,0),self.index(last,self.columnCount()-1))
+
+    def on_changes(self,generation,seq,changes):
+        if generation!=self.generation:
+            return
+        if changes is None:
+            self.reset()
+            return
+        removed,inserted=changes
+        for row in removed:
+            self.beginRemoveRows(QtCore.QModelIndex(),row,row)
+            self.n_rows-=1
+            self.endRemoveRows()
+        for row,values in inserted:
+            self.beginInsertRows(QtCore.QModelIndex(),row,row)
+            self.n_rows+=1
+            self.endInsertRows()
+        # Cached pages have shifted; visible rows are refetched on demand
+        self.seq=seq
+        self.pages={}
+        self.requested=set()
+        if self.n_rows:
+            self.dataChanged.emit(self.index(0,0),self.index(self.n_rows-1,self.columnCount()-1))
 
 def get_base_parameter_files(file_list):
     logging.info('Generating parameter files and reading into pipeline');
@@ -486,8 +734,8 @@ def get_base_parameter_files(file_list):
             continue
         
         # Generate the parameter file
-        devnull=open(os.devnull,'w')
-        call(['ctbb_info','-b',f],stdout=devnull,stderr=devnull);
+        exit_status,record=usage.run(['ctbb_info','-b',f])
+        usage.log_usage('prmb',record)
 
         # Open the parameter file and read into pipeline
         with open(f+'.prmb') as f_prmb:
@@ -23,12 +23,24 @@ setup(name='CTBB_Pipeline',
           ],
       scripts=[
           "bin/ctbb_copy_pipeline_dataset",          
+          "bin/ctbb_pipeline_analyze",
+          "bin/ctbb_pipeline_arbiter",
+          "bin/ctbb_pipeline_bench",
+          "bin/ctbb_pipeline_catalog",
+          "bin/ctbb_pipeline_compare",
+          "bin/ctbb_pipeline_compress",
+          "bin/ctbb_pipeline_control",
           "bin/ctbb_pipeline_daemon",
           "bin/ctbb_pipeline_diff",
           "bin/ctbb_pipeline_kill",
           "bin/ctbb_pipeline_launch",
           "bin/ctbb_pipeline_metrics",
           "bin/ctbb_pipeline.py",
+          "bin/ctbb_pipeline_previews",
+          "bin/ctbb_pipeline_simulate",
+          "bin/ctbb_pipeline_slice_server",
+          "bin/ctbb_pipeline_stages",
+          "bin/ctbb_pipeline_layout",
           "bin/ctbb_pipeline_qa_docs",
           "bin/ctbb_queue_item",
           "bin/ctbb_q",
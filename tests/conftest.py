@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from CTBB_Pipeline.ctbb_pipeline_library import default_settings
+
+class library_stub:
+    ### The parts of ctbb_pipeline_library that the modules under test use:
+    ### its directories and settings (the defaults, updated with overrides)
+    def __init__(self,path,**settings):
+        self.path=path
+        self.raw_dir=os.path.join(path,'raw')
+        self.recon_dir=os.path.join(path,'recon')
+        self.mutex_dir=os.path.join(path,'.proc','mutex')
+        os.makedirs(self.mutex_dir,exist_ok=True)
+        self.settings=dict(default_settings)
+        self.settings.update(settings)
+
+@pytest.fixture
+def fake_library(tmp_path):
+    ### fake_library(**settings): a fake library in tmp_path
+    def make(**settings):
+        return library_stub(str(tmp_path),**settings)
+    return make
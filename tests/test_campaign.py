@@ -0,0 +1,64 @@
+import os
+
+from CTBB_Pipeline import ctbb_pipeline_campaign as campaigns
+
+def make_campaign(fake_library,name='study',cases=('/raw/a.ptr','/raw/b.ptr'),priority=0):
+    library=fake_library()
+    c=campaigns.create(library,name,list(cases),[100,25],[1.0,2.0],[1],priority)
+    return library,c
+
+def test_grid_index_round_trip(fake_library):
+    library,c=make_campaign(fake_library)
+    assert c.size()==8
+    for i in range(c.size()):
+        assert c.index(*c.job(i))==i
+    assert c.job(5)==('/raw/b.ptr','100','1','2.0')
+    assert c.index('/raw/b.ptr',100,1,2)==5
+    assert c.index('/raw/c.ptr',100,1,2.0) is None
+
+def test_bitmaps(fake_library):
+    library,c=make_campaign(fake_library)
+    c.set_bits('done',[3])
+    c.set_bits('done',[0,7])
+    done=c.read_bitmap('done')
+    assert [i for i in range(c.size()) if campaigns.is_bit_set(done,i)]==[0,3,7]
+    assert campaigns.popcount(done)==3
+    c.set_bits('cancelled',[5])
+    assert c.unexpanded(cursor=2)==3
+    c.clear_bitmap('cancelled')
+    assert campaigns.popcount(c.read_bitmap('cancelled'))==0
+
+def test_mark_done(fake_library):
+    library,c=make_campaign(fake_library)
+    campaigns.mark_done(library,c.queue_item(6))
+    assert campaigns.is_bit_set(c.read_bitmap('done'),6)
+
+def test_expand_leaves_cursor_until_advanced(fake_library):
+    library,c=make_campaign(fake_library)
+    c.set_bits('done',[1])
+    queue=[c.queue_item(2)]
+    new_items,cursors=campaigns.expand(library,queue,[],4)
+    assert new_items==[c.queue_item(i) for i in [0,3,4]]
+    assert c.get_cursor()==0
+    campaigns.advance(cursors)
+    assert c.get_cursor()==5
+    new_items,cursors=campaigns.expand(library,queue+new_items,[],4)
+    assert new_items==[] and cursors==[]
+
+def test_list_campaigns_reuses_unchanged_campaigns(fake_library):
+    library,c=make_campaign(fake_library)
+    first=campaigns.list_campaigns(library)
+    assert campaigns.list_campaigns(library)[0] is first[0]
+    spec=os.path.join(c.path,'spec.yml')
+    os.utime(spec,(0,0))
+    assert campaigns.list_campaigns(library)[0] is not first[0]
+    campaigns.remove(library,c.name)
+    assert campaigns.list_campaigns(library)==[]
+
+def test_progress_follows_state_files(fake_library):
+    library,c=make_campaign(fake_library)
+    assert c.progress()['done']==0
+    c.set_bits('done',[0,1])
+    assert c.progress()['done']==2
+    c.set_cursor(c.size())
+    assert c.progress()['unexpanded']==0
@@ -0,0 +1,33 @@
+import logging
+
+import pytest
+
+from CTBB_Pipeline import ctbb_pipeline_control as control
+
+def test_parse_priority():
+    assert control.parse_priority('high')==1
+    assert control.parse_priority('low')==-1
+    assert control.parse_priority('3')==3
+    assert control.parse_priority(-2)==-2
+    with pytest.raises(ValueError):
+        control.parse_priority('urgent')
+
+def test_job_priority():
+    assert control.job_priority('/raw/a.ptr,100,1,1.0')==0
+    assert control.job_priority('/raw/a.ptr,100,1,1.0,priority=2')==2
+    assert control.job_priority('/raw/a.ptr,100,1,1.0,priority=high')==1
+
+def test_job_priority_bad_value_is_normal(caplog):
+    qi='/raw/a.ptr,100,1,1.0,priority=soon'
+    with caplog.at_level(logging.WARNING):
+        assert control.job_priority(qi)==0
+        assert control.job_priority(qi)==0
+    assert len([r for r in caplog.records if 'priority' in r.getMessage()])==1
+
+class first_policy:
+    def select(self,queue,device):
+        return 0
+
+def test_select_takes_highest_priority():
+    queue=['/raw/a.ptr,100,1,1.0','/raw/b.ptr,100,1,1.0,priority=high','/raw/c.ptr,100,1,1.0,priority=bad']
+    assert control.select(first_policy(),queue,'dev0')==1
@@ -0,0 +1,22 @@
+import shutil
+
+from CTBB_Pipeline import ctbb_pipeline_cpu as cpu
+
+def test_parse_cpulist():
+    assert cpu.parse_cpulist('0-3,8,10-11\n')==[0,1,2,3,8,10,11]
+    assert cpu.parse_cpulist('')==[]
+
+def test_split():
+    assert cpu.split([0,1,2,3,4,5],2)==[[0,1,2],[3,4,5]]
+    assert cpu.split([0],2)==[[0],[0]]
+
+def test_stage_prefix(monkeypatch,fake_library):
+    monkeypatch.setattr(shutil,'which',lambda name: '/usr/bin/'+name)
+    assert cpu.cpu_stage(fake_library(),'fetch_raw').command(['cp','a','b'])==['nice','-n','10','ionice','-c','3','cp','a','b']
+    assert cpu.cpu_stage(fake_library(),'dose_reduction').prefix()==['nice','-n','5','ionice','-c','2','-n','4']
+    assert cpu.cpu_stage(fake_library(),'recon').prefix()==[]
+    assert cpu.cpu_stage(fake_library(cpu_stages={'recon':{'nice':3}}),'recon').prefix()==['nice','-n','3']
+
+def test_stage_prefix_without_tools(monkeypatch,fake_library):
+    monkeypatch.setattr(shutil,'which',lambda name: None)
+    assert cpu.cpu_stage(fake_library(),'fetch_raw').prefix()==[]
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from CTBB_Pipeline import ctbb_pipeline_dag as dag
+
+def test_compress_recons_implies_compress_stage(fake_library):
+    library=fake_library(stages={'preview':{'run':'preview'},'analysis':{'run':'analysis'}},
+                         compress_recons=True,compress_keep_img=True)
+    stages=dag.library_stages(library)
+    assert [s['name'] for s in stages]==['analysis','preview','compress']
+    assert stages[-1]['resource']=='io'
+    assert sorted(stages[-1]['after'])==['analysis','preview']
+    assert stages[-1]['options']=={'keep':True}
+
+def test_declared_compress_stage_is_kept(fake_library):
+    declared={'shrink':{'run':'compress','options':{'level':9}}}
+    stages=dag.library_stages(fake_library(stages=declared,compress_recons=True))
+    assert [(s['name'],s['options']) for s in stages]==[('shrink',{'level':9})]
+    assert dag.library_stages(fake_library(stages={},compress_recons=False))==[]
+
+def test_compress_stage_name_taken(fake_library):
+    with pytest.raises(ValueError):
+        dag.library_stages(fake_library(stages={'compress':{'run':'gzip {series}'}},compress_recons=True))
+
+def test_command_stage_keeps_paths_with_spaces_whole(tmp_path):
+    log_dir=os.path.join(str(tmp_path),"it's a log dir")
+    series=os.path.join(str(tmp_path),'my study','series 1.img')
+    os.makedirs(log_dir)
+    os.makedirs(os.path.dirname(series))
+    with open(series,'w') as f:
+        f.write('data')
+    stage={'name':'copy','run':'cp {series} {log_dir}/{name}.copy','options':{}}
+    dag.run_task(str(tmp_path),stage,{'series':series,'log_dir':log_dir,'name':'job 1'})
+    with open(os.path.join(log_dir,'job 1.copy'),'r') as f:
+        assert f.read()=='data'
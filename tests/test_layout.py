@@ -0,0 +1,51 @@
+import os
+from hashlib import md5
+
+from CTBB_Pipeline import ctbb_pipeline_layout as layout
+
+case_id='5a1eebd46534e0e22036254ddd54c4db'
+
+def write(path,data):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    with open(path,'wb') as f:
+        f.write(data)
+
+def test_shard():
+    assert layout.shard(case_id)==os.path.join('5a','1e')
+    # Names that are not digests are sharded by their md5
+    h=md5(b'scan.ptr.prmb').hexdigest()
+    assert layout.shard('scan.ptr.prmb')==os.path.join(h[0:2],h[2:4])
+
+def test_in_layout():
+    flat=os.path.join('/lib','raw','100',case_id)
+    sharded=os.path.join('/lib','raw','100','5a','1e',case_id)
+    assert layout.in_layout(flat,'flat') and not layout.in_layout(flat,'sharded')
+    assert layout.in_layout(sharded,'sharded') and not layout.in_layout(sharded,'flat')
+
+def test_raw_filepath_finds_either_layout(fake_library):
+    library=fake_library(layout='sharded')
+    flat=os.path.join(library.raw_dir,'100',case_id)
+    write(flat,b'raw')
+    assert layout.raw_filepath(library,100,case_id)==flat
+    os.remove(flat)
+    assert layout.raw_filepath(library,100,case_id)==os.path.join(library.raw_dir,'100','5a','1e',case_id)
+
+def test_move_raw(fake_library):
+    library=fake_library()
+    path=os.path.join(library.raw_dir,'100','5a','1e',case_id)
+    write(path,b'raw')
+    assert layout.move(library,'raw','100',case_id,path,'flat')=='moved'
+    assert os.path.exists(os.path.join(library.raw_dir,'100',case_id))
+    assert not os.path.exists(os.path.join(library.raw_dir,'100','5a'))
+
+def test_move_raw_duplicate_and_conflict(fake_library):
+    library=fake_library()
+    dest=os.path.join(library.raw_dir,'25',case_id)
+    write(dest,b'noise realization 1')
+    path=os.path.join(library.raw_dir,'25','5a','1e',case_id)
+    write(path,b'noise realization 2')
+    assert layout.move(library,'raw','25',case_id,path,'flat')=='conflict'
+    assert os.path.exists(path) and os.path.exists(dest)
+    write(path,b'noise realization 1')
+    assert layout.move(library,'raw','25',case_id,path,'flat')=='duplicate'
+    assert not os.path.exists(path) and os.path.exists(dest)
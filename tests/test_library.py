@@ -0,0 +1,38 @@
+import os
+
+from CTBB_Pipeline import ctbb_pipeline_library as plib
+
+def make_library(tmp_path):
+    path=os.path.join(str(tmp_path),'library')
+    os.mkdir(path)
+    return plib.ctbb_pipeline_library(path)
+
+def make_raw(tmp_path,name,data):
+    path=os.path.join(str(tmp_path),name)
+    with open(path,'wb') as f:
+        f.write(data)
+    return path
+
+def test_ingest_status():
+    status={'n_total':4,'n_done':1,'n_failed':1,'bytes_total':4e9,'bytes_done':1.5e9,
+            'elapsed':60.0,'eta':3725.0}
+    assert plib.ingest_status(status)=='1/4 files, 1.5/4.0 GB, 1 failed, ETA 1:02:05'
+    status.update({'n_done':3,'n_failed':1,'bytes_done':4e9,'eta':0.0})
+    assert plib.ingest_status(status)=='3/4 files, 4.0/4.0 GB, 1 failed'
+
+def test_ingest_raw_data(tmp_path):
+    library=make_library(tmp_path)
+    a=make_raw(tmp_path,'a.ptr',b'a'*1000)
+    b=make_raw(tmp_path,'b.ptr',b'b'*1000)
+    case_ids=library.ingest_raw_data([a,b,a],concurrency=2)
+    assert sorted(case_ids)==[a,b]
+    assert library.__get_case_list__()[a]==case_ids[a]
+    assert os.path.exists(os.path.join(library.raw_dir,'100',case_ids[a]))
+    assert library.ingest_raw_data([a,b])=={}
+
+def test_ingest_raw_data_stopped(tmp_path):
+    library=make_library(tmp_path)
+    files=[make_raw(tmp_path,'%d.ptr' % i,bytes([i])*1000) for i in range(3)]
+    assert library.ingest_raw_data(files,concurrency=1,stop=lambda: True)=={}
+    assert files[0] not in library.__get_case_list__()
+    assert [f for f in os.listdir(os.path.join(library.raw_dir,'100')) if f.endswith('.tmp')]==[]
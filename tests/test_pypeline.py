@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from CTBB_Pipeline import pypeline as pype
+
+data_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'data')
+
+def read_example():
+    with open(os.path.join(data_dir,'example.prm'),'r') as f:
+        return f.read()
+
+def test_parse_prm_value():
+    assert pype.parse_prm_value('512')==512
+    assert pype.parse_prm_value('-1254.5')==-1254.5
+    assert pype.parse_prm_value('definitionas.scanner')=='definitionas.scanner'
+    assert pype.parse_prm_value('[1,0,0,0,1,0]')==[1,0,0,0,1,0]
+    assert pype.parse_prm_value('[[1,0,0],[0,1,0]]')==[[1,0,0],[0,1,0]]
+    assert pype.parse_prm_value('[a, b]')==['a','b']
+    with pytest.raises(ValueError):
+        pype.parse_prm_value('[[a,b]]')
+
+def test_parse_prm_real_prm_takes_fast_path(monkeypatch):
+    string=read_example()
+    expected=pype.parse_prm_yaml(string)
+
+    def no_yaml(string):
+        raise AssertionError('fell back to YAML')
+    monkeypatch.setattr(pype,'parse_prm_yaml',no_yaml)
+
+    prm=pype.parse_prm(string)
+    assert prm==expected
+    assert prm['ImageOrientationPatient']==[[1,0,0],[0,1,0]]
+    assert prm['Scanner']=='definitionas.scanner'
+    assert prm['RawDataFile']=='5a1eebd46534e0e22036254ddd54c4db'
+
+def test_parse_prm_falls_back_to_yaml():
+    assert pype.parse_prm('Key: [[a, b], [c]]\n')=={'Key':[['a','b'],['c']]}
+    assert pype.parse_prm('Key: {a: 1}\n')=={'Key':{'a':1}}
+
+def test_series_header_from_real_prm():
+    header=pype.series_header.from_prm(pype.parse_prm(read_example()))
+    assert header.ImageOrientationPatient==[[1,0,0],[0,1,0]]
+    assert header.Width==512
+    assert header.TotalCollimationWidth==pytest.approx(64*0.6)
+    assert header.SpiralPitchFactor==pytest.approx(38.4/(64*0.6))
+
+def write_lock(m,record):
+    with open(m.mutex_file,'w') as f:
+        f.write(record)
+
+def test_claim_if_dead_removes_dead_holder(tmp_path):
+    m=pype.mutex('slot',str(tmp_path))
+    write_lock(m,'host 999999 0.0\n')
+    assert m.claim_if_dead(lambda owner: owner[1]==999999)==('host',999999)
+    assert not m.check_state()
+    assert m.try_lock()
+
+def test_claim_if_dead_keeps_live_holder(tmp_path):
+    m=pype.mutex('slot',str(tmp_path))
+    m.lock()
+    assert m.claim_if_dead(lambda owner: False) is None
+    assert m.owner()[1]==os.getpid()
+
+def test_claim_if_dead_restores_lock_taken_meanwhile(tmp_path):
+    m=pype.mutex('slot',str(tmp_path))
+    write_lock(m,'host 999999 0.0\n')
+    def is_dead(owner):
+        # The dead holder's lock is released and taken by a live process
+        # between the check and the claim
+        os.remove(m.mutex_file)
+        write_lock(m,'host 123 1.0\n')
+        return True
+    assert m.claim_if_dead(is_dead) is None
+    assert m.owner()==('host',123)
+    assert [f for f in os.listdir(str(tmp_path)) if f!='slot']==[]
@@ -0,0 +1,59 @@
+import random
+
+from CTBB_Pipeline import ctbb_pipeline_scheduler as scheduler
+
+def queue_item(i):
+    return '/raw/case%d.ptr,%d,1,1.0' % (i%7,[100,50,25][i%3])
+
+def reference(policy,queue):
+    ### The choice sjf/lpt make, from the whole window at once
+    window=queue[0:policy.window]
+    predicted=[policy.predict(qi) for qi in window]
+    return predicted.index(max(predicted) if policy.longest_first else min(predicted))
+
+def drive(policy,steps=2000,seed=0):
+    rng=random.Random(seed)
+    queue=[queue_item(i) for i in range(40)]
+    n=len(queue)
+    active=[]
+    for step in range(steps):
+        policy.update(queue,active)
+        for device in range(rng.randint(1,3)):
+            if not queue:
+                break
+            i=policy.select(queue,device)
+            assert i==reference(policy,queue)
+            qi=queue.pop(i)
+            policy.dispatched(qi,device)
+            active.append(qi)
+        # Jobs finish, arrive, and are removed or reordered behind the
+        # policy's back (ctbb_pipeline_control)
+        if active and rng.random()<0.5:
+            active.pop(rng.randrange(len(active)))
+        for k in range(rng.randint(0,3)):
+            queue.append(queue_item(n))
+            n+=1
+        if queue and rng.random()<0.1:
+            queue.pop(rng.randrange(len(queue)))
+        if rng.random()<0.05:
+            rng.shuffle(queue)
+
+def test_sjf_matches_full_window_scan():
+    durations={}
+    def predict(qi):
+        return durations.setdefault(qi,random.Random(qi).choice([10.0,20.0,30.0,40.0]))
+    drive(scheduler.sjf_policy(lambda filepath,dose: True,predict,window=16,max_bypass=None))
+    drive(scheduler.lpt_policy(lambda filepath,dose: True,predict,window=None))
+
+def test_sjf_bypass_limit():
+    queue=[queue_item(i) for i in range(4)]
+    durations=dict(zip(queue,[100.0,10.0,20.0,30.0]))
+    policy=scheduler.sjf_policy(lambda filepath,dose: True,durations.get,max_bypass=2)
+    long_job,short1,short2,short3=queue
+    policy.update(queue,[])
+    picks=[]
+    for device in range(3):
+        i=policy.select(queue,device)
+        picks.append(queue[i])
+        policy.dispatched(queue.pop(i),device)
+    assert picks==[short1,short2,long_job]
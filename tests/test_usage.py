@@ -0,0 +1,47 @@
+import os
+import signal
+import logging
+
+import pytest
+
+from CTBB_Pipeline import ctbb_pipeline_usage as usage
+
+record={'command':'ctbb_recon','exit_status':0,'wall':12.3456,'utime':40.5,'stime':1.25,
+        'maxrss_kb':2048000,'rchar':123456789,'wchar':1000,'read_bytes':4096,'write_bytes':0}
+
+def test_format_parse_round_trip():
+    line='2017-01-24 10:00:00,000 USAGE: %s' % usage.format_usage('recon',record)
+    parsed=usage.parse_usage(line)
+    assert parsed.pop('stage')=='recon'
+    assert parsed.pop('wall')==pytest.approx(12.346) # written to the millisecond
+    assert parsed=={k:v for k,v in record.items() if k!='wall'}
+
+def test_parse_usage_without_record():
+    assert usage.parse_usage('2017-01-24 10:00:00,000 Launching reconstruction') is None
+    assert usage.parse_usage('USAGE: command=ctbb_recon') is None
+
+def test_log_usage(caplog):
+    with caplog.at_level(logging.INFO):
+        usage.log_usage('dose_reduction',record)
+    assert usage.parse_usage(caplog.records[-1].getMessage())['stage']=='dose_reduction'
+
+def test_exit_code():
+    assert usage.exit_code(0)==0
+    assert usage.exit_code(3<<8)==3
+    assert usage.exit_code(signal.SIGKILL)==-signal.SIGKILL
+
+def test_read_proc_io():
+    if not os.path.exists('/proc/self/io'):
+        pytest.skip('no task I/O accounting')
+    io=usage.read_proc_io(os.getpid())
+    assert set(usage.io_fields)<=set(io)
+    assert usage.read_proc_io(-1)=={}
+
+def test_run():
+    exit_status,r=usage.run(['sh','-c','exit 3'])
+    assert exit_status==3 and r['exit_status']==3
+    assert r['command']=='sh'
+    assert set(r)==set(usage.usage_fields)
+    exit_status,r=usage.run('/bin/sh -c "kill -9 $$"',shell=True,command='/opt/bin/ctbb_recon')
+    assert exit_status==-signal.SIGKILL
+    assert r['command']=='ctbb_recon'